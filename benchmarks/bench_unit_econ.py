@@ -0,0 +1,160 @@
+"""
+Бенчмарк unit-экономики unit_day_5: 10 000 SKU × 30 дней.
+
+Сравнивает колоночный расчёт (unit_costs.rates() + unit_rows()) с
+прежними циклами по словарям (legacy_rows — эталон, перенесён как был)
+и проверяет, что таблица совпадает полностью.
+
+    python -m benchmarks.bench_unit_econ [--skus 10000] [--days 30]
+"""
+from __future__ import annotations
+import argparse, random, time
+from collections import defaultdict
+from datetime import date, timedelta
+
+from core.services import unit_costs
+from core.services.sku_ref import SkuRef, SkuRow
+from report_scripts.unit_day_5 import num, unit_rows
+
+SERVICES = ["MarketplaceServiceItemDirectFlowLogistic",
+            "MarketplaceRedistributionOfAcquiringOperation",
+            "MarketplaceServiceItemDelivToCustomer",
+            "MarketplaceServiceItemReturnFlowLogistic"]
+
+
+def synth(n_skus: int, n_days: int, seed: int = 1):
+    rnd = random.Random(seed)
+    skus = [100_000_000 + i for i in range(n_skus)]
+    start = date(2026, 1, 1)
+    days = [(start + timedelta(days=d)).isoformat() for d in range(n_days)]
+
+    sales_rows, fin_ops = [], []
+    for sku in skus:
+        for d in days:
+            units = rnd.randint(0, 5)
+            if not units:
+                continue
+            sales_rows.append({
+                "dimensions": [{"id": str(sku), "name": f"Товар {sku}"}, {"id": d}],
+                "metrics": [units, round(units * rnd.uniform(300, 3000), 2)],
+            })
+            items = [{"sku": sku}] + ([{"sku": rnd.choice(skus)}] if rnd.random() < 0.1 else [])
+            fin_ops.append({
+                "operation_type": "OperationAgentDeliveredToCustomer",
+                "accruals_for_sale": round(rnd.uniform(0, 3000), 2) * (rnd.random() > 0.05),
+                "sale_commission": -round(rnd.uniform(0, 500), 2),
+                "items": items,
+                "services": [{"name": name, "price": -round(rnd.uniform(5, 150), 2)}
+                             for name in SERVICES if rnd.random() < 0.8],
+            })
+    ref = SkuRef("bench", 0.0, "", {
+        sku: SkuRow(f"Товар {sku}", round(rnd.uniform(50, 1500), 2),
+                    rnd.choice([None, 6.0, 7.0, 15.0]))
+        for sku in skus if rnd.random() < 0.9})
+    adv_map = {(f"{d[8:10]}.{d[5:7]}.{d[:4]}", str(sku)): num(rnd.uniform(0, 200))
+               for sku in skus[: n_skus // 3] for d in days[:7]}
+    return sales_rows, fin_ops, ref, adv_map
+
+
+def legacy_rows(sales_rows, fin_ops, ref, adv_map, default_tax, today_key, today_disp):
+    """Прежняя реализация из unit_day_5.run (до колоночного конвейера)."""
+    from datetime import datetime
+
+    sales = defaultdict(lambda: {"name": None, "units": 0, "rev": 0.0})
+    for r in sales_rows:
+        sku = r["dimensions"][0]["id"]
+        name = r["dimensions"][0]["name"]
+        day = datetime.strptime(r["dimensions"][1]["id"],
+                                "%Y-%m-%d").strftime("%d.%m.%Y")
+        s = sales[(day, sku)]
+        s["name"] = name
+        s["units"] += r["metrics"][0]
+        s["rev"] += r["metrics"][1]
+
+    tmp = defaultdict(lambda: {"log": [], "acq": [], "last": [],
+                               "accr": 0.0, "comm": 0.0})
+    for op in fin_ops:
+        accr = op.get("accruals_for_sale", 0)
+        comm = abs(op.get("sale_commission", 0))
+        for it in op.get("items", []):
+            sku = it["sku"]
+            for s in op.get("services", []):
+                n, p = s["name"], abs(s["price"])
+                if n == "MarketplaceServiceItemDirectFlowLogistic":
+                    tmp[sku]["log"].append(p)
+                elif n == "MarketplaceRedistributionOfAcquiringOperation":
+                    tmp[sku]["acq"].append(p)
+                elif n == "MarketplaceServiceItemDelivToCustomer":
+                    tmp[sku]["last"].append(p)
+            tmp[sku]["accr"] += accr
+            tmp[sku]["comm"] += comm
+
+    svc = {}
+    for sku, d in tmp.items():
+        pct = round(d["comm"] / d["accr"] * 100, 2) if d["accr"] else 0
+        avg = lambda lst: round(sum(lst) / len(lst), 2) if lst else 0
+        svc[sku] = {"log": avg(d["log"]), "acq": avg(d["acq"]),
+                    "last": avg(d["last"]), "pct": pct}
+
+    rows_by_day = defaultdict(list)
+    for (day, sku), s in sales.items():
+        sku_str = str(sku)
+        units = int(s["units"])
+        revenue = round(float(s["rev"]), 2)
+
+        sv = svc.get(int(sku), {})
+        log_r = round(abs(sv.get("log", 0)) * units, 2)
+        acq_r = round(abs(sv.get("acq", 0)) * units, 2)
+        last_r = round(abs(sv.get("last", 0)) * units, 2)
+        comm_r = round(revenue * sv.get("pct", 0) / 100, 2)
+
+        inp = ref.get(sku)
+        tax_pct = (round(inp.tax, 2) if inp and inp.tax is not None
+                   else default_tax)
+        tax_r = round(revenue * tax_pct / 100, 2)
+
+        adv = adv_map.get((day, sku_str), 0.0)
+        sebes_u = round(inp.cost, 2) if inp else 0.0
+
+        rows_by_day[day].append([
+            today_disp if day == today_key else day, sku,
+            (inp.name if inp else "") or s["name"],
+            units, revenue, adv, log_r, comm_r, acq_r, last_r,
+            tax_r, "", sebes_u, "", "",
+        ])
+    return rows_by_day
+
+
+def best_of(fn, repeat: int) -> tuple[float, object]:
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--skus", type=int, default=10_000)
+    ap.add_argument("--days", type=int, default=30)
+    ap.add_argument("--repeat", type=int, default=3)
+    a = ap.parse_args()
+
+    sales_rows, fin_ops, ref, adv_map = synth(a.skus, a.days)
+    args = (ref, adv_map, 7.0, "05.01.2026", "05.01.2026 (12:00 МСК)")
+    print(f"{a.skus} SKU × {a.days} дн.: строк продаж {len(sales_rows)}, операций {len(fin_ops)}")
+
+    t_old, old = best_of(lambda: legacy_rows(sales_rows, fin_ops, *args), a.repeat)
+    t_new, new = best_of(
+        lambda: unit_rows(sales_rows, unit_costs.rates(fin_ops), *args), a.repeat)
+    same = list(old.items()) == list(new.items())
+    print(f"циклы:     {t_old:7.3f} с")
+    print(f"колонки:   {t_new:7.3f} с  (×{t_old / t_new:.1f})")
+    print(f"таблица совпадает: {'да' if same else 'НЕТ'}")
+    if not same:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,26 @@ class Settings(BaseSettings):
     BOT_TOKEN: str = Field(..., env="BOT_TOKEN")                  # обязательное поле
     TECH_SHEET_ID: str = Field(..., env="TECH_SHEET_ID")          # обязательное поле
     ADMIN_SA_JSON: str = Field(..., env="ADMIN_SA_JSON")          # путь к JSON сервисного аккаунта
-    WORKERS: int = 2                                              # опционально, по умолчанию 2
+    REPORT_WORKERS: int = 6                                       # общий лимит одновременных отчётов
+    LONG_WORKERS: int = 3                                         # из них долгих (p_campain, fin_week)
+    SHORT_WORKERS: int = 5                                        # из них коротких (unit_day, balans)
+    LONG_THREADS: int = 3                                         # пул потоков долгих скриптов
+    SHORT_THREADS: int = 5                                        # пул потоков коротких скриптов
+    REPORT_MODE: str = "thread"                                   # "thread" | "process" для синхронных run()
+    PROCESS_WORKERS: int = 2                                      # размер пула процессов
+    PROCESS_MAX_TASKS: int = 20                                   # заданий на процесс до перезапуска
+    PROCESS_RSS_MB: int = 1024                                    # RSS, после которого пул пересоздаётся
+    COALESCE_WINDOW: int = 120                                    # сек: идущий отчёт поглощает повторы
+    AUTO_TASKS: str = "chain"                                     # автозадачи через запятую: chain,balans,fin_week
+    AUTO_JITTER: int = 60                                         # сек случайного сдвига автозапусков
+    STATE_DB: str = str(BASE_DIR / "var" / "state.sqlite3")       # очередь заданий и прочее состояние
+    JOB_LEASE: int = 300                                          # сек аренды running-задания (heartbeat ×3)
+    FLEET_SHARDS: int = 0                                         # 0 — отчёты в процессе бота; N — воркеры core.tasks.worker
+    METRICS_PORT: int = 9108                                      # /metrics на 127.0.0.1 (воркер i: +1+i); 0 — выкл.
+    ADMIN_IDS: str = ""                                           # Telegram id админов через запятую (/stats)
+    TRACE_FILE: str = str(BASE_DIR / "var" / "trace.jsonl")       # span-ы заданий (core.tasks.trace); "" — выкл.
+    DEADLINES: str = ""                                           # "script=сек,…" — потолок времени скрипта (core.tasks.deadlines)
+    STALL_MINUTES: int = 15                                       # мин без прогресса — сторож снимает задание
 
     class Config:
         env_file = ".env"
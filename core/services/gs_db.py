@@ -45,6 +45,13 @@ class GsDB:
               credentials_json, sheet_id, sa_path]]
         )
 
+    async def get_stores(self) -> dict[str, dict[str, Any]]:
+        """Все магазины по store_id — одним чтением листа."""
+        ws = await self._ws("Stores")
+        return {r[0]: dict(store_id=r[0], owner_id=r[1], marketplace=r[2], name=r[3],
+                           credentials_json=r[4], sheet_id=r[5], sa_path=r[6])
+                for r in (await self.sheets.read_all(ws))[1:]}
+
     # ─── сервис-аккаунт ───
     async def pick_service_account(self) -> dict[str, str]:
         sa = await sa_cache.pick()
@@ -0,0 +1,109 @@
+"""
+HTTP для отчётных скриптов: инструментированные requests-сессии.
+
+Каждый запрос к Ozon / Google становится span «http» текущего задания
+(core.tasks.trace) и строкой учёта квот (core.tasks.usage): метод,
+эндпоинт, статус, байты, время; исключения тоже. Модульные post/get
+ходят через сессию своего потока — keep-alive вместо нового TCP+TLS
+на каждую страницу.
+
+Таймаут каждого запроса урезается до остатка срока задания
+(core.tasks.cancel.current()); после срока запрос не уходит вовсе.
+Ответ (и ошибка) — пульс задания для сторожа планировщика.
+"""
+from __future__ import annotations
+import threading, time
+from urllib.parse import urlsplit
+
+import requests
+
+from core.tasks import cancel, trace, usage
+
+_local = threading.local()
+
+
+def _body_len(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    return 0    # генератор / файл — размер заранее неизвестен
+
+
+def _clamp(timeout, left: float):
+    """timeout requests (число | (connect, read) | None), не длиннее left сек."""
+    left = max(left, 1.0)
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+def instrument(session: requests.Session) -> requests.Session:
+    """Оборачивает session.send: span трассировки + учёт в core.tasks.usage."""
+    if getattr(session, "_instrumented", False):
+        return session
+    send = session.send
+
+    def traced_send(request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        token = cancel.current()
+        left = token.remaining()
+        if left is not None:
+            token.check()
+            kwargs["timeout"] = _clamp(kwargs.get("timeout"), left)
+        start, t0 = time.time(), time.monotonic()
+        url = urlsplit(request.url)
+        try:
+            r = send(request, **kwargs)
+        except Exception as e:
+            token.beat()
+            usage.record(request.url, None, _body_len(request.body), 0, time.monotonic() - t0)
+            trace.record("http", start, time.time(), method=request.method,
+                         host=url.hostname, path=url.path, error=type(e).__name__)
+            raise
+        token.beat()
+        # без stream=True тело уже прочитано внутри send
+        size = (len(r.content) if not kwargs.get("stream")
+                else int(r.headers.get("Content-Length") or 0))
+        usage.record(request.url, r.status_code, _body_len(request.body), size,
+                     time.monotonic() - t0)
+        trace.record("http", start, time.time(), method=request.method,
+                     host=url.hostname, path=url.path, status=r.status_code, bytes=size)
+        return r
+
+    session.send = traced_send
+    session._instrumented = True
+    return session
+
+
+def session() -> requests.Session:
+    return instrument(requests.Session())
+
+
+def _thread_session() -> requests.Session:
+    if getattr(_local, "session", None) is None:
+        _local.session = session()
+    return _local.session
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return _thread_session().post(url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return _thread_session().get(url, **kwargs)
+
+
+def authed_session(gc):
+    """AuthorizedSession клиента gspread — для прямых вызовов Google API."""
+    return getattr(getattr(gc, "http_client", None), "session", None) \
+        or getattr(gc, "session", None)         # gspread 6 / 5
+
+
+def gspread_client(creds):
+    """gspread.authorize(creds) с той же обёрткой на его AuthorizedSession."""
+    import gspread
+    gc = gspread.authorize(creds)
+    sess = authed_session(gc)
+    if sess is not None:
+        instrument(sess)
+    return gc
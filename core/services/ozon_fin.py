@@ -0,0 +1,123 @@
+"""
+Финансовые операции Ozon (/v3/finance/transaction/list) помесячно.
+
+Календарный месяц — единица загрузки и кэша: в цепочке и fin_week_1
+(вся история), и ops_since (догрузка дней для core.services.unit_costs)
+берут месяц через context.cached() — кто пришёл вторым, ждёт загрузку
+первого, а не качает те же страницы параллельно. Вне цепочки ops_since
+запрашивает только нужный отрезок. Страницы месяца
+качаются параллельно в общем лимите кабинета (core.services.ratelimit).
+"""
+from __future__ import annotations
+import contextvars, logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from core.services import http, ratelimit
+from core.tasks import context
+from core.tasks.cancel import CancelToken, NEVER
+from core.tasks.failures import classify, PERMANENT
+
+log = logging.getLogger(__name__)
+
+URL_FIN = "https://api-seller.ozon.ru/v3/finance/transaction/list"
+PAGE_SIZE = 1000
+PAGE_WORKERS = 4        # страниц месяца одновременно
+REQUEST_TIMEOUT = 60
+
+
+def _month_bounds(m_start: datetime) -> tuple[datetime, datetime]:
+    nxt = m_start.replace(year=m_start.year + m_start.month // 12,
+                          month=m_start.month % 12 + 1)
+    return m_start, nxt - timedelta(seconds=1)
+
+
+def _page(headers: dict, frm: datetime, to: datetime, page: int,
+          cancel: CancelToken) -> dict:
+    payload = {"filter": {"date": {"from": frm.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                                   "to": to.strftime("%Y-%m-%dT%H:%M:%S.000Z")}},
+               "page": page, "page_size": PAGE_SIZE}
+    # пара коротких попыток; дальше повторяет планировщик (core.tasks.failures)
+    for attempt in range(3):
+        cancel.check()
+        ratelimit.ozon(headers, URL_FIN, cancel)
+        try:
+            r = http.post(URL_FIN, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+            if r.status_code == 429 and attempt < 2:
+                delay = 15 * (attempt + 1)
+                log.warning("Ozon finance 429, повтор через %s с", delay)
+                ratelimit.backoff(headers, URL_FIN, delay)
+                continue
+            r.raise_for_status()
+            return r.json().get("result", {})
+        except requests.exceptions.RequestException as e:
+            if attempt == 2 or classify(e) == PERMANENT:
+                raise
+            delay = 10 * (attempt + 1)
+            log.warning("Ozon finance: %s, повтор через %s с", e, delay)
+            cancel.sleep(delay)
+
+
+def _fetch_range(headers: dict, frm: datetime, to: datetime,
+                 cancel: CancelToken) -> list[dict]:
+    """Операции за [frm, to] (не длиннее месяца). Первая страница —
+    последовательно (page_count), остальные — параллельно, до PAGE_WORKERS
+    за раз, в общем лимите кабинета."""
+    first = _page(headers, frm, to, 1, cancel)
+    chunks = [first.get("operations", [])]
+    pages = first.get("page_count")
+    if pages is None:               # без page_count — до неполной страницы
+        page = 1
+        while len(chunks[-1]) >= PAGE_SIZE:
+            page += 1
+            chunks.append(_page(headers, frm, to, page, cancel).get("operations", []))
+    elif pages > 1:
+        with ThreadPoolExecutor(min(PAGE_WORKERS, pages - 1),
+                                thread_name_prefix="ozon-fin") as pool:
+            futs = [pool.submit(contextvars.copy_context().run,
+                                _page, headers, frm, to, p, cancel)
+                    for p in range(2, pages + 1)]
+            try:
+                chunks.extend(f.result().get("operations", []) for f in futs)
+            except BaseException:
+                for f in futs:
+                    f.cancel()
+                raise
+    # текущий месяц растёт во время загрузки — на стыках страниц возможны повторы
+    ops: dict = {}
+    for chunk in chunks:
+        for op in chunk:
+            ops.setdefault(op.get("operation_id") or id(op), op)
+    return list(ops.values())
+
+
+def _key(headers: dict, m_start: datetime) -> str:
+    return f"fin_ops:{headers.get('Client-Id', '')}:{m_start:%Y-%m}"
+
+
+def month_ops(headers: dict, m_start: datetime, cancel: CancelToken = NEVER) -> list[dict]:
+    """Все операции месяца, начинающегося в m_start (UTC, 1-е число 00:00)."""
+    return context.current().cached(
+        _key(headers, m_start), lambda: _fetch_range(headers, *_month_bounds(m_start), cancel))
+
+
+def ops_since(headers: dict, since: datetime, cancel: CancelToken = NEVER) -> list[dict]:
+    """Операции с момента since (UTC) по сейчас. В цепочке — целыми
+    месяцами через month_ops (общий кэш с fin_week_1), вне её — только
+    нужный отрезок."""
+    now = datetime.now(timezone.utc)
+    ctx = context.current()
+    m = since.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    border = since.strftime("%Y-%m-%d %H:%M:%S")
+    ops: list[dict] = []
+    while m <= now:
+        m_end = _month_bounds(m)[1]
+        if ctx.active:
+            month = month_ops(headers, m, cancel)
+        else:
+            month = _fetch_range(headers, max(since, m), min(m_end, now), cancel)
+        ops.extend(op for op in month if op.get("operation_date", "") >= border)
+        m = m_end + timedelta(seconds=1)
+    return ops
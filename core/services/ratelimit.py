@@ -0,0 +1,104 @@
+"""
+Общий лимит запросов к Ozon Seller API.
+
+Лимиты Ozon — на кабинет (Client-Id), а не на процесс: одновременно
+в кабинет ходят воркеры, дочерние процессы пула и параллельные страницы
+одного отчёта. Поэтому состояние лежит в STATE_DB (GCRA: на ключ одно
+«теоретическое время прихода» tat), а не в памяти.
+
+    ratelimit.ozon(HEADERS, URL, cancel)   # перед каждым запросом
+    ...
+    if r.status_code == 429:
+        ratelimit.backoff(HEADERS, URL, 15) # притормозить всех, кто идёт в кабинет
+
+Ключи — кабинет целиком (LIMITS[""]) и отдельные методы со своим
+лимитом (LIMITS[path]); запрос ждёт оба.
+"""
+from __future__ import annotations
+import sqlite3, threading, time
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from config import settings
+from core.tasks.cancel import CancelToken, NEVER
+from core.tasks.metrics import registry
+
+
+@dataclass(frozen=True)
+class Limit:
+    per_sec: float          # устойчивый темп
+    burst: int = 1          # сколько можно сразу после простоя
+
+
+LIMITS: dict[str, Limit] = {
+    "":                             Limit(per_sec=20, burst=20),   # кабинет, все методы
+    "/v1/analytics/data":           Limit(per_sec=1 / 60),         # не чаще раза в минуту
+    "/v3/finance/transaction/list": Limit(per_sec=5, burst=5),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tat REAL NOT NULL
+);
+"""
+
+WAITED = registry.counter("report_ratelimit_wait_seconds_total",
+                          "Секунд ожидания общего лимита Ozon (limit=метод|account)")
+
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.executescript(_SCHEMA)
+    return db
+
+
+def _reserve(key: str, limit: Limit) -> float:
+    """Занять место в очереди ключа; сколько секунд ждать до своего запроса."""
+    interval = 1 / limit.per_sec
+    db = _db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        now = time.time()
+        row = db.execute("SELECT tat FROM rate_limits WHERE key=?", (key,)).fetchone()
+        tat = max(row[0] if row else now, now)
+        db.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?)", (key, tat + interval))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return max(0.0, tat - (limit.burst - 1) * interval - now)
+
+
+def acquire(key: str, limit: Limit, cancel: CancelToken = NEVER, label: str = ""):
+    wait = _reserve(key, limit)
+    if wait > 0:
+        WAITED.inc(wait, limit=label or key)
+        cancel.sleep(wait)
+
+
+def _keys(headers: dict, url: str):
+    cid, path = headers.get("Client-Id", ""), urlsplit(url).path
+    yield f"ozon:{cid}", LIMITS[""], "account"
+    if path in LIMITS:
+        yield f"ozon:{cid}:{path}", LIMITS[path], path
+
+
+def ozon(headers: dict, url: str, cancel: CancelToken = NEVER):
+    """Дождаться очереди кабинета (и метода) для запроса url."""
+    for key, limit, label in _keys(headers, url):
+        acquire(key, limit, cancel, label)
+
+
+def backoff(headers: dict, url: str, sec: float):
+    """Ozon ответил 429: ближайшие sec секунд метод не трогает никто."""
+    until = time.time() + sec
+    *_, (key, _, _) = _keys(headers, url)
+    _db().execute("INSERT INTO rate_limits VALUES (?, ?) ON CONFLICT(key)"
+                  " DO UPDATE SET tat=MAX(tat, excluded.tat)", (key, until))
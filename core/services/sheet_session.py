@@ -0,0 +1,125 @@
+"""
+Сессия отчёта с одной Google-таблицей: минимум запросов на чтение.
+
+gspread на каждый sh.worksheets() / sh.worksheet() заново тянет
+метаданные, а каждый get_all_values() — отдельный запрос. Сессия берёт
+метаданные один раз (вместе со списком листов), недостающие листы
+создаёт одним batchUpdate, а листы читает одним values:batchGet.
+
+    ss = SheetSession(gc, spread_id)            # 1 запрос: метаданные
+    ss.ensure({"unit-day": (1000, 30), "input": (100, 4)})
+    ss.prefetch("unit-day")                     # прочитается вместе с первым values()
+    ref = sku_ref.load(gc, spread_id, "input", read=lambda: ss.values("input"))
+    rows = ss.values("unit-day")                # как ws.get_all_values()
+    ws = ss.worksheet("unit-day")               # gspread.Worksheet для записи
+"""
+from __future__ import annotations
+import logging
+from typing import Dict, Iterable, List
+
+log = logging.getLogger(__name__)
+
+
+def a1(title: str) -> str:
+    """Диапазон «весь лист» в A1-нотации."""
+    return "'" + title.replace("'", "''") + "'"
+
+
+def _fill(values: list[list]) -> list[list]:
+    # batchGet обрезает пустые ячейки в конце строк — выравниваем,
+    # как get_all_values()
+    width = max((len(r) for r in values), default=0)
+    return [list(r) + [""] * (width - len(r)) for r in values]
+
+
+_opener = None
+
+
+def _open(gc, spread_id: str):
+    """Spreadsheet, как из gc.open_by_key(), и метаданные, которые его
+    конструктор уже запросил: свойства таблицы и листов — без второго
+    запроса за списком листов."""
+    global _opener
+    if _opener is None:
+        import gspread
+
+        class Opened(gspread.Spreadsheet):
+            meta: dict = {}
+
+            def fetch_sheet_metadata(self, params=None, *args, **kwargs):
+                if params is None:
+                    params = {"fields": "properties,sheets.properties"}
+                self.meta = super().fetch_sheet_metadata(params, *args, **kwargs)
+                return self.meta
+
+        _opener = Opened
+    sh = _opener(getattr(gc, "http_client", gc), {"id": spread_id})   # gspread 6 / 5
+    return sh, sh.meta
+
+
+class SheetSession:
+    def __init__(self, gc, spread_id: str):
+        sh, meta = _open(gc, spread_id)
+        self.spreadsheet = sh
+        self.sheets: Dict[str, dict] = {s["properties"]["title"]: s["properties"]
+                                        for s in meta.get("sheets", [])}
+        self.created: set[str] = set()        # листы, созданные этой сессией
+        self._values: Dict[str, List[list]] = {}
+        self._pending: list[str] = []
+
+    @property
+    def id(self) -> str:
+        return self.spreadsheet.id
+
+    def __contains__(self, title: str) -> bool:
+        return title in self.sheets
+
+    def ensure(self, sheets: Dict[str, tuple[int, int]]):
+        """Создать отсутствующие листы {title: (rows, cols)} одним batchUpdate."""
+        missing = [t for t in sheets if t not in self.sheets]
+        if not missing:
+            return
+        res = self.spreadsheet.batch_update({"requests": [
+            {"addSheet": {"properties": {
+                "title": t,
+                "gridProperties": {"rowCount": sheets[t][0], "columnCount": sheets[t][1]},
+            }}} for t in missing]})
+        for t, reply in zip(missing, res.get("replies", [])):
+            self.sheets[t] = reply["addSheet"]["properties"]
+            self._values[t] = []            # новый лист пуст — читать нечего
+            self.created.add(t)
+        log.info("таблица %s: созданы листы %s", self.id, ", ".join(missing))
+
+    def prefetch(self, *titles: str):
+        """Дочитать листы вместе с ближайшим чтением."""
+        self._pending.extend(t for t in titles if t not in self._pending)
+
+    def read(self, titles: Iterable[str]) -> Dict[str, List[list]]:
+        """Значения листов (как get_all_values()) одним values:batchGet."""
+        titles = list(titles)
+        need = [t for t in dict.fromkeys(titles + self._pending)
+                if t not in self._values and t in self.sheets]
+        if need:
+            res = self.spreadsheet.values_batch_get([a1(t) for t in need])
+            for t, vr in zip(need, res.get("valueRanges", [])):
+                self._values[t] = _fill(vr.get("values", []))
+        self._pending = [t for t in self._pending if t not in self._values]
+        return {t: self._values.get(t, []) for t in titles}
+
+    def values(self, title: str) -> List[list]:
+        return self.read([title])[title]
+
+    def forget(self, title: str):
+        """Лист перезаписан: следующее чтение пойдёт в API."""
+        self._values.pop(title, None)
+
+    def worksheet(self, title: str):
+        """gspread.Worksheet по уже известным свойствам — без запроса."""
+        import gspread
+
+        props = self.sheets[title]
+        sh = self.spreadsheet
+        try:
+            return gspread.Worksheet(sh, props, sh.id, sh.client)     # gspread 6
+        except TypeError:
+            return gspread.Worksheet(sh, props)                       # gspread 5
@@ -0,0 +1,400 @@
+"""
+Запись листа отчёта разницей: в Sheets уходят только изменившиеся ячейки.
+
+Отчёты раз в полчаса перезаписывали лист целиком (clear + update),
+хотя меняется в нём пара десятков строк, — это трафик и пересчёт всей
+таблицы на стороне Google. GridWriter сравнивает новую сетку с тем, что
+уже лежит на листе, и отправляет:
+  • вставку / удаление строк (insertDimension / deleteDimension) —
+    строки сопоставляются difflib, формулы сравниваются в относительном
+    виде (=E5-F5 в строке 5 и =E7-F7 в строке 7 — одна и та же строка);
+  • значения только изменившихся прямоугольников (values:batchUpdate);
+  • ничего, если лист не изменился.
+
+Прошлая сетка — своя последняя запись в STATE_DB, если ревизия таблицы
+с тех пор не менялась (Drive, как у sku_ref), иначе одно чтение листа
+(формулы как формулы). Чужие правки листа так не теряются: любая запись
+мимо own_write()/GridWriter меняет ревизию, и лист перечитывается.
+
+    ss = SheetSession(gc, spread_id)
+    w = GridWriter(gc, ss, "unit-day")
+    old = w.old()                       # list[list[str]], как на листе
+    res = w.write(table)                # Plan: cells, inserted, deleted, changed
+    w.write([[v] for v in col_f], at=(1, 5), resize=False)   # только F2:F…
+"""
+from __future__ import annotations
+import difflib, logging, pickle, re, sqlite3, threading, time, zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Sequence
+
+from config import settings
+from core.services import sku_ref
+from core.services.sheet_session import SheetSession, a1
+from core.tasks.metrics import registry
+
+log = logging.getLogger(__name__)
+
+MAX_AGE = 24 * 3600     # сек: как у sku_ref — страховка от правок в окне своей записи
+DIFF_LIMIT = 1_000_000  # строк old × new середины, дальше SequenceMatcher не зовём
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_grids (
+    spread_id TEXT NOT NULL,
+    sheet     TEXT NOT NULL,
+    revision  TEXT NOT NULL,
+    saved     REAL NOT NULL,
+    grid      BLOB NOT NULL,
+    PRIMARY KEY (spread_id, sheet)
+);
+"""
+
+WRITES = registry.counter("report_sheet_write_total",
+                          "Записи листов разницей (result=skip|diff)")
+CELLS = registry.counter("report_sheet_cells_total",
+                         "Ячейки, отправленные в Sheets записью разницей")
+GRIDS = registry.counter("report_sheet_grid_total",
+                         "Прошлая сетка листа (result=hit|read|new)")
+
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.executescript(_SCHEMA)
+    return db
+
+
+# ───────── нормализация ─────────
+def cell(x) -> str:
+    """Значение ячейки так, как его вернёт чтение с формулами."""
+    if x is None:
+        return ""
+    if isinstance(x, bool):
+        return "TRUE" if x else "FALSE"
+    if isinstance(x, str):
+        return x
+    try:
+        f = float(x)
+    except (TypeError, ValueError):
+        return str(x)
+    return str(int(f)) if f.is_integer() else repr(f)
+
+
+# A1-ссылка без листа перед ней; LOG10( и т. п. — функции, не ссылки
+_REF = re.compile(r"(?<![A-Za-z0-9_.$'!])(\$?[A-Z]{1,3})(\$?)(\d+)(?![\d(A-Za-z_])")
+
+
+def _rel(v: str, row: int) -> tuple[str, bool]:
+    """Формула в строке row → (вид со смещениями строк, ссылается ли на другие строки)."""
+    if not v.startswith("="):
+        return v, False
+    cross = False
+
+    def sub(m):
+        nonlocal cross
+        d = int(m[3]) - row
+        cross |= d != 0
+        return f"{m[1]}{m[2]}R[{d}]"
+
+    # API отдаёт формулы с «,», отчёты пишут в локали таблицы с «;»
+    return _REF.sub(sub, v.replace(";", ",")), cross
+
+
+def _pad(rows: Sequence[Sequence], width: int) -> List[list]:
+    return [list(r) + [""] * (width - len(r)) for r in rows]
+
+
+def _opcodes(a: list, b: list) -> list[tuple]:
+    """get_opcodes() SequenceMatcher по строкам. Общие начало и конец
+    отрезаются заранее; середину больше DIFF_LIMIT (на повторах строк
+    сравнение почти кубическое) сверяем по месту: правка строк, остаток —
+    вставка или удаление в конце."""
+    n, m = len(a), len(b)
+    p = 0
+    while p < min(n, m) and a[p] == b[p]:
+        p += 1
+    q = 0
+    while q < min(n, m) - p and a[n - 1 - q] == b[m - 1 - q]:
+        q += 1
+    ops = [("equal", 0, p, 0, p)] if p else []
+    da, db = n - p - q, m - p - q
+    if da * db > DIFF_LIMIT:
+        k = min(da, db)
+        ops += [("replace", p, p + k, p, p + k)] if k else []
+        if da > k:
+            ops.append(("delete", p + k, n - q, m - q, m - q))
+        if db > k:
+            ops.append(("insert", n - q, n - q, p + k, m - q))
+    else:
+        ops += [(tag, i1 + p, i2 + p, j1 + p, j2 + p) for tag, i1, i2, j1, j2 in
+                difflib.SequenceMatcher(None, a[p:n - q], b[p:m - q],
+                                        autojunk=False).get_opcodes()]
+    return ops + ([("equal", n - q, n, m - q, m)] if q else [])
+
+class Plan(NamedTuple):
+    requests: list          # batchUpdate: строки листа, очистка хвоста
+    data: list              # values:batchUpdate: изменившиеся прямоугольники
+    cells: int              # сколько ячеек уйдёт
+    inserted: int           # вставлено строк
+    deleted: int            # удалено строк
+    grid: list              # сетка листа после записи
+    size: dict              # gridProperties листа после записи
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.requests or self.data)
+
+
+def col_letter(n: int) -> str:  # 1-based
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+# ───────── своя запись ─────────
+def _adopt(spread_id: str, before: str, after: str):
+    _db().execute("UPDATE sheet_grids SET revision=? WHERE spread_id=? AND revision=?",
+                  (after, spread_id, before))
+
+
+def adopt(spread_id: str, before: str | None, after: str | None):
+    """Ревизия before → after — только наша запись: кэши таблицы остаются верными."""
+    sku_ref.adopt(spread_id, before, after)
+    if before and after and before != after:
+        try:
+            _adopt(spread_id, before, after)
+        except sqlite3.Error as e:
+            log.warning("sheet_writer %s: %s", spread_id, e)
+
+
+@contextmanager
+def own_write(gc, spread_id: str) -> Iterator[None]:
+    """Запись отчёта мимо GridWriter: не сбрасывает кэши справочника и сеток."""
+    before = sku_ref.revision(gc, spread_id)
+    yield
+    adopt(spread_id, before, sku_ref.revision(gc, spread_id))
+
+
+# ───────── писатель ─────────
+class GridWriter:
+    def __init__(self, gc, ss: SheetSession, title: str, revision: str | None = None):
+        self.gc, self.ss, self.title = gc, ss, title
+        self._rev = revision or None        # ревизия, к которой относится _grid
+        self._grid: List[list] | None = None
+
+    # прошлая сетка
+    def _cached(self) -> List[list] | None:
+        row = _db().execute(
+            "SELECT revision, saved, grid FROM sheet_grids WHERE spread_id=? AND sheet=?",
+            (self.ss.id, self.title)).fetchone()
+        if (row is None or row[0] != self._rev
+                or time.time() - row[1] >= MAX_AGE):
+            return None
+        return pickle.loads(zlib.decompress(row[2]))
+
+    def _store(self, grid: List[list] | None):
+        if grid is None or not self._rev:
+            _db().execute("DELETE FROM sheet_grids WHERE spread_id=? AND sheet=?",
+                          (self.ss.id, self.title))
+            return
+        blob = zlib.compress(pickle.dumps(grid, pickle.HIGHEST_PROTOCOL))
+        _db().execute("INSERT OR REPLACE INTO sheet_grids VALUES (?, ?, ?, ?, ?)",
+                      (self.ss.id, self.title, self._rev, time.time(), blob))
+
+    def _read(self) -> List[list]:
+        res = self.ss.spreadsheet.values_get(a1(self.title), params={
+            "valueRenderOption": "FORMULA",
+            "dateTimeRenderOption": "FORMATTED_STRING"})
+        rows = [[cell(v) for v in r] for r in res.get("values", [])]
+        width = max((len(r) for r in rows), default=0)
+        return _pad(rows, width)
+
+    def old(self) -> List[list]:
+        """Что сейчас на листе (строки, выровненные по ширине)."""
+        if self._grid is None:
+            if self.title in self.ss.created:
+                self._grid = []
+                GRIDS.inc(result="new")
+                return self._grid
+            if self._rev is None:
+                self._rev = sku_ref.revision(self.gc, self.ss.id)
+            grid = self._cached() if self._rev else None
+            if grid is not None:
+                GRIDS.inc(result="hit")
+            else:
+                grid = self._read()
+                GRIDS.inc(result="read")
+            self._grid = grid
+        return self._grid
+
+    # разница
+    def _plan(self, old: List[list], new: List[list], row0: int, col0: int, resize: bool):
+        """→ (структурные запросы, [(строка, кол_от, кол_до)] в координатах new,
+        вставлено, удалено, new выровненная по ширине)."""
+        sheet_id = self.ss.sheets[self.title]["sheetId"]
+        width = max([len(r) for r in old] + [len(r) for r in new] + [0])
+        old, new = _pad(old, width), _pad(new, width)
+        nrel = [[_rel(cell(v), row0 + j + 1) for v in r] for j, r in enumerate(new)]
+        orel = [[_rel(v, row0 + i + 1)[0] for v in r] for i, r in enumerate(old)]
+
+        if resize:
+            ops = _opcodes([tuple(r) for r in orel], [tuple(c for c, _ in r) for r in nrel])
+        else:   # только ячейки: строки на своих местах
+            n = min(len(old), len(new))
+            ops = [("replace", 0, n, 0, n)] + ([("insert", n, n, n, len(new))]
+                                              if len(new) > n else [])
+
+        dim = lambda a, b: {"sheetId": sheet_id, "dimension": "ROWS",
+                            "startIndex": row0 + a, "endIndex": row0 + b}
+        struct, pairs, fresh = [], [], []
+        inserted = deleted = 0
+        for tag, i1, i2, j1, j2 in reversed(ops):       # снизу вверх: индексы old в силе
+            if tag == "equal":
+                continue
+            k = min(i2 - i1, j2 - j1)
+            pairs += [(i1 + t, j1 + t) for t in range(k)]
+            if j2 - j1 > k:
+                fresh += range(j1 + k, j2)
+                if i1 + k < len(old):       # в конце листа строки есть и так
+                    struct.append({"insertDimension": {
+                        "range": dim(i1 + k, i1 + j2 - j1),
+                        "inheritFromBefore": row0 + i1 + k > 0}})
+                    inserted += j2 - j1 - k
+            elif i2 - i1 > k and resize and i2 < len(old):
+                struct.append({"deleteDimension": {"range": dim(i1 + k, i2)}})
+                deleted += i2 - i1 - k
+
+        # хвост старого листа ниже новой сетки — очистить значения
+        tail = len(old) - deleted + inserted - len(new) if resize else 0
+        if tail > 0:
+            struct.append({"updateCells": {
+                "range": {"sheetId": sheet_id,
+                          "startRowIndex": row0 + len(new), "endRowIndex": row0 + len(new) + tail,
+                          "startColumnIndex": col0, "endColumnIndex": col0 + width},
+                "fields": "userEnteredValue"}})
+
+        # ссылки на другие строки Sheets сдвигает сам, но не всегда так же,
+        # как построен отчёт (вставка на границе диапазона) — такие формулы
+        # после вставок/удалений пишем заново
+        moved = bool(inserted or deleted)
+        spans, fresh = [], set(fresh)
+        matched = {j: i for i, j in pairs}
+        if moved:
+            matched.update((j, None) for j, r in enumerate(nrel)
+                           if j not in matched and j not in fresh and any(c for _, c in r))
+        for j in sorted(matched):
+            i = matched[j]
+            cols = [c for c, (v, cross) in enumerate(nrel[j])
+                    if (moved and cross) or (i is not None and orel[i][c] != v)]
+            if cols:
+                spans.append((j, cols[0], cols[-1] + 1))
+        for j in sorted(fresh):
+            cols = [c for c, v in enumerate(new[j]) if cell(v) != ""]
+            if cols:
+                spans.append((j, cols[0], cols[-1] + 1))
+        return struct, sorted(spans), inserted, deleted, new
+
+    def _grow(self, rows: int, cols: int) -> tuple[list[dict], dict]:
+        """appendDimension, если сетке листа не хватает строк / колонок;
+        → (запросы, gridProperties после них)."""
+        props = self.ss.sheets[self.title]
+        have = dict(props.get("gridProperties", {}))
+        req = []
+        for dim, need, key in (("ROWS", rows, "rowCount"), ("COLUMNS", cols, "columnCount")):
+            if need > have.get(key, 0):
+                req.append({"appendDimension": {"sheetId": props["sheetId"], "dimension": dim,
+                                                "length": need - have.get(key, 0)}})
+                have[key] = need
+        return req, have
+
+    def diff(self, grid: Sequence[Sequence], *, at: tuple[int, int] = (0, 0),
+             resize: bool = True) -> Plan:
+        """Что нужно отправить, чтобы лист (или прямоугольник от at=(строка,
+        колонка), с 0) стал grid. resize=False — только ячейки: строки листа
+        не вставляются и не удаляются."""
+        row0, col0 = at
+        full = self.old()
+        width = max((len(r) for r in grid), default=0)
+        old = ([r[col0:col0 + width] for r in full[row0:row0 + len(grid)]] if not resize
+               else full[row0:])
+        struct, spans, ins, dels, new = self._plan(old, list(grid), row0, col0, resize)
+        width = len(new[0]) if new else width
+
+        # прямоугольники: подряд идущие строки с одинаковым диапазоном колонок
+        rects, cells = [], 0
+        for j, c1, c2 in spans:
+            if rects and rects[-1][0] + rects[-1][3] == j and rects[-1][1:3] == [c1, c2]:
+                rects[-1][3] += 1
+            else:
+                rects.append([j, c1, c2, 1])
+        data = []
+        for j, c1, c2, n in rects:
+            rng = (f"{a1(self.title)}!{col_letter(col0 + c1 + 1)}{row0 + j + 1}:"
+                   f"{col_letter(col0 + c2)}{row0 + j + n}")
+            data.append({"range": rng, "values": [new[j + t][c1:c2] for t in range(n)]})
+            cells += (c2 - c1) * n
+
+        # своя сетка после записи — то, что будет на листе
+        norm = [[cell(v) for v in r] for r in new]
+        if resize:
+            after = full[:row0] + norm
+        else:
+            after = [list(r) for r in full]
+            for j, r in enumerate(norm):
+                if row0 + j >= len(after):
+                    after.append([])
+                line = after[row0 + j]
+                line += [""] * (col0 + width - len(line))
+                line[col0:col0 + width] = r
+        after = _pad(after, max((len(r) for r in after), default=0))
+
+        # строки считаем до вставок/удалений: appendDimension уходит первым
+        grow, size = self._grow(row0 + len(new) - ins + dels, col0 + width)
+        if struct:
+            struct = grow + struct
+        elif data:
+            struct = grow
+        size["rowCount"] = size.get("rowCount", 0) + ins - dels
+        return Plan(struct, data, cells, ins, dels, after, size)
+
+    def apply(self, plan: Plan, requests: Sequence[dict] = ()) -> Plan:
+        """Отправить план; requests — доп. запросы batchUpdate (формат),
+        уходят тем же вызовом после структурных."""
+        if not (plan.changed or requests):
+            WRITES.inc(result="skip")
+            return plan
+        before = self._rev
+        try:
+            if plan.requests or requests:
+                self.ss.spreadsheet.batch_update({"requests": plan.requests + list(requests)})
+            if plan.data:
+                self.ss.spreadsheet.values_batch_update(
+                    {"valueInputOption": "USER_ENTERED", "data": plan.data})
+        except Exception:
+            # лист мог измениться наполовину — в следующий раз читаем его заново
+            self._grid, self._rev = None, None
+            self._store(None)
+            raise
+        self.ss.sheets[self.title]["gridProperties"] = plan.size
+        self._grid = plan.grid
+        WRITES.inc(result="diff")
+        CELLS.inc(plan.cells)
+
+        after = sku_ref.revision(self.gc, self.ss.id)
+        adopt(self.ss.id, before, after)
+        self._rev = after
+        self._store(self._grid if before else None)
+        log.info("лист %s/%s: %d ячеек, +%d/−%d строк", self.ss.id, self.title,
+                 plan.cells, plan.inserted, plan.deleted)
+        return plan
+
+    def write(self, grid: Sequence[Sequence], *, at: tuple[int, int] = (0, 0),
+              resize: bool = True, requests: Sequence[dict] = ()) -> Plan:
+        """diff() + apply(); ничего не отправляет, если лист уже такой."""
+        return self.apply(self.diff(grid, at=at, resize=resize), requests)
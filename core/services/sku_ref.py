@@ -0,0 +1,225 @@
+"""
+Справочник SKU (лист input: SKU, название, себестоимость, % налога).
+
+Один на таблицу и общий для всех отчётов: load() делает один дешёвый
+запрос метаданных Drive (version + modifiedTime) и перечитывает лист,
+только если таблица изменилась. Разобранный справочник лежит в памяти
+процесса и в STATE_DB (источник истины по ревизии) — видно воркерам,
+дочерним процессам и после перезапуска.
+
+    ref = sku_ref.load(gc, spread_id)
+    row = ref.get(sku)          # SkuRow | None, sku — int или "123"
+
+modifiedTime — на всю таблицу, а отчёты пишут в ту же таблицу свои
+листы. Свою запись оборачиваем в own_write(): если до записи ревизия
+совпадала с кэшем, новая ревизия принимается без перечитывания input.
+Правка input, попавшая ровно в окно записи, так не заметится — поэтому
+раз в MAX_AGE справочник перечитывается в любом случае. Отчёты пишут
+через core.services.sheet_writer — его own_write()/GridWriter заодно
+сохраняют и кэши сеток листов.
+"""
+from __future__ import annotations
+import hashlib, logging, pickle, sqlite3, threading, time, zlib
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, NamedTuple
+
+from config import settings
+from core.services import http
+from core.tasks.metrics import registry
+
+log = logging.getLogger(__name__)
+
+URL_FILE = "https://www.googleapis.com/drive/v3/files/{}"
+MAX_AGE = 24 * 3600     # сек: страховка от правок, принятых за свою запись
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sku_refs (
+    spread_id TEXT NOT NULL,
+    sheet     TEXT NOT NULL,
+    revision  TEXT NOT NULL,
+    loaded    REAL NOT NULL,
+    data      BLOB NOT NULL,
+    PRIMARY KEY (spread_id, sheet)
+);
+"""
+
+SKU_REF = registry.counter("report_sku_ref_total",
+                           "Обращения к справочнику SKU (result=hit|load)")
+
+
+class SkuRow(NamedTuple):
+    name: str
+    cost: float
+    tax: float | None       # % налога; None — колонки в строке нет
+
+
+@dataclass(frozen=True)
+class SkuRef:
+    revision: str
+    loaded: float
+    digest: str             # отпечаток содержимого (для probe)
+    rows: Dict[int, SkuRow] = field(default_factory=dict)
+
+    def get(self, sku: int | str) -> SkuRow | None:
+        try:
+            return self.rows.get(int(sku))
+        except (TypeError, ValueError):
+            return None
+
+    def items(self):
+        return self.rows.items()
+
+    def __contains__(self, sku) -> bool:
+        return self.get(sku) is not None
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+_local = threading.local()
+_mem: dict[tuple[str, str], SkuRef] = {}
+_guard = threading.Lock()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.executescript(_SCHEMA)
+    return db
+
+
+def _num(x) -> float:
+    try:
+        return float(str(x).replace(",", ".").replace("%", "").strip())
+    except ValueError:
+        return 0.0
+
+
+def parse(values: list[list]) -> Dict[int, SkuRow]:
+    """Строки листа (первая — заголовок) → {sku: SkuRow}.
+
+    Колонки ищутся по заголовку («SKU», «Себестоимость», «% Налога»),
+    иначе по позиции A–D; строки без числового SKU пропускаются.
+    """
+    if not values:
+        return {}
+    hdr = {str(h).strip(): i for i, h in enumerate(values[0])}
+    i_sku = hdr.get("SKU", 0)
+    i_cost = hdr.get("Себестоимость", 2)
+    i_tax = hdr.get("% Налога", 3)
+    # values_get обрезает пустые ячейки в конце строки — выравниваем,
+    # как get_all_values()
+    width = max(len(r) for r in values)
+    rows: Dict[int, SkuRow] = {}
+    for r in values[1:]:
+        r = list(r) + [""] * (width - len(r))
+        try:
+            sku = int(str(r[i_sku]).strip())
+        except (ValueError, IndexError):
+            continue
+        rows[sku] = SkuRow(
+            name=str(r[1]).strip() if len(r) > 1 else "",
+            cost=_num(r[i_cost]) if len(r) > i_cost else 0.0,
+            tax=_num(r[i_tax]) if len(r) > i_tax else None,
+        )
+    return rows
+
+
+def _digest(values: list[list]) -> str:
+    # без пустых хвостов строк: values_get и выровненное чтение дают один отпечаток
+    rows = [list(r) for r in values]
+    for r in rows:
+        while r and r[-1] == "":
+            r.pop()
+    return hashlib.sha1(repr(rows).encode()).hexdigest()
+
+
+def revision(gc, spread_id: str) -> str | None:
+    """Ревизия таблицы по Drive; None — метаданные недоступны."""
+    sess = http.authed_session(gc)
+    if sess is None:
+        return None
+    try:
+        r = sess.get(URL_FILE.format(spread_id),
+                     params={"fields": "version,modifiedTime", "supportsAllDrives": "true"},
+                     timeout=30)
+        r.raise_for_status()
+        meta = r.json()
+    except Exception as e:
+        log.warning("sku_ref %s: метаданные Drive недоступны: %s", spread_id, e)
+        return None
+    return f"{meta.get('version', '')}/{meta.get('modifiedTime', '')}"
+
+
+def _cached(spread_id: str, sheet: str) -> SkuRef | None:
+    row = _db().execute(
+        "SELECT revision, loaded, data FROM sku_refs WHERE spread_id=? AND sheet=?",
+        (spread_id, sheet)).fetchone()
+    if row is None:
+        return None
+    ref = _mem.get((spread_id, sheet))
+    if ref is None or ref.loaded != row[1]:
+        digest, rows = pickle.loads(zlib.decompress(row[2]))
+        ref = SkuRef(row[0], row[1], digest, rows)
+    elif ref.revision != row[0]:
+        ref = SkuRef(row[0], ref.loaded, ref.digest, ref.rows)
+    _mem[(spread_id, sheet)] = ref
+    return ref
+
+
+def _store(spread_id: str, sheet: str, ref: SkuRef):
+    _mem[(spread_id, sheet)] = ref
+    blob = zlib.compress(pickle.dumps((ref.digest, ref.rows), pickle.HIGHEST_PROTOCOL))
+    _db().execute("INSERT OR REPLACE INTO sku_refs VALUES (?, ?, ?, ?, ?)",
+                  (spread_id, sheet, ref.revision, ref.loaded, blob))
+
+
+def load(gc, spread_id: str, sheet: str = "input", read=None) -> SkuRef:
+    """Справочник из кэша, если таблица не менялась, иначе — чтение листа.
+
+    read() → значения листа, если отчёт уже читает таблицу сам
+    (например, SheetSession.values); по умолчанию — values_get.
+    """
+    rev = revision(gc, spread_id)
+    with _guard:
+        ref = _cached(spread_id, sheet)
+        if (ref is not None and rev is not None and ref.revision == rev
+                and time.time() - ref.loaded < MAX_AGE):
+            SKU_REF.inc(result="hit")
+            return ref
+    # ревизия взята до чтения: правка во время чтения перечитается в следующий раз
+    values = (read() if read is not None
+              else gc.open_by_key(spread_id).values_get(sheet).get("values", []))
+    ref = SkuRef(revision=rev or "", loaded=time.time(),
+                 digest=_digest(values),
+                 rows=parse(values))
+    SKU_REF.inc(result="load")
+    log.info("sku_ref %s/%s: прочитано %d SKU", spread_id, sheet, len(ref))
+    if rev is not None:
+        with _guard:
+            _store(spread_id, sheet, ref)
+    return ref
+
+
+def adopt(spread_id: str, before: str | None, after: str | None):
+    """Таблица изменилась только нашей записью before → after: кэш остаётся верным."""
+    if not (before and after and before != after):
+        return
+    try:
+        # память процесса догонит STATE_DB при следующем _cached()
+        _db().execute("UPDATE sku_refs SET revision=? WHERE spread_id=? AND revision=?",
+                      (after, spread_id, before))
+    except sqlite3.Error as e:
+        log.warning("sku_ref %s: %s", spread_id, e)
+
+
+@contextmanager
+def own_write(gc, spread_id: str) -> Iterator[None]:
+    """Запись отчёта в таблицу со справочником: не сбрасывает кэш input."""
+    before = revision(gc, spread_id)
+    yield
+    adopt(spread_id, before, revision(gc, spread_id))
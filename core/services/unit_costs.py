@@ -0,0 +1,270 @@
+"""
+Услуги Ozon и комиссия по SKU — основа unit-экономики.
+
+rates(ops)      — по сырым операциям: средние логистика / эквайринг /
+                  последняя миля и % комиссии (skus, таблица n×4).
+rolling(HEADERS) — то же за последние 30 дней из накопленных агрегатов:
+                  в STATE_DB лежат дневные суммы и счётчики по SKU и
+                  итог окна. Прогон докачивает только дни после прошлого
+                  (последние REFETCH_DAYS — заново: операции за них ещё
+                  дописываются), вычитает ушедшие из окна и читает итог
+                  за O(SKU), без скачивания и разбора месяца операций.
+
+Агрегаты — на кабинет (Client-Id): любой отчёт по unit-экономике этого
+кабинета берёт те же числа. Суммы — в копейках (целые), поэтому
+прибавление и вычитание дней не копит ошибку округления.
+"""
+from __future__ import annotations
+import sqlite3, threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+
+from config import settings
+from core.services import ozon_fin
+from core.tasks.cancel import CancelToken, NEVER
+
+SVC_KIND = {"MarketplaceServiceItemDirectFlowLogistic": 0,         # логистика
+            "MarketplaceRedistributionOfAcquiringOperation": 1,    # эквайринг
+            "MarketplaceServiceItemDelivToCustomer": 2}            # последняя миля
+
+WINDOW_DAYS = 30
+REFETCH_DAYS = 2
+
+# суммы и счётчики услуг, начисления и комиссия — копейки
+COLS = ("log_sum", "log_cnt", "acq_sum", "acq_cnt",
+        "last_sum", "last_cnt", "accr", "comm")
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS unit_cost_days (
+    account TEXT    NOT NULL,
+    day     TEXT    NOT NULL,
+    sku     INTEGER NOT NULL,
+    {", ".join(f"{c} INTEGER NOT NULL" for c in COLS)},
+    PRIMARY KEY (account, day, sku)
+);
+CREATE TABLE IF NOT EXISTS unit_cost_window (
+    account TEXT    NOT NULL,
+    sku     INTEGER NOT NULL,
+    {", ".join(f"{c} INTEGER NOT NULL" for c in COLS)},
+    PRIMARY KEY (account, sku)
+);
+CREATE TABLE IF NOT EXISTS unit_cost_state (
+    account TEXT PRIMARY KEY,
+    start   TEXT NOT NULL,      -- первый день окна
+    through TEXT NOT NULL       -- последний загруженный день
+);
+"""
+
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.executescript(_SCHEMA)
+    return db
+
+
+# ─────────────────── округление ───────────────────
+def _near_half(a: np.ndarray) -> np.ndarray:
+    """Где x*100 почти на «половинке» — там np.round может разойтись с round."""
+    scaled = a * 100
+    return np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6
+
+
+def round2(a) -> np.ndarray:
+    """round(x, 2) поэлементно, с тем же результатом, что встроенный round."""
+    a = np.asarray(a, dtype=float)
+    out = np.round(a, 2)
+    near = _near_half(a)
+    if near.any():
+        out[near] = [round(x, 2) for x in a[near].tolist()]
+    return out
+
+
+# ─────────────────── операции → массивы ───────────────────
+def _flatten(fin_ops: list[dict]):
+    """Операции с товарами → плоские массивы.
+
+    op_day, op_accr, op_comm — на операцию; it_op, it_sku — на товар;
+    pair_item, pair_kind, pair_price — на пару (товар, услуга его
+    операции) в порядке операция → товар → услуга. Знак не снят.
+    """
+    op_day, n_items, it_sku, op_accr, op_comm = [], [], [], [], []
+    sv_op, sv_kind, sv_price = [], [], []
+    kind_of = SVC_KIND.get
+    for op in fin_ops:
+        items = op.get("items")
+        if not items:
+            continue
+        j = len(op_accr)
+        op_day.append(op.get("operation_date", "")[:10])
+        op_accr.append(op.get("accruals_for_sale", 0))
+        op_comm.append(op.get("sale_commission", 0))
+        n_items.append(len(items))
+        it_sku += [it["sku"] for it in items]
+        for sv in op.get("services", ()):
+            k = kind_of(sv["name"])
+            if k is not None:
+                sv_op.append(j)
+                sv_kind.append(k)
+                sv_price.append(sv["price"])
+
+    it_op = np.repeat(np.arange(len(n_items)), n_items)
+    ns = np.bincount(np.asarray(sv_op, np.int64), minlength=len(op_accr))
+    first_sv = np.cumsum(ns) - ns
+    per_item = ns[it_op]
+    pair_item = np.repeat(np.arange(len(it_op)), per_item)
+    pair_sv = (first_sv[it_op][pair_item] + np.arange(per_item.sum(), dtype=np.int64)
+               - np.repeat(np.cumsum(per_item) - per_item, per_item))
+    return (op_day, np.asarray(op_accr, float), np.asarray(op_comm, float),
+            it_op, np.asarray(it_sku, np.int64),
+            pair_item, np.asarray(sv_kind, np.int64)[pair_sv],
+            np.asarray(sv_price, float)[pair_sv])
+
+
+def rates(fin_ops: list[dict]) -> tuple[np.ndarray, np.ndarray]:
+    """По SKU: средние логистика / эквайринг / последняя миля и % комиссии.
+
+    → (skus по возрастанию, таблица n×4: log, acq, last, pct). Услуги
+    операции относятся к каждому её товару. Порядок сложения — как у
+    прежних циклов unit_day_5, результат совпадает с ними бит в бит.
+    """
+    _, op_accr, op_comm, it_op, it_sku, pair_item, pair_kind, pair_price = _flatten(fin_ops)
+    if not len(it_sku):
+        return np.empty(0, np.int64), np.empty((0, 4))
+    skus, it_idx = np.unique(it_sku, return_inverse=True)
+    n = len(skus)
+    accr = np.bincount(it_idx, op_accr[it_op], n)
+    comm = np.bincount(it_idx, np.abs(op_comm)[it_op], n)
+
+    key = it_idx[pair_item] * 3 + pair_kind
+    price = np.abs(pair_price)
+    cnt = np.bincount(key, minlength=n * 3)
+    mean = np.bincount(key, price, n * 3) / np.maximum(cnt, 1)
+    # sum() списка float в новых Python — с компенсацией; на «половинках»
+    # пересчитываем так же, как прежний код
+    redo = np.flatnonzero(_near_half(mean) & (cnt > 0))
+    if len(redo):
+        by_key = price[np.argsort(key, kind="stable")]
+        start = np.cumsum(cnt) - cnt
+        for b in redo.tolist():
+            mean[b] = sum(by_key[start[b]:start[b] + cnt[b]].tolist()) / int(cnt[b])
+    avg = np.where(cnt > 0, round2(mean), 0.0).reshape(n, 3)
+
+    nz = accr != 0
+    pct = np.where(nz, round2(comm / np.where(nz, accr, 1) * 100), 0.0)
+    return skus, np.column_stack([avg, pct])
+
+
+def daily(fin_ops: list[dict]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Дневные агрегаты по SKU: (дни, skus, таблица m×8 по COLS, копейки)."""
+    op_day, op_accr, op_comm, it_op, it_sku, pair_item, pair_kind, pair_price = _flatten(fin_ops)
+    if not len(it_sku):
+        return [], np.empty(0, np.int64), np.empty((0, len(COLS)), np.int64)
+    days, day_idx = np.unique(np.asarray(op_day), return_inverse=True)
+    skus, sku_idx = np.unique(it_sku, return_inverse=True)
+    groups, it_grp = np.unique(day_idx.ravel()[it_op] * len(skus) + sku_idx.ravel(),
+                               return_inverse=True)
+    it_grp = it_grp.ravel()
+    m = len(groups)
+
+    def kop(x):
+        return np.rint(x * 100).astype(np.int64)
+
+    tab = np.zeros((m, len(COLS)), np.int64)
+    key = it_grp[pair_item] * 3 + pair_kind
+    price = kop(np.abs(pair_price))
+    for k in range(3):
+        sel = pair_kind == k
+        np.add.at(tab[:, 2 * k], it_grp[pair_item[sel]], price[sel])
+    tab[:, 1:6:2] = np.bincount(key, minlength=m * 3).reshape(m, 3)
+    np.add.at(tab[:, 6], it_grp, kop(op_accr)[it_op])
+    np.add.at(tab[:, 7], it_grp, kop(np.abs(op_comm))[it_op])
+    return (days[groups // len(skus)].tolist(), skus[groups % len(skus)], tab)
+
+
+# ─────────────────── скользящее окно ───────────────────
+def _apply(account: str, start: str, frm: str, today: str,
+           days: list[str], skus: np.ndarray, tab: np.ndarray):
+    """Дни ≥ frm заменить свежими, дни < start — убрать; итог окна — по разнице."""
+    cols = ", ".join(COLS)
+    qs = ", ".join("?" * len(COLS))
+    add = ", ".join(f"{c}={c}+excluded.{c}" for c in COLS)
+    db = _db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute("SELECT through FROM unit_cost_state WHERE account=?",
+                         (account,)).fetchone()
+        if row is None or row[0] < start or frm <= start:
+            db.execute("DELETE FROM unit_cost_days WHERE account=?", (account,))
+            db.execute("DELETE FROM unit_cost_window WHERE account=?", (account,))
+        else:
+            gone = db.execute(
+                f"SELECT sku, {', '.join(f'SUM({c})' for c in COLS)} FROM unit_cost_days"
+                " WHERE account=? AND (day >= ? OR day < ?) GROUP BY sku",
+                (account, frm, start)).fetchall()
+            db.executemany(
+                f"UPDATE unit_cost_window SET {', '.join(f'{c}={c}-?' for c in COLS)}"
+                " WHERE account=? AND sku=?",
+                [(*r[1:], account, r[0]) for r in gone])
+            db.execute("DELETE FROM unit_cost_days WHERE account=? AND (day >= ? OR day < ?)",
+                       (account, frm, start))
+
+        db.executemany(f"INSERT INTO unit_cost_days VALUES (?, ?, ?, {qs})",
+                       [(account, d, s, *t) for d, s, t in
+                        zip(days, skus.tolist(), tab.tolist())])
+        if len(skus):
+            u, inv = np.unique(skus, return_inverse=True)
+            per_sku = np.zeros((len(u), len(COLS)), np.int64)
+            np.add.at(per_sku, inv.ravel(), tab)
+            db.executemany(
+                f"INSERT INTO unit_cost_window VALUES (?, ?, {qs})"
+                f" ON CONFLICT(account, sku) DO UPDATE SET {add}",
+                [(account, s, *t) for s, t in zip(u.tolist(), per_sku.tolist())])
+        db.execute(f"DELETE FROM unit_cost_window WHERE account=? AND "
+                   f"{' AND '.join(f'{c}=0' for c in COLS)}", (account,))
+        db.execute("INSERT OR REPLACE INTO unit_cost_state VALUES (?, ?, ?)",
+                   (account, start, today))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+def window(account: str) -> tuple[np.ndarray, np.ndarray]:
+    """Итог окна кабинета в формате rates(): (skus, n×4)."""
+    rows = _db().execute(f"SELECT sku, {', '.join(COLS)} FROM unit_cost_window"
+                         " WHERE account=? ORDER BY sku", (account,)).fetchall()
+    if not rows:
+        return np.empty(0, np.int64), np.empty((0, 4))
+    a = np.asarray(rows, np.int64)
+    sums, cnt = a[:, 1:7:2], a[:, 2:7:2]
+    avg = np.where(cnt > 0, round2(sums / np.maximum(cnt, 1) / 100), 0.0)
+    accr, comm = a[:, 7], a[:, 8]
+    nz = accr != 0
+    pct = np.where(nz, round2(comm / np.where(nz, accr, 1) * 100), 0.0)
+    return a[:, 0], np.column_stack([avg, pct])
+
+
+def rolling(headers: dict, cancel: CancelToken = NEVER,
+            days: int = WINDOW_DAYS) -> tuple[np.ndarray, np.ndarray]:
+    """rates() за последние days дней (по UTC-датам операций, включая
+    сегодня) — с догрузкой только новых дней."""
+    account = headers.get("Client-Id", "")
+    today = datetime.now(timezone.utc).date()
+    start = (today - timedelta(days=days)).isoformat()
+    row = _db().execute("SELECT through FROM unit_cost_state WHERE account=?",
+                        (account,)).fetchone()
+    frm = start
+    if row is not None and start <= row[0] <= today.isoformat():
+        since = datetime.fromisoformat(row[0]).date() - timedelta(days=REFETCH_DAYS - 1)
+        frm = max(start, since.isoformat())
+    ops = ozon_fin.ops_since(
+        headers, datetime.fromisoformat(frm).replace(tzinfo=timezone.utc), cancel)
+    _apply(account, start, frm, today.isoformat(), *daily(ops))
+    return window(account)
@@ -1,6 +1,9 @@
+import time
 import aiohttp
 from typing import Any
 
+from core.tasks import usage
+
 WB_URL = "https://suppliers-api.wildberries.ru"
 
 class WBAPI:
@@ -13,8 +16,12 @@ class WBAPI:
 
     async def _request(self, method: str, path: str, **kwargs) -> Any:
         url = f"{WB_URL}{path}"
+        t0 = time.monotonic()
         async with aiohttp.ClientSession(headers=self._headers) as sess:
             async with sess.request(method, url, **kwargs) as resp:
+                body = await resp.read()
+                usage.record(url, resp.status, len(str(kwargs.get("json") or "")),
+                             len(body), time.monotonic() - t0)
                 resp.raise_for_status()
                 return await resp.json()
 
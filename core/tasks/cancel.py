@@ -0,0 +1,185 @@
+"""
+Кооперативная отмена отчётов.
+
+Планировщик выдаёт каждому выполняющемуся заданию CancelToken и передаёт
+его в run(cancel=...). Скрипт проверяет токен на границах страниц, чанков
+и опросов, а вместо time.sleep спит через token.sleep() — поэтому кнопка ⏹
+останавливает даже часовой p_campain_fin_1 за секунды.
+
+Cancelled наследует BaseException, чтобы его не глотали
+`except Exception: continue` в циклах повторов внутри скриптов.
+
+У токена может быть срок (deadline, time.time()): после него check()
+и sleep() отменяют задание сами. Текущий токен задания лежит и в
+contextvar (bind/current) — по нему HTTP-слой (core.services.http)
+укорачивает таймауты запросов до оставшегося бюджета.
+
+Токен же — пульс задания: check() и каждый HTTP-ответ отмечают прогресс
+(beat), по нему сторож планировщика находит зависшие задания.
+
+Задание в дочернем процессе (REPORT_MODE="process"): share() заводит
+токену строку в STATE_DB, ребёнок строит токен с тем же ключом. ⏹ и
+сторож пишут в строку причину отмены, ребёнок — свой пульс; обе стороны
+сверяются со строкой не чаще раза в POLL секунд.
+"""
+from __future__ import annotations
+import sqlite3, threading, time, uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Iterator
+
+from config import settings
+
+DEADLINE = "превышен лимит времени"
+STALLED = "нет прогресса"
+
+POLL = 2.0              # сек: как часто токен с общей строкой смотрит в STATE_DB
+KEEP = 86400            # сек: строки брошенных заданий живут сутки
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cancels (
+    key    TEXT PRIMARY KEY,
+    reason TEXT,
+    beat   REAL NOT NULL
+)
+"""
+
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.execute(_SCHEMA)
+    return db
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class CancelToken:
+    def __init__(self, deadline: float | None = None, key: str | None = None):
+        self._ev = threading.Event()
+        self.reason = ""
+        self.deadline = deadline
+        self.progress = time.monotonic()
+        self.remote = False         # выполняется в другом процессе: пульс — из строки
+        self.key = key              # общая строка в STATE_DB (share)
+        self._synced = 0.0
+
+    def share(self) -> str:
+        """Задание уходит в дочерний процесс: отмена и пульс — через STATE_DB."""
+        self.key, self.remote = uuid.uuid4().hex, True
+        now = time.time()
+        db = _db()
+        db.execute("DELETE FROM cancels WHERE beat < ?", (now - KEEP,))
+        db.execute("INSERT INTO cancels VALUES (?, ?, ?)",
+                   (self.key, self.reason if self._ev.is_set() else None, now))
+        return self.key
+
+    def release(self):
+        """Дочерний процесс закончил задание — строка больше не нужна."""
+        if self.key is not None:
+            _db().execute("DELETE FROM cancels WHERE key=?", (self.key,))
+
+    def _sync(self):
+        if self.key is None:
+            return
+        now = time.monotonic()
+        if now - self._synced < POLL:
+            return
+        self._synced = now
+        db = _db()
+        if not self.remote:         # сторона задания: отдать свой пульс
+            db.execute("UPDATE cancels SET beat=? WHERE key=?",
+                       (time.time() - (now - self.progress), self.key))
+        row = db.execute("SELECT reason, beat FROM cancels WHERE key=?",
+                         (self.key,)).fetchone()
+        if row is None:
+            return
+        if row[0] and not self._ev.is_set():
+            self.reason = row[0]
+            self._ev.set()
+        if self.remote:
+            self.progress = now - max(0.0, time.time() - row[1])
+
+    def beat(self):
+        """Задание продвинулось (страница, HTTP-ответ)."""
+        self.progress = time.monotonic()
+        self._sync()
+
+    def idle(self) -> float:
+        """Секунд без прогресса."""
+        self._sync()
+        return time.monotonic() - self.progress
+
+    def cancel(self, reason: str = "остановлено"):
+        if not self._ev.is_set():
+            self.reason = reason
+        self._ev.set()
+        if self.key is not None:
+            _db().execute("UPDATE cancels SET reason=COALESCE(reason, ?) WHERE key=?",
+                          (self.reason, self.key))
+
+    @property
+    def cancelled(self) -> bool:
+        self._sync()
+        return self._ev.is_set()
+
+    @property
+    def timed_out(self) -> bool:
+        return self.cancelled and self.reason == DEADLINE
+
+    def remaining(self) -> float | None:
+        """Секунд до срока (None — срока нет)."""
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def check(self):
+        self.progress = time.monotonic()
+        self._raise()
+
+    def _raise(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.cancel(DEADLINE)
+        self._sync()
+        if self._ev.is_set():
+            raise Cancelled(self.reason)
+
+    def sleep(self, sec: float):
+        """time.sleep, который прерывается отменой и сроком."""
+        end = time.time() + sec
+        while True:
+            self._raise()               # без beat: сон — не прогресс
+            left = end - time.time()
+            if left <= 0:
+                return
+            rem = self.remaining()
+            step = left if rem is None else min(left, max(rem, 0))
+            if self.key is not None:    # отмена из другого процесса событие не взведёт
+                step = min(step, POLL)
+            if self._ev.wait(step):
+                raise Cancelled(self.reason)
+
+
+# токен по умолчанию для запуска скриптов вне бота: никогда не отменяется
+NEVER = CancelToken()
+
+_current: ContextVar[CancelToken] = ContextVar("cancel_token", default=NEVER)
+
+
+def current() -> CancelToken:
+    return _current.get()
+
+
+@contextmanager
+def bind(token: CancelToken | None) -> Iterator[None]:
+    """Токен задания — в контекст (копируется в потоки исполнителей)."""
+    t = _current.set(token or NEVER)
+    try:
+        yield
+    finally:
+        _current.reset(t)
@@ -0,0 +1,58 @@
+"""
+Чекпоинты отчётных скриптов: состояние прогона по (store_id, script)
+в локальном SQLite (тот же файл, что и jobstore).
+
+Скрипт сохраняет состояние после каждой фазы; если прогон умер
+(рестарт, исключение, кнопка ⏹), следующий запуск продолжает с того же
+места. Вызывается из потоков и дочерних процессов, поэтому соединение
+у каждого потока своё (_db), одно на всё время его жизни.
+"""
+from __future__ import annotations
+import json, sqlite3, threading, time
+from pathlib import Path
+from typing import Any
+
+from config import settings
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    store_id TEXT NOT NULL,
+    script   TEXT NOT NULL,
+    data     TEXT NOT NULL,
+    updated  REAL NOT NULL,
+    PRIMARY KEY (store_id, script)
+)
+"""
+
+
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.execute(_SCHEMA)
+    return db
+
+
+def load(store_id: str, script: str, max_age: float | None = None) -> dict[str, Any] | None:
+    """Последний чекпоинт или None (нет / старше max_age секунд)."""
+    row = _db().execute("SELECT data, updated FROM checkpoints"
+                        " WHERE store_id=? AND script=?", (store_id, script)).fetchone()
+    if row is None or (max_age is not None and time.time() - row[1] > max_age):
+        return None
+    return json.loads(row[0])
+
+
+def save(store_id: str, script: str, data: dict[str, Any]):
+    _db().execute("INSERT INTO checkpoints(store_id, script, data, updated)"
+                  " VALUES (?, ?, ?, ?) ON CONFLICT(store_id, script)"
+                  " DO UPDATE SET data=excluded.data, updated=excluded.updated",
+                  (store_id, script, json.dumps(data, ensure_ascii=False), time.time()))
+
+
+def clear(store_id: str, script: str):
+    _db().execute("DELETE FROM checkpoints WHERE store_id=? AND script=?",
+                  (store_id, script))
@@ -0,0 +1,170 @@
+"""
+Общие данные шагов одного обновления магазина (цепочки).
+
+enqueue_chain помечает задания одной цепочки cfg["chain"]; run_report
+открывает scope(store_id, chain) на заход, скрипт берёт current():
+
+    ctx = context.current()
+    ops = ctx.cached(f"fin_ops:{client_id}:{month}", lambda: fetch(month))
+
+Первый шаг цепочки загружает и публикует (операции Ozon за месяц,
+снимок листа unit-day), следующие берут готовое — без повторных
+запросов. Вне цепочки (единичный отчёт) cached() просто вызывает loader.
+
+Версии: put(key, value, version) / get(key, version) — значение отдаётся,
+только если версия совпала. Счётчики stamp/bump живут на уровне магазина,
+а не цепочки: writer листа делает bump, и снимок, опубликованный до чужой
+записи, перестаёт совпадать по версии.
+
+Хранится в STATE_DB (pickle + zlib), поэтому видно и дочерним процессам,
+и воркерам; записи старше TTL удаляются при следующей публикации.
+"""
+from __future__ import annotations
+import logging, pickle, sqlite3, threading, time, zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from config import settings
+from core.tasks.metrics import registry
+
+log = logging.getLogger(__name__)
+
+TTL = 6 * 3600          # сек: цепочка с park p_campain укладывается с запасом
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chain_data (
+    store_id TEXT NOT NULL,
+    chain_id TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    version  TEXT NOT NULL,
+    data     BLOB NOT NULL,
+    created  REAL NOT NULL,
+    PRIMARY KEY (store_id, chain_id, key)
+);
+CREATE INDEX IF NOT EXISTS chain_data_created ON chain_data(created);
+CREATE TABLE IF NOT EXISTS stamps (
+    store_id TEXT    NOT NULL,
+    name     TEXT    NOT NULL,
+    version  INTEGER NOT NULL,
+    PRIMARY KEY (store_id, name)
+);
+"""
+
+CONTEXT = registry.counter("report_context_total",
+                           "Обращения к общим данным цепочки (result=hit|miss)")
+
+_local = threading.local()
+_locks: dict[tuple, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.executescript(_SCHEMA)
+    return db
+
+
+class ChainContext:
+    def __init__(self, store_id: str | None = None, chain_id: str | None = None):
+        self.store_id, self.chain_id = store_id, chain_id
+
+    @property
+    def active(self) -> bool:
+        return bool(self.store_id and self.chain_id)
+
+    def get(self, key: str, version: Any = None) -> Any | None:
+        if not self.active:
+            return None
+        row = _db().execute(
+            "SELECT version, data FROM chain_data WHERE store_id=? AND chain_id=? AND key=?",
+            (self.store_id, self.chain_id, key)).fetchone()
+        if row is None or (version is not None and row[0] != str(version)):
+            return None
+        return pickle.loads(zlib.decompress(row[1]))
+
+    def put(self, key: str, value: Any, version: Any = ""):
+        if not self.active:
+            return
+        now = time.time()
+        blob = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        db = _db()
+        db.execute("DELETE FROM chain_data WHERE created < ?", (now - TTL,))
+        db.execute("INSERT OR REPLACE INTO chain_data VALUES (?, ?, ?, ?, ?, ?)",
+                   (self.store_id, self.chain_id, key, str(version), blob, now))
+
+    def cached(self, key: str, loader: Callable[[], Any], version: Any = "") -> Any:
+        """get(key, version) или loader() с публикацией; параллельные шаги
+        этого процесса ждут первую загрузку, а не делают свою."""
+        if not self.active:
+            return loader()
+        with _lock_for(self.store_id, self.chain_id, key):
+            value = self.get(key, version)
+            if value is not None:
+                CONTEXT.inc(key=key.split(":")[0], result="hit")
+                log.info("context %s/%s: %s из цепочки", self.store_id, self.chain_id, key)
+                return value
+            CONTEXT.inc(key=key.split(":")[0], result="miss")
+            value = loader()
+            self.put(key, value, version)
+            return value
+
+    # ─── версии листов магазина ───
+    def stamp(self, name: str) -> int:
+        if not self.store_id:
+            return 0
+        row = _db().execute("SELECT version FROM stamps WHERE store_id=? AND name=?",
+                            (self.store_id, name)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name: str) -> int:
+        """name изменён (лист перезаписан) — новая версия."""
+        if not self.store_id:
+            return 0
+        db = _db()
+        db.execute("INSERT INTO stamps VALUES (?, ?, 1) ON CONFLICT(store_id, name)"
+                   " DO UPDATE SET version=version+1", (self.store_id, name))
+        return self.stamp(name)
+
+
+def _lock_for(*key) -> threading.Lock:
+    with _locks_guard:
+        if len(_locks) > 1000:
+            _locks.clear()
+        return _locks.setdefault(key, threading.Lock())
+
+
+_NONE = ChainContext()
+_current: ContextVar[ChainContext] = ContextVar("chain_context", default=_NONE)
+
+
+def current() -> ChainContext:
+    return _current.get()
+
+
+def current_ids() -> tuple[str | None, str | None] | None:
+    ctx = _current.get()
+    return (ctx.store_id, ctx.chain_id) if ctx is not _NONE else None
+
+
+@contextmanager
+def scope(store_id: str, chain_id: str | None) -> Iterator[ChainContext]:
+    token = _current.set(ChainContext(store_id, chain_id))
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def adopt(ids: tuple[str | None, str | None] | None) -> Iterator[None]:
+    """В дочернем процессе: тот же магазин и цепочка, что у родителя."""
+    if ids is None:
+        yield
+        return
+    with scope(*ids):
+        yield
@@ -0,0 +1,88 @@
+"""
+Граф шагов обновления магазина.
+
+Шаг зависит от других (after) — ждёт, пока поставленные раньше задания
+этих скриптов в магазине завершатся; шаги одной группы листов (group)
+пишут в одни и те же строки и идут строго по очереди. Всё остальное
+планировщик (core.tasks.scheduler) запускает параллельно в пределах
+общих лимитов и полос — полное обновление магазина длится столько,
+сколько его критический путь, а не сумма шагов.
+
+  unit_day_5 ──► p_campain_fin_1      (колонка F строк unit-day)
+  balans_1                            (свой лист)
+  fin_week_1                          (свой лист; input только читает)
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, Iterable
+
+
+@dataclass(frozen=True)
+class Step:
+    script: str
+    after: tuple[str, ...] = ()
+    group: str = ""         # лист / группа листов, которую шаг перезаписывает
+
+
+STEPS: Dict[str, Step] = {s.script: s for s in (
+    Step("unit_day_5",                             group="unit_day"),
+    Step("p_campain_fin_1", after=("unit_day_5",), group="unit_day"),
+    Step("balans_1",                               group="balans"),
+    Step("fin_week_1",                             group="week_fin"),
+)}
+
+
+def step(script: str) -> Step:
+    return STEPS.get(script) or Step(script, group=script)
+
+
+def needs(script: str) -> set[str]:
+    """Все предки шага (транзитивно)."""
+    out: set[str] = set()
+    todo = list(step(script).after)
+    while todo:
+        s = todo.pop()
+        if s not in out:
+            out.add(s)
+            todo.extend(step(s).after)
+    return out
+
+
+def ready(script: str, running: Iterable[str], ahead: Iterable[str],
+          waiting: Iterable[str] = ()) -> bool:
+    """Можно ли запускать шаг.
+
+    running — выполняющиеся шаги магазина, ahead — поставленные раньше
+    и ещё ждущие в очереди, waiting — отложенные (park, повтор). Отложенный
+    шаг держит свою группу так же, как выполняющийся: пока p_campain_fin_1
+    ждёт UUID, unit_day_5 другой цепочки не перепишет лист под ним.
+
+    >>> ready("unit_day_5", [], [], waiting=["p_campain_fin_1"])
+    False
+    >>> ready("balans_1", [], [], waiting=["p_campain_fin_1"])
+    True
+    >>> ready("p_campain_fin_1", [], [], waiting=["unit_day_5"])
+    False
+    """
+    group, need = step(script).group, needs(script)
+    for s in (*running, *ahead, *waiting):
+        if s in need or step(s).group == group:
+            return False
+    return True
+
+
+def order(scripts: Iterable[str]) -> list[str]:
+    """Топологический порядок (порядок постановки в очередь)."""
+    wanted, out = list(dict.fromkeys(scripts)), []
+
+    def visit(s: str):
+        if s in out:
+            return
+        for dep in step(s).after:
+            if dep in wanted:
+                visit(dep)
+        out.append(s)
+
+    for s in wanted:
+        visit(s)
+    return out
@@ -0,0 +1,57 @@
+"""
+Бюджет времени задания — срок его CancelToken.
+
+Потолок — из settings.DEADLINES ("unit_day_5=600,…") поверх DEFAULTS.
+Под потолком срок учится по истории: p95 успешных run() магазина
+× FACTOR, но не меньше FLOOR. Пока своих заходов мало — потолок: время
+отчёта растёт с объёмом кабинета, и чужая история о нём ничего не
+говорит (крупный магазин убивался бы по сроку мелких и не учился). Зависший на Ozon отчёт больше не держит слот полосы часами:
+по сроку его отменяет токен, а HTTP-запросы укорачивают таймауты
+до остатка бюджета (core.services.http).
+"""
+from __future__ import annotations
+import math
+
+from config import settings
+from core.tasks.jobstore import jobstore
+
+# потолок, сек: p_campain_fin_1 — до часа в run() без учёта park;
+# unit_day_5 листает /v1/analytics/data по 1000 строк раз в минуту —
+# час ≈ 55 страниц ≈ 55 тыс. строк sku×день (~7 тыс. SKU с продажами)
+DEFAULTS: dict[str, float] = {
+    "unit_day_5":      3600,
+    "balans_1":        900,
+    "fin_week_1":      3600,
+    "p_campain_fin_1": 5400,
+}
+FALLBACK = 3600         # скрипт без потолка
+FACTOR = 3.0            # запас над p95
+FLOOR = 300             # сек: короче срок не учим
+MIN_SAMPLES = 5
+
+
+def configured(script: str) -> float:
+    caps = dict(DEFAULTS)
+    for part in filter(None, (p.strip() for p in settings.DEADLINES.split(","))):
+        name, _, sec = part.partition("=")
+        caps[name.strip()] = float(sec)
+    return caps.get(script, FALLBACK)
+
+
+def _p95(samples: list[float]) -> float:
+    s = sorted(samples)
+    return s[min(len(s) - 1, math.ceil(0.95 * len(s)) - 1)]
+
+
+def learned(script: str, store_id: str) -> float | None:
+    samples = jobstore.runtimes(script, store_id)
+    if len(samples) >= MIN_SAMPLES:
+        return max(FLOOR, _p95(samples) * FACTOR)
+    return None
+
+
+def budget(script: str, store_id: str) -> float:
+    """Сек на run() задания по всем заходам (park не считается)."""
+    cap = configured(script)
+    got = learned(script, store_id)
+    return cap if got is None else min(cap, got)
@@ -0,0 +1,144 @@
+"""
+Отдельные пулы потоков для синхронных отчётных скриптов.
+
+Раньше run() уходил в пул asyncio по умолчанию — тот же, что обслуживает
+DNS и прочие блокирующие помощники; долгий p_campain_fin_1, спящий
+в time.sleep, мог выбрать его целиком. Теперь у каждого класса заданий
+(core.tasks.lanes) свой ограниченный пул с метриками:
+  • active — сколько потоков сейчас заняты отчётом
+  • queued — сколько заданий ждут свободный поток
+  • stuck  — потоки брошенных заданий (срок, сторож планировщика): слот
+    освобождён сразу, а пока основной пул ими занят, новые задания идут
+    в запасной пул того же размера
+
+При settings.REPORT_MODE="process" синхронные скрипты вместо потоков
+уходят в пул процессов (core.tasks.proc_pool).
+"""
+from __future__ import annotations
+import asyncio, contextvars, logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict
+
+from config import settings
+from core.tasks import trace
+from core.tasks.lanes import LONG, SHORT, lane_of
+from core.tasks.metrics import registry
+from core.tasks.proc_pool import ProcessReportExecutor
+
+log = logging.getLogger(__name__)
+
+
+class ReportExecutor:
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.active = 0
+        self.queued = 0
+        self.stuck = 0
+        self._pool = ThreadPoolExecutor(max_workers=size,
+                                        thread_name_prefix=f"report-{name}")
+        self._spare: ThreadPoolExecutor | None = None
+        self._busy = 0              # незавершённые задания основного пула, вкл. брошенные
+        self._slots: asyncio.Semaphore | None = None
+
+    async def run(self, func: Callable[..., Any], **kwargs) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        self.active += 1
+        ctx = contextvars.copy_context()     # текущий span трассировки — в поток
+        fut = None
+        try:
+            fut = self._submit(ctx.run, trace.call, partial(func, **kwargs))
+            return await asyncio.wrap_future(fut)
+        finally:
+            if fut is not None and not fut.done():      # ожидание брошено, а поток ещё занят
+                self._abandon(fut)
+            self.active -= 1
+            self._slots.release()
+
+    def _submit(self, *args):
+        """В основной пул, а если его потоки держат брошенные задания — в запасной."""
+        loop = asyncio.get_running_loop()
+        if self._busy < self.size:
+            self._busy += 1
+            fut = self._pool.submit(*args)
+
+            def freed():
+                self._busy -= 1
+
+            fut.add_done_callback(lambda _: loop.call_soon_threadsafe(freed))
+            return fut
+        if self._spare is None:
+            self._spare = ThreadPoolExecutor(max_workers=self.size,
+                                             thread_name_prefix=f"report-{self.name}-spare")
+        return self._spare.submit(*args)
+
+    def _abandon(self, fut):
+        loop = asyncio.get_running_loop()
+        self.stuck += 1
+
+        def released():
+            self.stuck -= 1
+
+        fut.add_done_callback(lambda _: loop.call_soon_threadsafe(released))
+        log.warning("executor %s: поток брошенного задания занят, таких %s",
+                    self.name, self.stuck)
+
+    def gauges(self) -> dict[str, int]:
+        return {"size": self.size, "active": self.active, "queued": self.queued,
+                "stuck": self.stuck}
+
+    def shutdown(self, wait: bool = False):
+        for pool in filter(None, (self._pool, self._spare)):
+            pool.shutdown(wait=wait, cancel_futures=True)
+        log.info("executor %s: остановлен", self.name)
+
+
+executors: Dict[str, ReportExecutor | ProcessReportExecutor] = {
+    LONG:  ReportExecutor(LONG,  settings.LONG_THREADS),
+    SHORT: ReportExecutor(SHORT, settings.SHORT_THREADS),
+}
+if settings.REPORT_MODE == "process":
+    executors["process"] = ProcessReportExecutor(settings.PROCESS_WORKERS,
+                                                 settings.PROCESS_MAX_TASKS,
+                                                 settings.PROCESS_RSS_MB)
+
+
+def executor_for(script: str) -> ReportExecutor:
+    return executors[lane_of(script)]
+
+
+async def run_sync(script: str, func: Callable[..., Any], **kwargs) -> Any:
+    """Выполняет синхронный run() скрипта в пуле, выбранном настройками."""
+    if "process" in executors:
+        # сам токен не пересекает границу процессов — его срок и ключ строки
+        # в STATE_DB, через которую ребёнку доходит ⏹ (CancelToken.share)
+        tok = kwargs.pop("cancel", None)
+        if tok is None:
+            return await executors["process"].run(script, **kwargs)
+        res = await executors["process"].run(
+            script, deadline=tok.deadline, cancel_key=tok.share(), **kwargs)
+        tok.release()
+        return res
+    return await executor_for(script).run(func, **kwargs)
+
+
+def executor_stats() -> dict[str, dict[str, int]]:
+    return {name: ex.gauges() for name, ex in executors.items()}
+
+
+registry.gauge("report_executor",
+               "Пулы исполнителей: size / active / queued / stuck (потоки) / recycled (процессы)",
+               lambda: [({"pool": name, "kind": k}, v)
+                        for name, g in executor_stats().items() for k, v in g.items()])
+
+
+def shutdown_executors(wait: bool = False):
+    for ex in executors.values():
+        ex.shutdown(wait=wait)
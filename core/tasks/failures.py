@@ -0,0 +1,57 @@
+"""
+Классификация ошибок отчётов и повтор на уровне планировщика.
+
+Временная ошибка (429, 5xx, таймаут, обрыв соединения) — задание уходит
+в очередь повторов с экспоненциальной паузой и не держит поток, пока ждёт.
+Постоянная (неверные ключи, нет таблицы или листа, битые credentials) —
+повторять бессмысленно: (магазин, скрипт) попадает в dead-letter список
+jobstore, автоциклы его пропускают до ручного запуска или /dlq_clear.
+Неизвестная ошибка считается временной, но после RETRY_MAX повторов
+тоже уходит в dead-letter.
+
+Скриптам не нужно спать внутри себя дольше пары коротких попыток —
+длинную паузу выдерживает планировщик.
+"""
+from __future__ import annotations
+import json, random
+
+TRANSIENT, PERMANENT = "transient", "permanent"
+
+RETRY_MAX = 4           # повторов после первой ошибки
+BACKOFF_BASE = 60.0     # сек: 1, 2, 4, 8 мин…
+BACKOFF_CAP = 1800.0
+
+# HTTP-статусы, при которых повтор не поможет
+_PERMANENT_STATUS = {400, 401, 403, 404}
+# gspread / google-auth: таблица или лист не найдены, ключ SA не читается
+_PERMANENT_NAMES = {"SpreadsheetNotFound", "WorksheetNotFound", "NoValidUrlKeyFound",
+                    "RefreshError", "MalformedError"}
+
+
+def status_of(exc: BaseException) -> int | None:
+    """HTTP-статус из исключения requests / gspread / aiohttp."""
+    resp = getattr(exc, "response", None)
+    code = getattr(resp, "status_code", None) or getattr(exc, "status", None)
+    return code if isinstance(code, int) else None
+
+
+def classify(exc: BaseException) -> str:
+    if type(exc).__name__ in _PERMANENT_NAMES:
+        return PERMANENT
+    if isinstance(exc, (FileNotFoundError, PermissionError, json.JSONDecodeError)):
+        return PERMANENT        # sa_path или credentials_json магазина
+    code = status_of(exc)
+    if code is not None:
+        return PERMANENT if code in _PERMANENT_STATUS else TRANSIENT
+    return TRANSIENT
+
+
+def retry_delay(cfg: dict) -> float | None:
+    """Пауза перед следующим повтором задания или None — в dead-letter."""
+    if cfg.get("_failure") != TRANSIENT:
+        return None
+    n = cfg.get("_retries", 0)
+    if n >= RETRY_MAX:
+        return None
+    delay = min(BACKOFF_BASE * 2 ** n, BACKOFF_CAP)
+    return delay * random.uniform(0.8, 1.2)
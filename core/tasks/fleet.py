@@ -0,0 +1,77 @@
+"""
+Связь бота с воркерами отчётов (settings.FLEET_SHARDS > 0).
+
+Бот не выполняет отчёты: FleetClient пишет задания и запросы ⏹
+в jobstore, воркер шарда (core.tasks.worker) их забирает. Сообщения
+отчётов воркер отдаёт через RelayBot в таблицу events, а relay_loop
+в процессе бота отправляет их в Telegram.
+
+Магазин всегда в одном шарде: crc32(store_id) % FLEET_SHARDS.
+"""
+from __future__ import annotations
+import asyncio, logging, uuid, zlib
+from types import SimpleNamespace
+
+from core.tasks.jobstore import jobstore
+
+log = logging.getLogger(__name__)
+
+
+def shard_of(store_id: str, shards: int) -> int:
+    return zlib.crc32(str(store_id).encode()) % shards
+
+
+class FleetClient:
+    """То же API, что у Scheduler, но задания выполняют воркеры."""
+
+    def submit(self, cfg: dict) -> int:
+        # склейка повторов и WFQ — в воркере шарда
+        return jobstore.add(cfg, int(cfg.get("owner_id") or cfg["chat_id"]))
+
+    def drop(self, store_id: str) -> int:
+        n = jobstore.count_pending(store_id)
+        jobstore.request_drop(store_id)
+        return n
+
+    def recover(self, bot) -> int:
+        return 0    # незавершённые задания поднимают сами воркеры
+
+
+class RelayBot:
+    """Вместо aiogram.Bot в воркере: сообщения уходят в jobstore.events.
+
+    message_id здесь — строковый ключ; настоящий id знает только бот.
+    """
+
+    async def send_message(self, chat_id: int, text: str, **_) -> SimpleNamespace:
+        ref = uuid.uuid4().hex
+        jobstore.emit(chat_id, "send", ref, text)
+        return SimpleNamespace(message_id=ref)
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: str, **_):
+        jobstore.emit(chat_id, "edit", message_id, text)
+
+
+async def relay_loop(bot, interval: float = 1.0):
+    """Процесс бота: отправляет в Telegram сообщения воркеров по порядку."""
+    while True:
+        for ev in jobstore.unsent():
+            mid = None
+            try:
+                if ev["kind"] == "send":
+                    mid = (await bot.send_message(ev["chat_id"], ev["text"])).message_id
+                else:
+                    real = jobstore.message_id(ev["ref"])
+                    if real is None:    # исходное не дошло — шлём новым
+                        await bot.send_message(ev["chat_id"], ev["text"])
+                    else:
+                        await bot.edit_message_text(text=ev["text"], chat_id=ev["chat_id"],
+                                                    message_id=real)
+            except Exception as e:      # заблокировали бота, «message is not modified»…
+                log.warning("relay event %s to %s: %s", ev["id"], ev["chat_id"], e)
+            jobstore.sent(ev["id"], mid)
+        await asyncio.sleep(interval)
+
+
+# Singleton
+fleet = FleetClient()
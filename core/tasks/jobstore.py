@@ -0,0 +1,310 @@
+"""
+JobStore — очередь отчётов в локальном SQLite, переживающая рестарт.
+
+systemd перезапускает бота на каждый деплой; без этого файла пропадали
+все очереди, автоциклы и наполовину выполненные p_campain_fin_1.
+
+Состояния задания: queued → running → (parked → queued →) done | failed;
+временная ошибка — running → retry → queued (core.tasks.failures).
+У running-задания есть аренда (lease_until), которую планировщик
+продлевает heartbeat-ом — по ней видно, жив ли исполнитель. После
+рестарта running-задания возвращаются в очередь, parked — снова ждут
+свой UUID.
+
+Все вызовы — из потока event loop, запросы короткие и локальные.
+
+В режиме воркеров (settings.FLEET_SHARDS > 0, core.tasks.worker) этот же
+файл — общая очередь между процессами: бот пишет задания и запросы ⏹
+(drops), воркеры пишут сообщения для Telegram (events), которые бот
+отправляет от своего имени.
+
+Ключи магазина (credentials_json) в файл не пишутся: в задании — только
+store_id, исполнитель берёт ключи из базы магазинов (report_runner).
+"""
+from __future__ import annotations
+import json, logging, sqlite3, time
+from pathlib import Path
+from typing import Any
+
+from config import settings
+
+log = logging.getLogger(__name__)
+
+QUEUED, RUNNING, PARKED, DONE, FAILED = "queued", "running", "parked", "done", "failed"
+RETRY = "retry"
+
+# то, что нельзя (и не нужно) сохранять: живые объекты процесса и ключи
+_VOLATILE = ("bot", "step_event", "cancel", "credentials_json")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    store_id    TEXT    NOT NULL,
+    owner_id    INTEGER NOT NULL,
+    script      TEXT    NOT NULL,
+    state       TEXT    NOT NULL,
+    cfg         TEXT    NOT NULL,
+    park        TEXT,
+    interval    REAL,
+    lease_until REAL,
+    heartbeat   REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    created     REAL    NOT NULL,
+    updated     REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state);
+CREATE TABLE IF NOT EXISTS loops (
+    store_id TEXT PRIMARY KEY,
+    cfg      TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS drops (
+    store_id  TEXT PRIMARY KEY,
+    requested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id    INTEGER NOT NULL,
+    kind       TEXT    NOT NULL,
+    ref        TEXT    NOT NULL,
+    text       TEXT    NOT NULL,
+    message_id INTEGER,
+    sent       INTEGER NOT NULL DEFAULT 0,
+    created    REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_sent ON events(sent, id);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    store_id TEXT    NOT NULL,
+    script   TEXT    NOT NULL,
+    owner_id INTEGER NOT NULL,
+    kind     TEXT    NOT NULL,
+    error    TEXT    NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 1,
+    first_at REAL    NOT NULL,
+    last_at  REAL    NOT NULL,
+    PRIMARY KEY (store_id, script)
+);
+CREATE TABLE IF NOT EXISTS runtimes (
+    store_id TEXT NOT NULL,
+    script   TEXT NOT NULL,
+    seconds  REAL NOT NULL,
+    ts       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runtimes_script ON runtimes(script, store_id, ts);
+"""
+
+
+def _dump_cfg(cfg: dict) -> str:
+    return json.dumps({k: v for k, v in cfg.items() if k not in _VOLATILE},
+                      ensure_ascii=False, default=str)
+
+
+class JobStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+            # строки, записанные до того, как ключи перестали сохраняться
+            for table in ("jobs", "loops"):
+                self._db.execute(
+                    f"UPDATE {table} SET cfg=json_remove(cfg, '$.credentials_json')"
+                    " WHERE json_extract(cfg, '$.credentials_json') IS NOT NULL")
+        return self._db
+
+    # ─── jobs ───
+    def add(self, cfg: dict, owner_id: int) -> int:
+        now = time.time()
+        cur = self.db.execute(
+            "INSERT INTO jobs(store_id, owner_id, script, state, cfg, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (cfg["store_id"], owner_id, cfg["script"], QUEUED,
+             _dump_cfg(cfg), now, now))
+        return cur.lastrowid
+
+    def start(self, job_id: int, lease: float):
+        now = time.time()
+        self.db.execute(
+            "UPDATE jobs SET state=?, lease_until=?, heartbeat=?,"
+            " attempts=attempts+1, updated=? WHERE id=?",
+            (RUNNING, now + lease, now, now, job_id))
+
+    def heartbeat(self, job_id: int, lease: float):
+        now = time.time()
+        self.db.execute(
+            "UPDATE jobs SET lease_until=?, heartbeat=?, updated=? WHERE id=?",
+            (now + lease, now, now, job_id))
+
+    def park(self, job_id: int, cfg: dict, state: dict, interval: float):
+        self.db.execute(
+            "UPDATE jobs SET state=?, cfg=?, park=?, interval=?, lease_until=NULL,"
+            " updated=? WHERE id=?",
+            (PARKED, _dump_cfg(cfg), json.dumps(state, ensure_ascii=False),
+             interval, time.time(), job_id))
+
+    def requeue(self, job_id: int, cfg: dict):
+        self.db.execute(
+            "UPDATE jobs SET state=?, cfg=?, park=NULL, lease_until=NULL,"
+            " updated=? WHERE id=?",
+            (QUEUED, _dump_cfg(cfg), time.time(), job_id))
+
+    def retry(self, job_id: int, cfg: dict, error: str):
+        """Временная ошибка: задание ждёт повтора (срок — cfg["_retry_at"])."""
+        self.db.execute(
+            "UPDATE jobs SET state=?, cfg=?, error=?, lease_until=NULL, updated=? WHERE id=?",
+            (RETRY, _dump_cfg(cfg), error, time.time(), job_id))
+
+    def finish(self, job_id: int, ok: bool, error: str | None = None):
+        self.db.execute(
+            "UPDATE jobs SET state=?, error=?, lease_until=NULL, updated=? WHERE id=?",
+            (DONE if ok else FAILED, error, time.time(), job_id))
+
+    @staticmethod
+    def _rows(rows) -> list[dict[str, Any]]:
+        out = []
+        for r in rows:
+            d = dict(r)
+            d["cfg"] = json.loads(d["cfg"])
+            d["park"] = json.loads(d["park"]) if d["park"] else None
+            out.append(d)
+        return out
+
+    def pending(self) -> list[dict[str, Any]]:
+        """Незавершённые задания в порядке постановки (для восстановления)."""
+        return self._rows(self.db.execute(
+            "SELECT * FROM jobs WHERE state IN (?, ?, ?, ?) ORDER BY id",
+            (QUEUED, RUNNING, PARKED, RETRY)))
+
+    def queued_after(self, last_id: int) -> list[dict[str, Any]]:
+        """Новые задания в очереди (воркер забирает их по id)."""
+        return self._rows(self.db.execute(
+            "SELECT * FROM jobs WHERE state=? AND id>? ORDER BY id", (QUEUED, last_id)))
+
+    def last_id(self) -> int:
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM jobs").fetchone()[0]
+
+    def counts(self) -> dict[str, int]:
+        """Незавершённые задания по состояниям (все процессы)."""
+        return {r[0]: r[1] for r in self.db.execute(
+            "SELECT state, COUNT(*) FROM jobs WHERE state IN (?, ?, ?, ?) GROUP BY state",
+            (QUEUED, RUNNING, PARKED, RETRY))}
+
+    def count_pending(self, store_id: str) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE store_id=? AND state IN (?, ?, ?, ?)",
+            (store_id, QUEUED, RUNNING, PARKED, RETRY)).fetchone()[0]
+
+    def prune(self, days: int = 7):
+        cutoff = time.time() - days * 86400
+        self.db.execute("DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?",
+                        (DONE, FAILED, cutoff))
+        self.db.execute("DELETE FROM events WHERE sent=1 AND created < ?", (cutoff,))
+        self.db.execute("DELETE FROM runtimes WHERE ts < ?", (time.time() - 30 * 86400,))
+
+    # ─── dead-letter: постоянные ошибки (core.tasks.failures) ───
+    def bury(self, store_id: str, script: str, owner_id: int, kind: str, error: str):
+        now = time.time()
+        self.db.execute(
+            "INSERT INTO dead_letters(store_id, script, owner_id, kind, error, first_at, last_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(store_id, script) DO UPDATE SET"
+            " kind=excluded.kind, error=excluded.error, failures=failures+1, last_at=excluded.last_at",
+            (store_id, script, owner_id, kind, error, now, now))
+
+    def is_dead(self, store_id: str, script: str) -> bool:
+        return self.db.execute("SELECT 1 FROM dead_letters WHERE store_id=? AND script=?",
+                               (store_id, script)).fetchone() is not None
+
+    def revive(self, store_id: str, script: str | None = None) -> int:
+        """Снимает магазин (или один его скрипт) с dead-letter."""
+        sql, args = "DELETE FROM dead_letters WHERE store_id=?", [store_id]
+        if script is not None:
+            sql += " AND script=?"
+            args.append(script)
+        return self.db.execute(sql, args).rowcount
+
+    def dead_letters(self) -> list[dict[str, Any]]:
+        return [dict(r) for r in self.db.execute(
+            "SELECT * FROM dead_letters ORDER BY last_at DESC")]
+
+    # ─── история длительностей (core.tasks.deadlines) ───
+    def record_runtime(self, store_id: str, script: str, seconds: float):
+        self.db.execute("INSERT INTO runtimes VALUES (?, ?, ?, ?)",
+                        (store_id, script, seconds, time.time()))
+
+    def runtimes(self, script: str, store_id: str | None = None,
+                 limit: int = 50) -> list[float]:
+        """Последние успешные длительности run() скрипта (по магазину или всех)."""
+        sql, args = "SELECT seconds FROM runtimes WHERE script=?", [script]
+        if store_id is not None:
+            sql += " AND store_id=?"
+            args.append(store_id)
+        return [r[0] for r in self.db.execute(sql + " ORDER BY ts DESC LIMIT ?",
+                                              (*args, limit))]
+
+    # ─── ⏹ между процессами ───
+    def request_drop(self, store_id: str):
+        self.db.execute(
+            "INSERT INTO drops(store_id, requested) VALUES (?, ?)"
+            " ON CONFLICT(store_id) DO UPDATE SET requested=excluded.requested",
+            (store_id, time.time()))
+
+    def take_drops(self, owns) -> list[tuple[str, float]]:
+        """Запросы ⏹ для своих магазинов (owns(store_id) -> bool); удаляет их."""
+        out = [(r["store_id"], r["requested"])
+               for r in self.db.execute("SELECT store_id, requested FROM drops")
+               if owns(r["store_id"])]
+        for sid, _ in out:
+            self.db.execute("DELETE FROM drops WHERE store_id=?", (sid,))
+        return out
+
+    def cancel_queued(self, store_id: str, before: float):
+        """Ещё не взятые воркером задания магазина, поставленные до ⏹."""
+        self.db.execute(
+            "UPDATE jobs SET state=?, error='cancelled', updated=?"
+            " WHERE store_id=? AND state IN (?, ?) AND created<=?",
+            (FAILED, time.time(), store_id, QUEUED, RETRY, before))
+
+    # ─── сообщения воркеров для Telegram ───
+    def emit(self, chat_id: int, kind: str, ref: str, text: str):
+        self.db.execute(
+            "INSERT INTO events(chat_id, kind, ref, text, created) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, kind, ref, text, time.time()))
+
+    def unsent(self, limit: int = 100) -> list[sqlite3.Row]:
+        return self.db.execute("SELECT * FROM events WHERE sent=0 ORDER BY id LIMIT ?",
+                               (limit,)).fetchall()
+
+    def sent(self, event_id: int, message_id: int | None = None):
+        self.db.execute("UPDATE events SET sent=1, message_id=? WHERE id=?",
+                        (message_id, event_id))
+
+    def message_id(self, ref: str) -> int | None:
+        """Настоящий message_id сообщения, отправленного по событию ref."""
+        row = self.db.execute("SELECT message_id FROM events WHERE kind='send' AND ref=?",
+                              (ref,)).fetchone()
+        return row[0] if row else None
+
+    # ─── автоциклы магазинов ───
+    def save_loop(self, store_id: str, cfg: dict):
+        self.db.execute(
+            "INSERT INTO loops(store_id, cfg) VALUES (?, ?)"
+            " ON CONFLICT(store_id) DO UPDATE SET cfg=excluded.cfg",
+            (store_id, _dump_cfg(cfg)))
+
+    def delete_loop(self, store_id: str):
+        self.db.execute("DELETE FROM loops WHERE store_id=?", (store_id,))
+
+    def loops(self) -> list[dict[str, Any]]:
+        return [{"store_id": r["store_id"], "cfg": json.loads(r["cfg"])}
+                for r in self.db.execute("SELECT store_id, cfg FROM loops")]
+
+
+# Singleton
+jobstore = JobStore(settings.STATE_DB)
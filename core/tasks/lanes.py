@@ -0,0 +1,20 @@
+"""
+Классы заданий: долгие и короткие скрипты.
+
+Один и тот же класс определяет полосу планировщика и пул потоков,
+в котором выполняется синхронный run().
+"""
+from __future__ import annotations
+from typing import Dict
+
+LONG, SHORT = "long", "short"
+
+# скрипт → полоса; всё, чего нет в словаре, считается коротким
+LANES: Dict[str, str] = {
+    "p_campain_fin_1": LONG,
+    "fin_week_1":      LONG,
+}
+
+
+def lane_of(script: str) -> str:
+    return LANES.get(script, SHORT)
@@ -0,0 +1,157 @@
+"""
+Метрики очереди и отчётов (без внешних библиотек).
+
+• счётчики и гистограммы с метками — копятся в процессе
+• гауджи — функции, которые считаются в момент выгрузки
+  (глубина очереди из планировщика и т. п.)
+• выгрузка в текстовом формате Prometheus: serve() поднимает
+  http://127.0.0.1:METRICS_PORT/metrics, воркер шарда i — на порту +1+i
+• команда /stats (telegram/handlers/admin.py) читает тот же реестр
+
+Запись идёт из потока event loop, выгрузка — тоже, но на всякий
+случай всё под одним lock.
+"""
+from __future__ import annotations
+import bisect, logging, math, threading
+from typing import Callable, Dict, Iterable, Tuple
+
+log = logging.getLogger(__name__)
+
+# сек: от «сразу» до часа (p_campain_fin_1 с ожиданием UUID)
+BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, math.inf)
+
+_lock = threading.RLock()
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt(labels: Labels, extra: Iterable[tuple[str, str]] = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name, self.help = name, help
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, n: float = 1, **labels):
+        k = _key(labels)
+        with _lock:
+            self.values[k] = self.values.get(k, 0) + n
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_fmt(k)} {v:g}" for k, v in sorted(self.values.items())]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        self.name, self.help, self.buckets = name, help, buckets
+        self.values: Dict[Labels, list] = {}      # labels → [counts…, sum, count]
+
+    def observe(self, value: float, **labels):
+        k = _key(labels)
+        with _lock:
+            v = self.values.setdefault(k, [0] * len(self.buckets) + [0.0, 0])
+            v[bisect.bisect_left(self.buckets, value)] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    def quantile(self, q: float, **labels) -> float | None:
+        """Оценка квантиля по верхней границе бакета."""
+        v = self.values.get(_key(labels))
+        if not v or not v[-1]:
+            return None
+        rank, acc = q * v[-1], 0
+        for bound, n in zip(self.buckets, v):
+            acc += n
+            if acc >= rank:
+                return bound
+        return math.inf
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for k, v in sorted(self.values.items()):
+            acc = 0
+            for bound, n in zip(self.buckets, v):
+                acc += n
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                out.append(f"{self.name}_bucket{_fmt(k, [('le', le)])} {acc}")
+            out.append(f"{self.name}_sum{_fmt(k)} {v[-2]:g}")
+            out.append(f"{self.name}_count{_fmt(k)} {v[-1]}")
+        return out
+
+
+class Gauge:
+    """Значение считается при выгрузке: fn() -> [(метки-dict, значение), …]."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], list[tuple[dict, float]]]):
+        self.name, self.help, self.fn = name, help, fn
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = sorted((_key(lb), v) for lb, v in self.fn())
+        except Exception as e:
+            log.warning("gauge %s: %s", self.name, e)
+            return out
+        out += [f"{self.name}{_fmt(k)} {v:g}" for k, v in values]
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], list[tuple[dict, float]]]) -> Gauge:
+        self._metrics[name] = Gauge(name, help, fn)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        with _lock:
+            lines = [ln for m in self._metrics.values() for ln in m.render()]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ─── метрики планировщика ───
+QUEUE_WAIT = registry.histogram(
+    "report_queue_wait_seconds", "Время от постановки в очередь до старта")
+RUN_TIME = registry.histogram(
+    "report_run_seconds", "Время выполнения run() скрипта (без ожидания в park)")
+JOBS = registry.counter(
+    "report_jobs_total", "Завершённые задания по результату")
+STALLS = registry.counter(
+    "report_stalls_total", "Задания без прогресса, снятые сторожем (action=cancel|abandon)")
+
+
+async def serve(port: int):
+    """GET /metrics на 127.0.0.1:port (aiohttp уже есть в зависимостях aiogram)."""
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(text=registry.render(),
+                            content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    log.info("metrics on http://127.0.0.1:%s/metrics", port)
+    return runner
@@ -0,0 +1,20 @@
+"""
+Приостановка заданий (park-and-resume).
+
+Скрипт, которому остаётся только ждать внешнюю систему (например, пока
+Ozon Performance соберёт отчёт по UUID), может вернуть из run() объект
+Park вместо того, чтобы спать в потоке. Планировщик освобождает слот,
+раз в `interval` секунд вызывает poll(state, ...) того же модуля и, когда
+тот вернёт True, снова ставит задание в очередь с run(resume=state).
+
+state должен состоять из простых типов — он может пересекать границу
+процессов.
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+
+
+@dataclass
+class Park:
+    state: dict
+    interval: float = 120.0
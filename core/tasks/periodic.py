@@ -0,0 +1,144 @@
+"""
+Периодический запуск отчётов магазинов (вместо sleep(1800) на магазин).
+
+Один heap на все магазины: (время, магазин, задача). Чтобы магазины,
+включённые одновременно (например, после деплоя), не стреляли разом
+каждые 30 минут:
+  • у каждой пары (магазин, задача) своя фаза внутри периода —
+    стабильный хэш store_id, равномерно размазанный по периоду
+  • к каждому сроку добавляется случайный jitter (±AUTO_JITTER, но не
+    больше 5% периода)
+  • у тяжёлых задач есть окно по МСК: суточные задачи раскладываются
+    внутри окна, более частые переносятся в окно, если срок вне его
+
+Какие задачи включены — settings.AUTO_TASKS (через запятую).
+"""
+from __future__ import annotations
+import asyncio, heapq, itertools, logging, random, time, zlib
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict
+
+from config import settings
+
+log = logging.getLogger(__name__)
+
+DAY = 86400
+MSK = 3 * 3600      # смещение МСК от UTC
+
+
+@dataclass(frozen=True)
+class Cadence:
+    scripts: tuple[str, ...]                 # выполняются по порядку
+    period: int                              # сек
+    window: tuple[int, int] | None = None    # [с, до) часов МСК, с < до
+
+
+CADENCES: Dict[str, Cadence] = {
+    "chain":    Cadence(("unit_day_5", "p_campain_fin_1"), 1800),
+    "balans":   Cadence(("balans_1",), 3600),
+    "fin_week": Cadence(("fin_week_1",), DAY, window=(1, 5)),
+}
+
+
+def enabled_tasks() -> list[str]:
+    return [t.strip() for t in settings.AUTO_TASKS.split(",")
+            if t.strip() in CADENCES]
+
+
+def _phase(store_id: str, task: str) -> float:
+    return zlib.crc32(f"{store_id}:{task}".encode()) / 2**32     # [0, 1)
+
+
+def next_slot(store_id: str, task: str, after: float) -> float:
+    """Первый слот расписания (без jitter) строго позже after."""
+    cad = CADENCES[task]
+    phase = _phase(store_id, task)
+    if cad.window and cad.period == DAY:
+        # фаза сразу внутри окна: суточные задачи ночью, но не все в 01:00
+        h1, h2 = cad.window
+        offset = (h1 * 3600 + phase * (h2 - h1) * 3600 - MSK) % DAY
+    else:
+        offset = phase * cad.period
+    slot = after - (after - offset) % cad.period + cad.period   # следующий слот фазы
+
+    if cad.window and cad.period < DAY:
+        h1, h2 = cad.window
+        local = slot + MSK
+        hour = local % DAY / 3600
+        if not h1 <= hour < h2:
+            day_start = local - local % DAY + (DAY if hour >= h2 else 0)
+            slot = day_start + h1 * 3600 + phase * (h2 - h1) * 3600 - MSK
+    return slot
+
+
+def jittered(task: str, slot: float) -> float:
+    """Срок запуска слота: slot ± jitter (не больше 5% периода)."""
+    cad = CADENCES[task]
+    return slot + random.uniform(-1, 1) * min(settings.AUTO_JITTER, cad.period * 0.05)
+
+
+class Periodic:
+    def __init__(self):
+        # (срок, seq, поколение, магазин, задача, слот): следующий слот
+        # считается от слота, а не от фактического запуска — ранний
+        # (jitter < 0) запуск не повторяет тот же слот
+        self._heap: list[tuple[float, int, int, str, str, float]] = []
+        self._fire: Dict[str, Callable[[str], Awaitable[None]]] = {}
+        self._gen: Dict[str, int] = {}       # поколение магазина: старые записи heap игнорируются
+        self._seq = itertools.count()
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def add(self, store_id: str, fire: Callable[[str], Awaitable[None]]):
+        """Включает автозапуск: fire(task) вызывается в срок каждой задачи."""
+        self.remove(store_id)
+        gen = self._gen[store_id] = next(self._seq)
+        self._fire[store_id] = fire
+        now = time.time()
+        for task in enabled_tasks():
+            self._push(store_id, task, gen, next_slot(store_id, task, now), now)
+        self._ensure_running()
+        self._wake.set()
+
+    def _push(self, store_id: str, task: str, gen: int, slot: float, now: float):
+        due = max(jittered(task, slot), now + 1)
+        heapq.heappush(self._heap, (due, next(self._seq), gen, store_id, task, slot))
+
+    def remove(self, store_id: str):
+        self._fire.pop(store_id, None)
+        self._gen.pop(store_id, None)
+
+    def active(self, store_id: str) -> bool:
+        return store_id in self._fire
+
+    def _ensure_running(self):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            self._wake.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, gen, sid, task, slot = heapq.heappop(self._heap)
+                if self._gen.get(sid) != gen:
+                    continue
+                nxt = next_slot(sid, task, slot)
+                if nxt <= now:          # цикл отстал (долгий fire) — пропущенные слоты не догоняем
+                    nxt = next_slot(sid, task, now)
+                self._push(sid, task, gen, nxt, now)
+                try:
+                    await self._fire[sid](task)
+                except Exception as e:
+                    log.exception("periodic %s/%s: %s", sid, task, e)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Singleton
+periodic = Periodic()
@@ -0,0 +1,98 @@
+"""
+Пробы изменений: пропуск автоциклов, которые ничего бы не поменяли.
+
+У скрипта может быть probe(**kw) -> str | None — дешёвый отпечаток
+исходных данных (итоги аналитики, сводка Performance API и т. п.).
+Отпечаток успешного прогона хранится по (store_id, script); если
+автоматический запуск видит тот же отпечаток — дорогой прогон
+не нужен. Ручные запуски («Обновить отчёт») не пропускаются никогда,
+но свой отпечаток тоже записывают.
+
+Если отчёт пишет поверх листа другого скрипта (p_campain_fin_1
+дописывает F в unit-day), к отпечатку добавляется время последнего
+прогона зависимости: новый unit-day ⇒ колонку F нужно заполнить заново.
+"""
+from __future__ import annotations
+import hashlib, json, logging, sqlite3, time
+from pathlib import Path
+from typing import Any
+
+from config import settings
+
+log = logging.getLogger(__name__)
+
+# скрипт → скрипты, чей свежий прогон делает его отпечаток устаревшим
+DEPENDS = {
+    "p_campain_fin_1": ("unit_day_5",),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    store_id TEXT    NOT NULL,
+    script   TEXT    NOT NULL,
+    fp       TEXT,
+    ran_at   REAL,
+    runs     INTEGER NOT NULL DEFAULT 0,
+    skips    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (store_id, script)
+)
+"""
+
+
+def digest(data: Any) -> str:
+    """Короткий стабильный хэш JSON-совместимых данных."""
+    raw = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+class Fingerprints:
+    def __init__(self, path: str):
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(_SCHEMA)
+        return self._db
+
+    def _row(self, store_id: str, script: str) -> sqlite3.Row | None:
+        return self.db.execute("SELECT * FROM fingerprints WHERE store_id=? AND script=?",
+                               (store_id, script)).fetchone()
+
+    def compose(self, store_id: str, script: str, fp: str) -> str:
+        """Отпечаток скрипта + времена последних прогонов зависимостей."""
+        for dep in DEPENDS.get(script, ()):
+            row = self._row(store_id, dep)
+            fp += f"|{dep}@{row['ran_at'] if row else 0}"
+        return fp
+
+    def unchanged(self, store_id: str, script: str, fp: str) -> bool:
+        row = self._row(store_id, script)
+        return row is not None and row["fp"] == fp
+
+    def ran(self, store_id: str, script: str, fp: str | None):
+        """Успешный прогон: запоминаем отпечаток (None — пробы не было)."""
+        self.db.execute(
+            "INSERT INTO fingerprints(store_id, script, fp, ran_at, runs) VALUES (?, ?, ?, ?, 1)"
+            " ON CONFLICT(store_id, script) DO UPDATE SET"
+            " fp=excluded.fp, ran_at=excluded.ran_at, runs=runs+1",
+            (store_id, script, fp, time.time()))
+
+    def skipped(self, store_id: str, script: str):
+        self.db.execute("UPDATE fingerprints SET skips=skips+1 WHERE store_id=? AND script=?",
+                        (store_id, script))
+
+    def stats(self, store_id: str | None = None) -> list[dict[str, Any]]:
+        q, args = "SELECT store_id, script, runs, skips FROM fingerprints", ()
+        if store_id is not None:
+            q, args = q + " WHERE store_id=?", (store_id,)
+        return [dict(r) for r in self.db.execute(q, args)]
+
+
+# Singleton
+fingerprints = Fingerprints(settings.STATE_DB)
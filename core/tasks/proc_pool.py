@@ -0,0 +1,129 @@
+"""
+Режим выполнения отчётов в отдельных процессах (settings.REPORT_MODE="process").
+
+build_weekly_report, parse_zip и pandas-часть balans_1 упираются в CPU
+и держат GIL внутри процесса бота — от этого тормозят Telegram-хендлеры.
+В этом режиме run() выполняется в пуле дочерних процессов:
+  • через границу процессов идут только имя скрипта и простые kwargs
+    (строки из конфигурации магазина), сам модуль импортируется в ребёнке
+  • процесс пересоздаётся после PROCESS_MAX_TASKS заданий
+  • если после задания RSS ребёнка больше PROCESS_RSS_MB — весь пул
+    пересоздаётся, память pandas возвращается ОС
+"""
+from __future__ import annotations
+import asyncio, gc, inspect, logging, multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib import import_module
+from typing import Any
+
+from core.tasks import context, trace, usage
+from core.tasks.cancel import CancelToken, bind
+
+log = logging.getLogger(__name__)
+
+
+# ─── код, выполняемый в дочернем процессе ───
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        import resource   # не Linux: пиковый RSS лучше, чем ничего
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _release_memory():
+    gc.collect()
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)   # glibc: вернуть свободные арены ОС
+    except (OSError, AttributeError):
+        pass
+
+
+def _child_run(script: str, kwargs: dict[str, Any],
+               trace_ids: tuple[str, str] | None = None,
+               usage_ids: tuple[str, str, str] | None = None,
+               deadline: float | None = None,
+               context_ids: tuple[str | None, str | None] | None = None,
+               cancel_key: str | None = None) -> tuple[float, Any]:
+    func = getattr(import_module(f"report_scripts.{script}"), "run")
+    tok = CancelToken(deadline, cancel_key)     # ⏹ и пульс — через строку в STATE_DB
+    if "cancel" in inspect.signature(func).parameters:
+        kwargs["cancel"] = tok
+    try:
+        with trace.adopt(trace_ids), usage.adopt(usage_ids), bind(tok), \
+                context.adopt(context_ids):
+            res = trace.call(func, **kwargs)    # None или Park — оба сериализуемы
+    finally:
+        _release_memory()
+    return _rss_mb(), res
+
+
+# ─── сторона бота ───
+class ProcessReportExecutor:
+    def __init__(self, size: int, max_tasks: int, rss_cap_mb: int):
+        self.name = "process"
+        self.size = size
+        self.max_tasks = max_tasks
+        self.rss_cap_mb = rss_cap_mb
+        self.active = 0
+        self.queued = 0
+        self.recycled = 0
+        self._pool: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # max_tasks_per_child несовместим с fork
+        return ProcessPoolExecutor(max_workers=self.size,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   max_tasks_per_child=self.max_tasks)
+
+    def _recycle(self, reason: str):
+        old, self._pool = self._pool, self._new_pool()
+        self.recycled += 1
+        log.info("process pool пересоздан: %s", reason)
+        if old is not None:
+            old.shutdown(wait=False)   # идущие задания доработают в старом пуле
+
+    async def run(self, script: str, deadline: float | None = None,
+                  cancel_key: str | None = None, **kwargs) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        if self._pool is None:
+            self._pool = self._new_pool()
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        self.active += 1
+        fut = None
+        try:
+            fut = self._pool.submit(_child_run, script, kwargs, trace.current_ids(),
+                                    usage.current_ids(), deadline, context.current_ids(),
+                                    cancel_key)
+            rss, res = await asyncio.wrap_future(fut)
+            log.info("%s: RSS процесса после задания %.0f МБ", script, rss)
+            if rss > self.rss_cap_mb:
+                self._recycle(f"RSS {rss:.0f} МБ > {self.rss_cap_mb} МБ")
+            return res
+        except BrokenProcessPool:
+            self._recycle("дочерний процесс упал")
+            raise
+        finally:
+            if fut is not None and not fut.done():      # задание брошено: ребёнок доработает до своего срока
+                self._recycle(f"{script}: задание брошено")
+            self.active -= 1
+            self._slots.release()
+
+    def gauges(self) -> dict[str, int]:
+        return {"size": self.size, "active": self.active,
+                "queued": self.queued, "recycled": self.recycled}
+
+    def shutdown(self, wait: bool = False):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            log.info("executor %s: остановлен", self.name)
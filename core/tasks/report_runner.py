@@ -5,64 +5,229 @@ from importlib import import_module
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
 from config import settings
+from core.tasks import cancel, context, failures, trace, usage
+from core.tasks.cancel import Cancelled, NEVER, DEADLINE, STALLED
+from core.tasks.executors import run_sync, executors
+from core.tasks.lanes import SHORT
+from core.tasks.park import Park
+from core.tasks.probes import fingerprints
 
 log = logging.getLogger(__name__)
 
+# сек сверх срока: скрипт успевает заметить отменённый токен сам
+DEADLINE_GRACE = 30
+
+STORES_TTL = 600        # сек: ротация ключей в Stores доходит до воркеров за это время
+
+# store_id → строка Stores (ключи, sheet_id, sa_path); только в памяти
+_stores: dict[str, dict] = {}
+_stores_at = 0.0
+_stores_lock: asyncio.Lock | None = None
+
+
+async def _notify(bot: Bot, cfg: dict, msgs: dict, text: str):
+    """Итог отчёта — всем чатам, чьи запросы склеены в это задание."""
+    for chat in [cfg["chat_id"], *cfg.get("extra_chats", [])]:
+        mid = msgs.get(str(chat))
+        if mid is None:     # присоединился, когда отчёт уже шёл
+            msgs[str(chat)] = (await bot.send_message(chat, text)).message_id
+        else:
+            await bot.edit_message_text(text=text, chat_id=chat, message_id=mid)
+
+
+def _script_kwargs(cfg: dict, func, **extra) -> dict:
+    """kwargs для run()/poll(): только те, что функция объявила."""
+    creds = json.loads(cfg["credentials_json"])
+    raw_kwargs = dict(
+        token_oz           = creds.get("api_key", ""),
+        client_id          = creds.get("client_id", ""),
+        perf_client_id     = creds.get("perf_client_id", ""),
+        perf_client_secret = creds.get("perf_client_secret", ""),
+        gs_cred            = cfg["sa_path"],
+        spread_id          = cfg["sheet_id"],
+        store_id           = cfg["store_id"],
+        **extra,
+    )
+    sig = inspect.signature(func)
+    return {k: v for k, v in raw_kwargs.items() if k in sig.parameters}
+
+
+async def _within(token, aw):
+    """await aw, но не дольше срока токена (+ DEADLINE_GRACE).
+
+    Не уложился — токен отменяется, слот освобождается сразу; поток
+    исполнителя выйдет на ближайшей проверке токена или HTTP-таймауте.
+    """
+    rem = token.remaining()
+    if rem is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, max(rem, 0) + DEADLINE_GRACE)
+    except asyncio.TimeoutError:
+        token.cancel(DEADLINE)
+        raise Cancelled(DEADLINE) from None
+
+
+async def _credentials(cfg: dict):
+    """Ключи, таблица и сервис-аккаунт магазина — из Stores (в jobstore ключи
+    не пишутся). Весь лист читается одним запросом и живёт STORES_TTL;
+    401/403 в отчёте сбрасывает кэш досрочно (forget_stores)."""
+    global _stores, _stores_at, _stores_lock
+    from core.services.gs_db import GsDB
+
+    sid = cfg["store_id"]
+    if _stores_lock is None:
+        _stores_lock = asyncio.Lock()
+    async with _stores_lock:
+        if sid not in _stores or time.time() - _stores_at > STORES_TTL:
+            _stores, _stores_at = await GsDB().get_stores(), time.time()
+    store = _stores.get(sid)
+    if store is None:
+        raise RuntimeError(f"магазин {sid} не найден в Stores")
+    cfg.update(credentials_json=store["credentials_json"],
+               sheet_id=store["sheet_id"], sa_path=store["sa_path"])
+
+
+def forget_stores():
+    """Ключи отвергнуты (401/403): следующий заход перечитает Stores."""
+    global _stores_at
+    _stores_at = 0.0
+
+
+async def poll_parked(cfg: dict, state: dict) -> bool:
+    """Готово ли отложенное задание продолжить работу (poll() скрипта)."""
+    script = cfg["script"]
+    await _credentials(cfg)
+    poll = getattr(import_module(f"report_scripts.{script}"), "poll")
+    kwargs = _script_kwargs(cfg, poll)
+    # проверка — один короткий HTTP-запрос, долгий пул ей не нужен
+    return await executors[SHORT].run(partial(poll, state), **kwargs)
+
+
+async def _probe(cfg: dict) -> str | None:
+    """Отпечаток исходных данных (probe() скрипта) или None."""
+    probe = getattr(import_module(f"report_scripts.{cfg['script']}"), "probe", None)
+    if probe is None:
+        return None
+    try:
+        with trace.span("probe"):
+            fp = await executors[SHORT].run(probe, **_script_kwargs(cfg, probe))
+    except Exception as e:      # проба не должна мешать самому отчёту
+        log.warning("%s probe failed for %s: %s", cfg["script"], cfg["store_id"], e)
+        return None
+    return None if fp is None else fingerprints.compose(cfg["store_id"], cfg["script"], fp)
+
 
 async def run_report(cfg: dict):
+    """Один заход задания: span «run» под span задания из cfg, учёт API
+    и общие данные цепочки (core.tasks.context)."""
+    await _credentials(cfg)
+    with usage.accounting(cfg["store_id"], cfg["script"]) as u, \
+            context.scope(cfg["store_id"], cfg.get("chain")):
+        if "trace_id" not in cfg:       # задание из jobstore до трассировки
+            res = await _run_report(cfg)
+        else:
+            with trace.span("run", trace_id=cfg["trace_id"], parent=cfg["span_id"],
+                            resume="resume" in cfg):
+                res = await _run_report(cfg)
+    calls = usage.summary(u.run_id)
+    if calls:
+        log.info("%s API for %s: %s", cfg["script"], cfg["store_id"], calls)
+    return res
+
+
+async def _run_report(cfg: dict):
     bot: Bot = cfg["bot"]
     chat_id  = cfg["chat_id"]
     script   = cfg["script"]
     nice     = cfg.get("human", script)
     step     = cfg.get("step", "?")
 
+    # проба — только у автоцикла и только на старте, не после park/resume:
+    # ручной запуск её всё равно не пропустит, а проба unit_day_5 стоит
+    # слот /v1/analytics/data (1 запрос в минуту)
+    if cfg.get("auto") and "_t0" not in cfg and "resume" not in cfg:
+        cfg["_fp"] = await _probe(cfg)
+        if cfg["_fp"] is not None \
+                and fingerprints.unchanged(cfg["store_id"], script, cfg["_fp"]):
+            fingerprints.skipped(cfg["store_id"], script)
+            cfg["_skipped"] = True
+            log.info("%s SKIPPED for %s (no changes)", script, cfg["store_id"])
+            ev = cfg.get("step_event")
+            if isinstance(ev, asyncio.Event):
+                ev.set()
+            return True
+
     header = f"⏳ Шаг {step} <b>{nice}</b>…"
     if "p_campain_fin" in script:
         header += " (до 1 ч)"
-    msg = await bot.send_message(chat_id, header)
+    # chat_id → message_id; после park/resume (и рестарта) редактируем те же
+    msgs = cfg.setdefault("_msgs", {})
+    for chat in [chat_id, *cfg.get("extra_chats", [])]:
+        if str(chat) not in msgs:
+            msgs[str(chat)] = (await bot.send_message(chat, header)).message_id
+    parked = False
 
     try:
-        creds = json.loads(cfg["credentials_json"])
-        raw_kwargs = dict(
-            token_oz           = creds.get("api_key", ""),
-            client_id          = creds.get("client_id", ""),
-            perf_client_id     = creds.get("perf_client_id", ""),
-            perf_client_secret = creds.get("perf_client_secret", ""),
-            gs_cred            = cfg["sa_path"],
-            spread_id          = cfg["sheet_id"],
-        )
-
         mod  = import_module(f"report_scripts.{script}")
         func = getattr(mod, "run")
-        sig  = inspect.signature(func)
-        kwargs = {k: v for k, v in raw_kwargs.items()
-                  if k in sig.parameters}
+        kwargs = _script_kwargs(cfg, func, park=True,
+                                resume=cfg.pop("resume", None),
+                                cancel=cfg.get("cancel"))
+
+        t0 = cfg.setdefault("_t0", time.time())
+        token = cfg.get("cancel") or NEVER
+        with cancel.bind(token):        # срок — и HTTP-слою в потоке исполнителя
+            if inspect.iscoroutinefunction(func):
+                res = await _within(token, func(**kwargs))
+            else:
+                res = await _within(token, run_sync(script, func, **kwargs))
+
+        if isinstance(res, Park):
+            parked = True
+            await _notify(bot, cfg, msgs,
+                          f"⏸ {nice}: ждём, пока Ozon подготовит данные…")
+            log.info("%s PARKED for %s", script, cfg["store_id"])
+            return res
 
-        t0 = time.time()
-        if inspect.iscoroutinefunction(func):
-            await func(**kwargs)
-        else:
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(None, partial(func, **kwargs))
         m, s = divmod(round(time.time() - t0), 60)
 
-        await bot.edit_message_text(
-            text=f"✅ {nice} готов ({m} м {s} с).",
-            chat_id=chat_id,
-            message_id=msg.message_id
-        )
+        await _notify(bot, cfg, msgs, f"✅ {nice} готов ({m} м {s} с).")
         log.info("%s OK for %s", script, cfg["store_id"])
+        fingerprints.ran(cfg["store_id"], script, cfg.get("_fp"))
+        return True
 
-    except Exception:
+    except Cancelled as e:
+        if str(e) == DEADLINE:
+            m = round((time.time() - cfg["_t0"]) / 60)
+            await _notify(bot, cfg, msgs, f"⏱ {nice} прерван: {DEADLINE} ({m} мин).")
+            log.warning("%s DEADLINE for %s after %s min", script, cfg["store_id"], m)
+            cfg["_error"] = "deadline"
+            return False
+        await _notify(bot, cfg, msgs, f"⏹ {nice} остановлен: {e}.")
+        log.info("%s CANCELLED for %s: %s", script, cfg["store_id"], e)
+        cfg["_error"] = "stalled" if str(e) == STALLED else "cancelled"
+        return False
+
+    except Exception as e:
         err = traceback.format_exc()
-        await bot.edit_message_text(
-            text=f"❌ {nice} ERROR:\n<code>{err.splitlines()[-1]}</code>",
-            chat_id=chat_id,
-            message_id=msg.message_id
-        )
-        log.error("%s FAIL for %s\n%s", script, cfg["store_id"], err)
+        last = err.splitlines()[-1]
+        cfg["_error"] = last
+        cfg["_failure"] = failures.classify(e)
+        if failures.status_of(e) in (401, 403):
+            forget_stores()         # ключи могли смениться в Stores
+        delay = cfg["_retry_in"] = failures.retry_delay(cfg)
+        if delay is not None:
+            note = f"🔁 повтор через ~{max(1, round(delay / 60))} мин"
+        elif cfg["_failure"] == failures.PERMANENT:
+            note = "⛔ автозапуск этого отчёта приостановлен до ручного запуска"
+        else:
+            note = "⛔ повторы исчерпаны, автозапуск приостановлен до ручного запуска"
+        await _notify(bot, cfg, msgs, f"❌ {nice} ERROR:\n<code>{last}</code>\n{note}")
+        log.error("%s FAIL (%s) for %s\n%s", script, cfg["_failure"], cfg["store_id"], err)
+        return False
 
     finally:
         ev = cfg.get("step_event")
-        if isinstance(ev, asyncio.Event):
+        if isinstance(ev, asyncio.Event) and not parked:
             ev.set()
@@ -0,0 +1,541 @@
+"""
+Глобальный планировщик отчётов.
+
+• общий лимит одновременно выполняемых отчётов (settings.REPORT_WORKERS)
+• отдельные полосы (lanes) для долгих и коротких скриптов, у каждой свой лимит
+• внутри магазина — граф шагов (core.tasks.dag): зависимые шаги и шаги,
+  пишущие в одну группу листов, идут по очереди (FIFO), независимые —
+  параллельно
+• между владельцами — взвешенная справедливая очередь (WFQ): владелец
+  с 50 магазинами получает ту же долю слотов, что и владелец с одним
+• повторные запросы того же (store_id, script) склеиваются: ожидающее
+  задание забирает их себе, выполняющееся — если стартовало не раньше
+  settings.COALESCE_WINDOW секунд назад; уведомляются все запросившие
+• задание, вернувшее Park, освобождает слот и поток; планировщик сам
+  опрашивает poll() скрипта и возвращает задание в начало очереди магазина
+• каждое задание дублируется в core.tasks.jobstore (SQLite): после
+  рестарта recover() возвращает очередь, отложенные и прерванные задания
+• у каждого захода есть срок (core.tasks.deadlines): остаток бюджета
+  задания за вычетом уже отработанного; просроченное задание отменяется
+• упавшее задание с временной ошибкой ждёт повтора с экспоненциальной
+  паузой вне слотов и потоков; постоянная ошибка или исчерпанные повторы
+  кладут (магазин, скрипт) в dead-letter jobstore (core.tasks.failures)
+• сторож (_watchdog) следит за пульсом токена выполняющихся заданий:
+  после settings.STALL_MINUTES без прогресса задание отменяется, а если
+  и после этого не вышло — бросается, слот и поток пула освобождаются,
+  владелец получает сообщение
+• в воркере (core.tasks.worker) планировщик видит только свой шард
+  магазинов и забирает новые задания бота через pull()
+"""
+from __future__ import annotations
+import asyncio, itertools, logging, time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+from config import settings
+from core.tasks.cancel import CancelToken, STALLED
+from core.tasks.jobstore import jobstore, RUNNING, PARKED, RETRY
+from core.tasks.lanes import LONG, SHORT, lane_of
+from core.tasks.metrics import registry, QUEUE_WAIT, RUN_TIME, JOBS, STALLS
+from core.tasks import dag, deadlines, failures, trace, usage
+from core.tasks.park import Park
+from core.tasks.report_runner import run_report, poll_parked
+
+log = logging.getLogger(__name__)
+
+# «стоимость» задания в виртуальном времени WFQ
+COST: Dict[str, float] = {LONG: 4.0, SHORT: 1.0}
+
+# сек: минимум на заход после resume, даже если бюджет почти выбран
+MIN_SLICE = 60.0
+
+# сек: период сторожа и сколько ждать выхода после отмены, прежде чем бросить
+WATCH_EVERY = 30.0
+STALL_GRACE = 60.0
+
+
+@dataclass(eq=False)
+class Job:
+    cfg: dict
+    store_id: str
+    owner_id: int
+    script: str
+    lane: str
+    seq: int
+    enqueued: float = field(default_factory=time.time)
+    started: float | None = None
+    park: Park | None = None
+    next_poll: float = 0.0
+    id: int | None = None                               # строка в jobstore
+    busy: float = 0.0                                   # сек в run() по всем заходам
+    parked_at: float = 0.0
+    task: asyncio.Task | None = None                    # текущий заход (_run)
+    stalled_at: float = 0.0                             # сторож отменил задание
+    waiters: list[dict] = field(default_factory=list)   # склеенные запросы
+    done: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future())
+
+    def absorb(self, cfg: dict):
+        """Присоединяет повторный запрос: его чат тоже получит результат."""
+        self.waiters.append(cfg)
+        chat = cfg.get("chat_id")
+        extra = self.cfg.setdefault("extra_chats", [])
+        if chat is not None and chat != self.cfg.get("chat_id") and chat not in extra:
+            extra.append(chat)
+        if not cfg.get("auto"):     # ручной запрос: пропускать по пробе нельзя
+            self.cfg.pop("auto", None)
+
+
+@dataclass(eq=False)
+class _Store:
+    owner_id: int
+    jobs: Deque[Job] = field(default_factory=deque)
+    running: list[Job] = field(default_factory=list)
+
+
+class Scheduler:
+    def __init__(self, runner: Callable[[dict], Awaitable[Any]] = run_report,
+                 poller: Callable[[dict, dict], Awaitable[bool]] = poll_parked):
+        self.runner = runner
+        self.poller = poller
+        self.limit = settings.REPORT_WORKERS
+        self.lane_limits = {LONG: settings.LONG_WORKERS,
+                            SHORT: settings.SHORT_WORKERS}
+        self.weights: Dict[int, float] = {}      # owner_id → вес (по умолчанию 1)
+
+        self._stores: Dict[str, _Store] = {}
+        self._vtime: Dict[int, float] = {}       # виртуальное время владельца
+        self._vclock = 0.0                       # старт-тег последнего запуска
+        self._running = {LONG: 0, SHORT: 0}
+        self._seq = itertools.count()
+        self._parked: list[Job] = []
+        self._parking_task: asyncio.Task | None = None
+        self._watchdog_task: asyncio.Task | None = None
+        self._retrying: Dict[Job, asyncio.TimerHandle] = {}
+
+    # ─── публичное API ───
+    def submit(self, cfg: dict) -> Job:
+        """Ставит задание в очередь магазина; job.done завершится после run."""
+        store_id, script = cfg["store_id"], cfg["script"]
+        owner = int(cfg.get("owner_id") or cfg["chat_id"])
+        st = self._stores.setdefault(store_id, _Store(owner))
+        if not self._has_pending(owner):
+            # владелец «просыпается»: не даём ему накопить кредит за простой
+            self._vtime[owner] = max(self._vtime.get(owner, 0.0), self._vclock)
+
+        dup = self._coalesce_target(store_id, script)
+        if dup is not None:
+            dup.absorb(cfg)
+            self._retry_now(dup)
+            log.info("SCHED coalesce %s/%s → %s запрос(ов)",
+                     store_id, script, len(dup.waiters) + 1)
+            return dup
+
+        job = Job(cfg, store_id, owner, script, lane_of(script), next(self._seq))
+        job.id = jobstore.add(cfg, owner)
+        st.jobs.append(job)
+        log.info("SCHED enqueue %s/%s lane=%s depth=%s",
+                 store_id, script, job.lane, len(st.jobs))
+        self._kick()
+        return job
+
+    def drop(self, store_id: str) -> int:
+        """Удаляет ожидающие задания магазина и отменяет выполняющееся."""
+        st = self._stores.get(store_id)
+        if not st:
+            return 0
+        for job in st.running:
+            job.cfg["cancel"].cancel("остановлено пользователем")
+        dropped = list(st.jobs) + [j for j in self._parked if j.store_id == store_id]
+        st.jobs.clear()
+        self._parked = [j for j in self._parked if j.store_id != store_id]
+        for job in [j for j in self._retrying if j.store_id == store_id]:
+            self._retrying.pop(job).cancel()
+            dropped.append(job)
+        for job in dropped:
+            jobstore.finish(job.id, False, "cancelled")
+            if not job.done.done():
+                job.done.cancel()
+        return len(dropped)
+
+    def recover(self, bot, owns: Callable[[str], bool] | None = None) -> int:
+        """Поднимает незавершённые задания из jobstore после рестарта.
+
+        owns(store_id) — какие магазины наши (шард воркера); у каждого
+        шарда один процесс, поэтому все running-задания шарда — осиротевшие.
+        """
+        jobstore.prune()
+        usage.prune()
+        n = 0
+        for row in jobstore.pending():
+            if owns is None or owns(row["store_id"]):
+                self._adopt(row, bot)
+                n += 1
+        log.info("SCHED recovered %s jobs (%s parked)", n, len(self._parked))
+        self._kick()
+        return n
+
+    def pull(self, bot, owns: Callable[[str], bool], last_id: int) -> int:
+        """Забирает новые задания, поставленные другим процессом (ботом).
+
+        Возвращает последний просмотренный id.
+        """
+        known = self._ids()
+        for row in jobstore.queued_after(last_id):
+            last_id = row["id"]
+            if row["id"] in known or not owns(row["store_id"]):
+                continue
+            self._stores.setdefault(row["store_id"], _Store(row["owner_id"]))
+            dup = self._coalesce_target(row["store_id"], row["script"])
+            if dup is not None:
+                dup.absorb(row["cfg"])
+                jobstore.finish(row["id"], True, f"coalesced into {dup.id}")
+                self._retry_now(dup)
+                continue
+            if not self._has_pending(row["owner_id"]):
+                self._vtime[row["owner_id"]] = max(
+                    self._vtime.get(row["owner_id"], 0.0), self._vclock)
+            self._adopt(row, bot)
+        self._kick()
+        return last_id
+
+    def depth(self, store_id: str | None = None) -> int:
+        if store_id is not None:
+            st = self._stores.get(store_id)
+            return len(st.jobs) if st else 0
+        return sum(len(s.jobs) for s in self._stores.values())
+
+    def running(self, lane: str | None = None) -> int:
+        return self._running[lane] if lane else sum(self._running.values())
+
+    def parked(self) -> int:
+        return len(self._parked)
+
+    def retrying(self) -> int:
+        return len(self._retrying)
+
+    def depths(self) -> list[tuple[dict, float]]:
+        """Глубина очереди по (lane, store) — для метрик."""
+        out = []
+        for sid, st in self._stores.items():
+            for lane in (LONG, SHORT):
+                n = sum(1 for j in st.jobs if j.lane == lane)
+                if n:
+                    out.append(({"lane": lane, "store": sid}, n))
+        return out
+
+    # ─── диспетчер ───
+    def _adopt(self, row: dict, bot) -> Job:
+        """Задание из строки jobstore — в очередь магазина или к отложенным."""
+        cfg = {**row["cfg"], "bot": bot}
+        job = Job(cfg, row["store_id"], row["owner_id"], row["script"],
+                  lane_of(row["script"]), next(self._seq),
+                  enqueued=row["created"], id=row["id"])
+        self._stores.setdefault(job.store_id, _Store(job.owner_id))
+        self._vtime.setdefault(job.owner_id, self._vclock)
+        if row["state"] == PARKED:
+            job.started = row["created"]
+            job.park = Park(row["park"], row["interval"] or 120.0)
+            job.next_poll = time.time()
+            self._parked.append(job)
+            if self._parking_task is None or self._parking_task.done():
+                self._parking_task = asyncio.create_task(self._parking_loop())
+        elif row["state"] == RETRY:
+            self._arm_retry(job, cfg.get("_retry_at", 0) - time.time())
+        else:
+            if row["state"] == RUNNING:     # прерван рестартом
+                jobstore.requeue(job.id, cfg)
+            self._stores[job.store_id].jobs.append(job)
+        return job
+
+    def _ids(self) -> set[int]:
+        ids = {j.id for j in self._parked} | {j.id for j in self._retrying}
+        for st in self._stores.values():
+            ids.update(j.id for j in st.jobs)
+            ids.update(j.id for j in st.running)
+        return ids
+
+    def _coalesce_target(self, store_id: str, script: str) -> Job | None:
+        st = self._stores[store_id]
+        for job in [*st.jobs, *self._retrying]:
+            if job.store_id == store_id and job.script == script:
+                return job
+        live = st.running + [j for j in self._parked if j.store_id == store_id]
+        for job in live:
+            if (job.script == script and job.started
+                    and time.time() - job.started <= settings.COALESCE_WINDOW):
+                return job
+        return None
+
+    def _has_pending(self, owner: int) -> bool:
+        return any(s.jobs for s in self._stores.values() if s.owner_id == owner)
+
+    def _ready(self, st: _Store) -> Job | None:
+        """Первое задание магазина, которое граф шагов и полоса дают запустить."""
+        running = [j.script for j in st.running]
+        waiting = [j.script for j in (*self._parked, *self._retrying)
+                   if j.store_id == st.jobs[0].store_id]
+        ahead: list[str] = []
+        for job in st.jobs:
+            if (self._running[job.lane] < self.lane_limits[job.lane]
+                    and dag.ready(job.script, running, ahead, waiting)):
+                return job
+            ahead.append(job.script)
+        return None
+
+    def _pick(self) -> Job | None:
+        best: Job | None = None
+        best_key = None
+        for st in self._stores.values():
+            if not st.jobs:
+                continue
+            job = self._ready(st)
+            if job is None:
+                continue
+            key = (self._vtime.get(job.owner_id, 0.0), job.seq)
+            if best_key is None or key < best_key:
+                best, best_key = job, key
+        return best
+
+    def _kick(self):
+        while self.running() < self.limit:
+            job = self._pick()
+            if job is None:
+                return
+            st = self._stores[job.store_id]
+            st.jobs.remove(job)
+            st.running.append(job)
+            if job.started is None:
+                job.started = time.time()
+                QUEUE_WAIT.observe(job.started - job.enqueued,
+                                   script=job.script, lane=job.lane)
+                self._trace("queue", job, job.enqueued, job.started)
+            left = deadlines.budget(job.script, job.store_id) - job.busy
+            job.cfg["cancel"] = CancelToken(deadline=time.time() + max(left, MIN_SLICE))
+            jobstore.start(job.id, settings.JOB_LEASE)
+            self._running[job.lane] += 1
+
+            start_tag = self._vtime.get(job.owner_id, 0.0)
+            self._vclock = max(self._vclock, start_tag)
+            self._vtime[job.owner_id] = (
+                start_tag + COST[job.lane] / self.weights.get(job.owner_id, 1.0))
+            job.task = asyncio.create_task(self._run(job))
+            if self._watchdog_task is None or self._watchdog_task.done():
+                self._watchdog_task = asyncio.create_task(self._watchdog())
+
+    async def _run(self, job: Job):
+        log.info("SCHED start %s/%s waited %.1f s (running %s/%s)",
+                 job.store_id, job.script, job.started - job.enqueued,
+                 self.running(), self.limit)
+        res = None
+        t0 = time.monotonic()
+        hb = asyncio.create_task(self._heartbeat(job))
+        try:
+            try:
+                res = await self.runner(job.cfg)
+            except Exception as e:      # мимо run_report: тот же путь classify → повтор / dead-letter
+                log.exception("SCHED %s/%s error: %s", job.store_id, job.script, e)
+                res = False
+                job.cfg["_error"] = repr(e)
+                job.cfg["_failure"] = failures.classify(e)
+                job.cfg["_retry_in"] = failures.retry_delay(job.cfg)
+            job.busy += time.monotonic() - t0
+            delay = job.cfg.pop("_retry_in", None)
+            if isinstance(res, Park):
+                self._park(job, res)
+            elif res is False and delay is not None:
+                self._retry(job, delay)
+            else:
+                jobstore.finish(job.id, res is not False, job.cfg.get("_error"))
+                self._observe(job, res)
+                if res is False and job.cfg.get("_failure"):
+                    jobstore.bury(job.store_id, job.script, job.owner_id,
+                                  job.cfg["_failure"], job.cfg["_error"])
+                    log.warning("SCHED dead-letter %s/%s: %s", job.store_id,
+                                job.script, job.cfg["_error"])
+                if not job.done.done():
+                    job.done.set_result(res)
+        except asyncio.CancelledError:
+            if not job.stalled_at:
+                raise
+            job.busy += time.monotonic() - t0
+            job.cfg["_error"] = "stalled"
+            jobstore.finish(job.id, False, "stalled")
+            self._observe(job, False)
+            await self._alert(job, f"⚠️ {job.cfg.get('human', job.script)}: "
+                                   f"{STALLED} {settings.STALL_MINUTES} мин — задание снято, "
+                                   f"очередь магазина продолжается.")
+            if not job.done.done():
+                job.done.set_result(False)
+        finally:
+            hb.cancel()
+            if not isinstance(res, Park) and job not in self._retrying:
+                for w in job.waiters:
+                    ev = w.get("step_event")
+                    if isinstance(ev, asyncio.Event):
+                        ev.set()
+            self._stores[job.store_id].running.remove(job)
+            self._running[job.lane] -= 1
+            self._kick()
+
+    @staticmethod
+    def _trace(name: str, job: Job, start: float, end: float, **attrs):
+        if "trace_id" in job.cfg:
+            trace.record(name, start, end, trace_id=job.cfg["trace_id"],
+                         parent=job.cfg["span_id"], **attrs)
+
+    @staticmethod
+    def _observe(job: Job, res):
+        if job.cfg.get("_skipped"):
+            result = "skipped"
+        elif res is not False:
+            result = "ok"
+        elif job.cfg.get("_error") in ("cancelled", "deadline", "stalled"):
+            result = job.cfg["_error"]
+        else:
+            result = "failed"
+        JOBS.inc(script=job.script, result=result)
+        if result != "skipped":
+            RUN_TIME.observe(job.busy, script=job.script)
+        if result == "ok":
+            jobstore.record_runtime(job.store_id, job.script, job.busy)
+            jobstore.revive(job.store_id, job.script)
+        if "trace_id" in job.cfg:
+            cfg = job.cfg
+            trace.record("job", job.enqueued, time.time(), trace_id=cfg["trace_id"],
+                         parent=cfg.get("trace_parent"), span_id=cfg["span_id"],
+                         script=job.script, store=job.store_id, result=result)
+            lines = trace.summarize(cfg["trace_id"], cfg["span_id"])
+            if lines:
+                log.info("TRACE %s %s/%s\n%s", cfg["trace_id"], job.store_id,
+                         job.script, "\n".join(lines))
+
+    @staticmethod
+    async def _alert(job: Job, text: str):
+        try:
+            await job.cfg["bot"].send_message(job.cfg["chat_id"], text)
+        except Exception as e:
+            log.warning("SCHED alert %s/%s: %s", job.store_id, job.script, e)
+
+    def stalled(self) -> int:
+        return sum(1 for st in self._stores.values() for j in st.running if j.stalled_at)
+
+    async def _watchdog(self):
+        """Снимает выполняющиеся задания без прогресса (пульс — CancelToken)."""
+        limit = settings.STALL_MINUTES * 60
+        while self.running():
+            await asyncio.sleep(WATCH_EVERY)
+            now = time.time()
+            for job in [j for st in self._stores.values() for j in st.running]:
+                if job.task is None or limit <= 0:
+                    continue
+                token = job.cfg["cancel"]     # у remote пульс — из строки ребёнка
+                if not job.stalled_at and token.idle() > limit:
+                    # сначала по-хорошему: скрипт выйдет на ближайшей проверке
+                    job.stalled_at = now
+                    token.cancel(STALLED)
+                    STALLS.inc(script=job.script, action="cancel")
+                    log.warning("SCHED stalled %s/%s: %.0f с без прогресса",
+                                job.store_id, job.script, token.idle())
+                elif job.stalled_at and now - job.stalled_at > STALL_GRACE:
+                    # висит в вызове, который токен не прерывает: бросаем
+                    STALLS.inc(script=job.script, action="abandon")
+                    log.warning("SCHED abandon %s/%s", job.store_id, job.script)
+                    task, job.task = job.task, None
+                    task.cancel()
+
+    @staticmethod
+    async def _heartbeat(job: Job):
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE / 3)
+            jobstore.heartbeat(job.id, settings.JOB_LEASE)
+
+    # ─── повторы после временных ошибок ───
+    def _retry(self, job: Job, delay: float):
+        cfg = job.cfg
+        error = cfg.pop("_error", "")
+        for k in ("_failure", "_t0"):       # новый заход — с пробой и своим временем
+            cfg.pop(k, None)
+        cfg["_retries"] = cfg.get("_retries", 0) + 1
+        cfg["_retry_at"] = time.time() + delay
+        job.busy = 0.0
+        jobstore.retry(job.id, cfg, error)
+        JOBS.inc(script=job.script, result="retry")
+        log.info("SCHED retry %s/%s #%s in %.0f s", job.store_id, job.script,
+                 cfg["_retries"], delay)
+        self._arm_retry(job, delay)
+
+    def _arm_retry(self, job: Job, delay: float):
+        loop = asyncio.get_running_loop()
+        self._retrying[job] = loop.call_later(max(delay, 0), self._retry_due, job)
+
+    def _retry_now(self, job: Job):
+        """Ручной запрос к ждущему повтора заданию — без остатка паузы."""
+        handle = self._retrying.get(job)
+        if handle is not None:
+            handle.cancel()
+            self._retry_due(job)
+
+    def _retry_due(self, job: Job):
+        if self._retrying.pop(job, None) is None:
+            return
+        job.cfg.pop("_retry_at", None)
+        jobstore.requeue(job.id, job.cfg)
+        self._stores[job.store_id].jobs.appendleft(job)   # он старше всех в очереди
+        self._kick()
+
+    # ─── park / resume ───
+    def _park(self, job: Job, park: Park):
+        job.park = park
+        job.parked_at = time.time()
+        job.next_poll = job.parked_at + park.interval
+        jobstore.park(job.id, job.cfg, park.state, park.interval)
+        self._parked.append(job)
+        log.info("SCHED park %s/%s (parked %s)",
+                 job.store_id, job.script, len(self._parked))
+        if self._parking_task is None or self._parking_task.done():
+            self._parking_task = asyncio.create_task(self._parking_loop())
+
+    def _resume(self, job: Job):
+        self._parked.remove(job)
+        job.cfg["resume"] = job.park.state
+        job.park = None
+        if job.parked_at:
+            self._trace("parked", job, job.parked_at, time.time())
+        jobstore.requeue(job.id, job.cfg)
+        self._stores[job.store_id].jobs.appendleft(job)   # он старше всех в очереди
+        log.info("SCHED resume %s/%s", job.store_id, job.script)
+        self._kick()
+
+    async def _parking_loop(self):
+        while self._parked:
+            await asyncio.sleep(5)
+            now = time.time()
+            for job in [j for j in self._parked if j.next_poll <= now]:
+                try:
+                    ready = await self.poller(job.cfg, job.park.state)
+                except Exception as e:
+                    log.warning("SCHED poll %s/%s: %s", job.store_id, job.script, e)
+                    ready = False
+                if job not in self._parked:     # сняли кнопкой ⏹, пока ждали
+                    continue
+                if ready:
+                    self._resume(job)
+                else:
+                    job.next_poll = time.time() + job.park.interval
+
+
+# Singleton
+scheduler = Scheduler()
+
+registry.gauge("report_queue_depth", "Задания в очереди по полосе и магазину",
+               scheduler.depths)
+registry.gauge("report_running", "Выполняющиеся задания по полосе",
+               lambda: [({"lane": lane}, scheduler.running(lane)) for lane in (LONG, SHORT)])
+registry.gauge("report_parked", "Задания в park (ждут данных Ozon)",
+               lambda: [({}, scheduler.parked())])
+registry.gauge("report_retrying", "Задания, ждущие повтора после временной ошибки",
+               lambda: [({}, scheduler.retrying())])
+registry.gauge("report_stalled", "Выполняющиеся задания, снятые сторожем и ещё не вышедшие",
+               lambda: [({}, scheduler.stalled())])
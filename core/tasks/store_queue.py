@@ -1,68 +1,109 @@
 """
 Очередь задач для каждого магазина.
 
-• автоматический бесконечный цикл unit_day_5 → p_campain_fin_1 → sleep(30 мин)
-• ручные задания («Обновить отчёт») просто добавляются в очередь
-• кнопка ⏹ ставит флаг cancel: текущий шаг заканчивает работу,
-  очередь очищается, автоматический цикл перезапускается
+• автоматический цикл: unit_day_5 → p_campain_fin_1 каждые 30 мин,
+  balans_1 раз в час, fin_week_1 ночью (core.tasks.periodic)
+• ручные задания просто добавляются в очередь; «Обновить» ставит все
+  шаги графа core.tasks.dag — независимые идут параллельно
+• автоматический запуск пропускается, если проба скрипта показала,
+  что данные с прошлого прогона не изменились (core.tasks.probes),
+  и если (магазин, скрипт) в dead-letter после постоянной ошибки
+  (core.tasks.failures) — до ручного запуска или /dlq_clear
+• кнопка ⏹ очищает очередь магазина, отменяет текущий шаг
+  и выключает автоматический цикл
+
+Сами задания выполняет общий планировщик (core.tasks.scheduler) или,
+при FLEET_SHARDS > 0, воркеры core.tasks.worker (через core.tasks.fleet):
+StoreWorker лишь хранит настройки магазина и ставит задачи по сигналу
+periodic. Включённые автоциклы записаны в jobstore и поднимаются после
+рестарта (restore_loops) — сроки берутся из фаз, а не «все сразу».
 """
 from __future__ import annotations
-import asyncio, logging, time
-from typing import Callable, Any, Dict, Awaitable
+import asyncio, logging, uuid
+from typing import Dict, Iterable
+
+from config import settings
+from core.tasks import dag, trace
+from core.tasks.fleet import fleet
+from core.tasks.jobstore import jobstore
+from core.tasks.periodic import periodic, CADENCES
+from core.tasks.scheduler import scheduler, Job
 
-from core.tasks.queue import enqueue
-from core.tasks.report_runner import run_report
+backend = fleet if settings.FLEET_SHARDS else scheduler
 
 log = logging.getLogger(__name__)
 
+CHAIN = [
+    ("unit_day_5",  "unit-day ≈2 мин"),
+    ("p_campain_fin_1", "ads до 1 часа"),
+]
+
+HUMAN = {
+    **dict(CHAIN),
+    "balans_1":   "balans",
+    "fin_week_1": "fin-week",
+}
+
+
 class StoreWorker:
     def __init__(self, store_id: str, base_cfg: dict):
         self.store_id = store_id
         self.base_cfg = base_cfg
-        self.queue: asyncio.Queue[dict] = asyncio.Queue()
-        self.cancel = asyncio.Event()
-        self._started = False
-
-    async def _worker(self):
-        while True:
-            cfg = await self.queue.get()
-            if self.cancel.is_set():
-                self.queue.task_done()
-                continue
-            await run_report(cfg)
-            self.queue.task_done()
 
-    async def _autoloop(self):
-        while True:
+    def submit(self, script: str, human: str, step: str = "—", **extra) -> Job | int:
+        return backend.submit({
+            **self.base_cfg,
+            "script": script,
+            "human":  human,
+            "step":   step,
+            **trace.carrier(),      # span задания — ребёнок callback-а, если он есть
+            **extra,
+        })
+
+    async def fire(self, task: str):
+        """Срок периодической задачи наступил (вызывает periodic)."""
+        if task == "chain":
             await self.enqueue_chain(manual=False)
-            await asyncio.sleep(1800)   # 30 мин
+            return
+        for script in CADENCES[task].scripts:
+            if not self._dead(script):
+                self.submit(script, HUMAN.get(script, script), auto=True)
+
+    def _dead(self, script: str) -> bool:
+        if jobstore.is_dead(self.store_id, script):
+            log.info("autoloop %s/%s skipped: dead-letter", self.store_id, script)
+            return True
+        return False
 
-    async def enqueue_chain(self, manual: bool = True):
+    async def enqueue_chain(self, manual: bool = True, scripts: Iterable[str] | None = None):
+        """Шаги обновления (по умолчанию CHAIN) в порядке графа core.tasks.dag;
+        что запускать параллельно, решает планировщик."""
+        steps = dag.order(scripts or [s for s, _ in CHAIN])
         step_event = asyncio.Event()
-        chain = [
-            ("unit_day_5",  "unit-day ≈2 мин"),
-            ("p_campain_fin_1", "ads до 1 часа"),
-        ]
-        for idx, (script, human) in enumerate(chain, start=1):
-            await self.queue.put({
-                **self.base_cfg,
-                "script": script,
-                "human": human,
-                "step": f"{idx}/{len(chain)}",
-                "bot":   self.base_cfg["bot"],
-                "step_event": step_event,     # сигнал окончанию шага
-            })
+        chain = uuid.uuid4().hex        # общие данные шагов (core.tasks.context)
+        for idx, script in enumerate(steps, start=1):
+            if not manual and self._dead(script):
+                continue
+            self.submit(script, HUMAN.get(script, script), f"{idx}/{len(steps)}",
+                        step_event=step_event,    # сигнал окончанию шага
+                        auto=not manual,          # автоцикл пропускается, если данные не менялись
+                        chain=chain)
         if manual:
             await self.base_cfg["bot"].send_message(
                 self.base_cfg["chat_id"],
                 "ℹ️ Отчёт добавлен в очередь."
             )
 
+    def stop(self) -> int:
+        """Выключает автоцикл, очищает очередь и отменяет текущий шаг."""
+        periodic.remove(self.store_id)
+        jobstore.delete_loop(self.store_id)
+        return backend.drop(self.store_id)
+
     async def start(self):
-        if not self._started:
-            asyncio.create_task(self._worker())
-            asyncio.create_task(self._autoloop())
-            self._started = True
+        if not periodic.active(self.store_id):
+            jobstore.save_loop(self.store_id, self.base_cfg)
+            periodic.add(self.store_id, self.fire)
 
 
 _workers: Dict[str, StoreWorker] = {}
@@ -72,3 +113,13 @@ async def get_worker(store_id: str, base_cfg: dict) -> StoreWorker:
         _workers[store_id] = StoreWorker(store_id, base_cfg)
         await _workers[store_id].start()
     return _workers[store_id]
+
+
+def restore_loops(bot) -> int:
+    """Поднимает автоциклы после рестарта."""
+    for row in jobstore.loops():
+        w = StoreWorker(row["store_id"], {**row["cfg"], "bot": bot})
+        _workers[row["store_id"]] = w
+        periodic.add(w.store_id, w.fire)
+    log.info("restored %s autoloops", len(_workers))
+    return len(_workers)
@@ -0,0 +1,231 @@
+"""
+Лёгкая трассировка заданий — без коллектора, в локальный JSONL.
+
+Путь одного отчёта: callback в telegram/handlers/store.py → задание
+в очереди (cfg["trace_id"], cfg["span_id"]) → ожидание в очереди →
+каждый заход run_report → фазы скрипта (trace.phase) → каждый HTTP-запрос к Ozon
+и Google (core.services.http). Родитель берётся из contextvar; в потоки
+исполнителей контекст копируется, в дочерние процессы — передаётся ids
+(их span попадают только в файл, не в водопад в логе).
+
+Каждый завершённый span — строка в settings.TRACE_FILE:
+  {"trace", "span", "parent", "name", "start", "dur", "attrs"}
+По завершении задания туда же пишется сводка-«водопад» (и в лог):
+где ушло время — очередь, страницы Ozon, чтение Sheets, запись.
+
+    python -m core.tasks.trace <trace_id>     # водопад из файла
+"""
+from __future__ import annotations
+import json, logging, os, sys, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+from config import settings
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_buffers: dict[str, list[dict]] = {}       # trace_id → span-записи этого процесса
+_BUFFER_TTL = 6 * 3600
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    start: float = field(default_factory=time.time)
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+
+_current: ContextVar[Span | None] = ContextVar("trace_span", default=None)
+_phase: ContextVar[tuple[Span, Token] | None] = ContextVar("trace_phase", default=None)
+
+
+def new_id() -> str:
+    return os.urandom(8).hex()
+
+
+def current_ids() -> tuple[str, str] | None:
+    """(trace_id, span_id) текущего span — для передачи в другой процесс."""
+    cur = _current.get()
+    return (cur.trace_id, cur.span_id) if cur else None
+
+
+def carrier() -> dict[str, str]:
+    """Поля трассировки нового задания: продолжает текущий trace или начинает свой."""
+    cur = _current.get()
+    out = {"trace_id": cur.trace_id if cur else new_id(), "span_id": new_id()}
+    if cur:
+        out["trace_parent"] = cur.span_id
+    return out
+
+
+def _emit(rec: dict):
+    if not settings.TRACE_FILE:
+        return
+    line = json.dumps(rec, ensure_ascii=False, default=str) + "\n"
+    with _lock:
+        _buffers.setdefault(rec["trace"], []).append(rec)
+        Path(settings.TRACE_FILE).parent.mkdir(parents=True, exist_ok=True)
+        with open(settings.TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def record(name: str, start: float, end: float, *, trace_id: str | None = None,
+           parent: str | None = None, span_id: str | None = None, **attrs):
+    """Готовый span с известными началом и концом (очередь, HTTP-ответ)."""
+    cur = _current.get()
+    if trace_id is None:
+        if cur is None:
+            return          # вне задания — не трассируем
+        trace_id, parent = cur.trace_id, cur.span_id
+    _emit({"trace": trace_id, "span": span_id or new_id(), "parent": parent,
+           "name": name, "start": round(start, 3), "dur": round(end - start, 3),
+           "attrs": attrs})
+
+
+@contextmanager
+def span(name: str, *, trace_id: str | None = None, parent: str | None = None,
+         **attrs) -> Iterator[Span]:
+    """Вложенный span; с trace_id — корень захода (родитель parent)."""
+    cur = _current.get()
+    if trace_id is None and cur is not None:
+        trace_id, parent = cur.trace_id, cur.span_id
+    sp = Span(trace_id or new_id(), new_id(), parent, name, attrs=attrs)
+    token = _current.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        record(sp.name, sp.start, time.time(), trace_id=sp.trace_id,
+               parent=sp.parent_id, span_id=sp.span_id, **sp.attrs)
+
+
+def phase(name: str | None, **attrs):
+    """Фаза скрипта без with-блока: закрывает предыдущую и открывает name
+    (None — только закрыть). Вне задания ничего не делает."""
+    prev = _phase.get()
+    if prev is not None:
+        sp, token = prev
+        _current.reset(token)
+        _phase.set(None)
+        record(sp.name, sp.start, time.time(), trace_id=sp.trace_id,
+               parent=sp.parent_id, span_id=sp.span_id, **sp.attrs)
+    cur = _current.get()
+    if name is None or cur is None:
+        return
+    sp = Span(cur.trace_id, new_id(), cur.span_id, name, attrs=attrs)
+    _phase.set((sp, _current.set(sp)))
+
+
+def call(func, /, *args, **kwargs):
+    """func(...) и закрыть незакрытую фазу (return Park, исключение)."""
+    try:
+        return func(*args, **kwargs)
+    except BaseException as e:
+        prev = _phase.get()
+        if prev is not None:
+            prev[0].attrs["error"] = type(e).__name__
+        raise
+    finally:
+        phase(None)
+
+
+@contextmanager
+def adopt(ids: tuple[str, str] | None) -> Iterator[None]:
+    """В дочернем процессе: следующие span — дети span родителя."""
+    if ids is None:
+        yield
+        return
+    token = _current.set(Span(ids[0], ids[1], None, "remote"))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+# ─── водопад ───
+def waterfall(spans: list[dict], root: str) -> list[str]:
+    """Дерево root: смещение от начала, длительность, имя; HTTP — сводкой
+    по хосту под своим родителем (их бывают сотни)."""
+    children: dict[str | None, list[dict]] = {}
+    for s in spans:
+        children.setdefault(s["parent"], []).append(s)
+    by_id = {s["span"]: s for s in spans}
+    if root not in by_id:
+        return []
+    t0 = by_id[root]["start"]
+    out: list[str] = []
+
+    def walk(s: dict, depth: int):
+        attrs = {k: v for k, v in s["attrs"].items() if k not in ("store", "script")}
+        extra = " ".join(f"{k}={v}" for k, v in attrs.items())
+        out.append(f"{s['start'] - t0:8.1f}s {s['dur']:8.1f}s  {'  ' * depth}{s['name']} {extra}".rstrip())
+        kids = sorted(children.get(s["span"], []), key=lambda c: c["start"])
+        http: dict[str, list[float]] = {}
+        for c in kids:
+            if c["name"] == "http":
+                http.setdefault(c["attrs"].get("host", "?"), []).append(c["dur"])
+            else:
+                walk(c, depth + 1)
+        for host, durs in sorted(http.items()):
+            out.append(f"{'':8} {sum(durs):8.1f}s  {'  ' * (depth + 1)}http {host} ×{len(durs)}"
+                       f" (max {max(durs):.1f}s)")
+
+    walk(by_id[root], 0)
+    return out
+
+
+def summarize(trace_id: str, root: str) -> list[str]:
+    """Водопад задания по span этого процесса; пишет его в TRACE_FILE."""
+    now = time.time()
+    with _lock:
+        buf = _buffers.get(trace_id, [])
+        ids = {s["span"]: s for s in buf}
+        parents = {root}            # потомки root; в trace бывают и соседние задания
+        for s in buf:
+            p, chain = s, []
+            while p is not None and p["span"] not in parents:
+                chain.append(p["span"])
+                p = ids.get(p["parent"])
+            if p is not None:
+                parents.update(chain)
+        mine = [s for s in buf if s["span"] in parents]
+        rest = [s for s in buf if s["span"] not in parents]
+        if rest:
+            _buffers[trace_id] = rest
+        else:
+            _buffers.pop(trace_id, None)
+        for tid in [t for t, b in _buffers.items() if now - b[-1]["start"] > _BUFFER_TTL]:
+            del _buffers[tid]
+    lines = waterfall(mine, root)
+    if lines and settings.TRACE_FILE:
+        with _lock, open(settings.TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"trace": trace_id, "span": root, "waterfall": lines},
+                               ensure_ascii=False) + "\n")
+    return lines
+
+
+def main(trace_id: str):
+    spans, roots = [], []
+    with open(settings.TRACE_FILE, encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec["trace"] == trace_id and "waterfall" not in rec:
+                spans.append(rec)
+                if rec["name"] == "job":
+                    roots.append(rec["span"])
+    for root in roots:
+        print("\n".join(waterfall(spans, root)), end="\n\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,190 @@
+"""
+Учёт внешних API по заходам run_report: вызовы, повторы, 429, ошибки,
+байты запроса/ответа и время — по (store_id, script, api, endpoint).
+
+run_report открывает accounting(...) на заход; core.services.http
+(и aiohttp-клиенты Ozon/WB) сообщают о каждом запросе через record().
+Счётчики копятся в памяти захода (contextvar — попадает и в потоки
+исполнителей) и в конце одним INSERT уходят в STATE_DB, таблица
+api_usage. По ней видно, какие магазины и эндпоинты съедают квоты
+и где включать кэши.
+
+Повтор — вызов того же эндпоинта после 429 / 5xx / исключения.
+"""
+from __future__ import annotations
+import re, sqlite3, threading, time, uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, astuple
+from pathlib import Path
+from typing import Any, Iterator
+from urllib.parse import urlsplit
+
+from config import settings
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_usage (
+    run_id     TEXT    NOT NULL,
+    store_id   TEXT    NOT NULL,
+    script     TEXT    NOT NULL,
+    api        TEXT    NOT NULL,
+    endpoint   TEXT    NOT NULL,
+    calls      INTEGER NOT NULL,
+    retries    INTEGER NOT NULL,
+    r429       INTEGER NOT NULL,
+    errors     INTEGER NOT NULL,
+    req_bytes  INTEGER NOT NULL,
+    resp_bytes INTEGER NOT NULL,
+    seconds    REAL    NOT NULL,
+    ts         REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS api_usage_run ON api_usage(run_id);
+CREATE INDEX IF NOT EXISTS api_usage_ts  ON api_usage(ts);
+"""
+
+_APIS = {
+    "api-seller.ozon.ru":             "ozon",
+    "api-performance.ozon.ru":        "ozon_perf",
+    "suppliers-api.wildberries.ru":   "wb",
+    "sheets.googleapis.com":          "sheets",
+    "www.googleapis.com":             "drive",
+    "oauth2.googleapis.com":          "google_auth",
+}
+
+_ID = re.compile(r"^(\d+|[0-9a-f-]{32,36}|[A-Za-z0-9_-]{25,})$")
+
+
+def endpoint_of(url: str) -> tuple[str, str]:
+    """(api, нормализованный путь): id и диапазоны листов — плейсхолдеры."""
+    parts = urlsplit(url)
+    api = _APIS.get(parts.hostname or "", parts.hostname or "?")
+    segs = []
+    for seg in parts.path.split("/"):
+        if segs and segs[-1] == "values":      # /values/<A1-диапазон>[:batchGet…]
+            segs.append(":range")
+            break
+        segs.append(":id" if _ID.match(seg) else seg)
+    return api, "/".join(segs) or "/"
+
+
+@dataclass
+class Stat:
+    calls: int = 0
+    retries: int = 0
+    r429: int = 0
+    errors: int = 0
+    req_bytes: int = 0
+    resp_bytes: int = 0
+    seconds: float = 0.0
+
+
+class RunUsage:
+    def __init__(self, store_id: str, script: str, run_id: str | None = None):
+        self.run_id = run_id or uuid.uuid4().hex
+        self.store_id, self.script = store_id, script
+        self.stats: dict[tuple[str, str], Stat] = {}
+        self._bad: set[tuple[str, str]] = set()     # последний вызов эндпоинта неудачен
+        self._lock = threading.Lock()
+
+    def add(self, url: str, status: int | None, req_bytes: int, resp_bytes: int,
+            seconds: float):
+        key = endpoint_of(url)
+        failed = status is None or status == 429 or status >= 500
+        with self._lock:
+            st = self.stats.setdefault(key, Stat())
+            st.calls += 1
+            st.retries += key in self._bad
+            st.r429 += status == 429
+            st.errors += status is None
+            st.req_bytes += req_bytes
+            st.resp_bytes += resp_bytes
+            st.seconds += seconds
+            (self._bad.add if failed else self._bad.discard)(key)
+
+    def flush(self):
+        if not self.stats:
+            return
+        now = time.time()
+        rows = [(self.run_id, self.store_id, self.script, api, ep, *astuple(st), now)
+                for (api, ep), st in self.stats.items()]
+        _db().executemany(f"INSERT INTO api_usage VALUES ({', '.join('?' * 13)})", rows)
+
+
+_current: ContextVar[RunUsage | None] = ContextVar("api_usage", default=None)
+
+
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        Path(settings.STATE_DB).parent.mkdir(parents=True, exist_ok=True)
+        db = _local.db = sqlite3.connect(settings.STATE_DB, isolation_level=None, timeout=30)
+        db.executescript(_SCHEMA)
+    return db
+
+
+def record(url: str, status: int | None, req_bytes: int = 0, resp_bytes: int = 0,
+           seconds: float = 0.0):
+    """Запрос завершён (status None — исключение). Вне захода — не учитываем."""
+    u = _current.get()
+    if u is not None:
+        u.add(url, status, req_bytes, resp_bytes, seconds)
+
+
+def current_ids() -> tuple[str, str, str] | None:
+    """(run_id, store_id, script) текущего захода — для дочернего процесса."""
+    u = _current.get()
+    return (u.run_id, u.store_id, u.script) if u else None
+
+
+@contextmanager
+def accounting(store_id: str, script: str, run_id: str | None = None) -> Iterator[RunUsage]:
+    u = RunUsage(store_id, script, run_id)
+    token = _current.set(u)
+    try:
+        yield u
+    finally:
+        _current.reset(token)
+        u.flush()
+
+
+@contextmanager
+def adopt(ids: tuple[str, str, str] | None) -> Iterator[None]:
+    """В дочернем процессе: свои счётчики под run_id родителя."""
+    if ids is None:
+        yield
+        return
+    run_id, store_id, script = ids
+    with accounting(store_id, script, run_id):
+        yield
+
+
+def summary(run_id: str) -> str:
+    """Одна строка для лога: по api — вызовы, 429, повторы, ошибки, МБ, сек."""
+    rows = _db().execute(
+        "SELECT api, SUM(calls), SUM(r429), SUM(retries), SUM(errors),"
+        " SUM(req_bytes), SUM(resp_bytes), SUM(seconds)"
+        " FROM api_usage WHERE run_id=? GROUP BY api ORDER BY api", (run_id,)).fetchall()
+    return "; ".join(
+        f"{api}: {calls} выз., 429×{r429}, повт. {retries}, ош. {errors}, "
+        f"↑{up / 2**20:.2f} ↓{down / 2**20:.2f} МБ, {sec:.1f} с"
+        for api, calls, r429, retries, errors, up, down, sec in rows)
+
+
+def top(days: float = 1, by: str = "store_id", limit: int = 10) -> list[dict[str, Any]]:
+    """Крупнейшие потребители квот за days суток: by = store_id | endpoint | script."""
+    assert by in ("store_id", "endpoint", "script")
+    col = "api || ' ' || endpoint" if by == "endpoint" else by
+    cur = _db().cursor()
+    cur.row_factory = sqlite3.Row          # соединение общее — фабрика только у курсора
+    return [dict(r) for r in cur.execute(
+        f"SELECT {col} AS key, SUM(calls) AS calls, SUM(r429) AS r429,"
+        " SUM(retries) AS retries, SUM(resp_bytes) AS resp_bytes"
+        " FROM api_usage WHERE ts > ? GROUP BY key ORDER BY calls DESC LIMIT ?",
+        (time.time() - days * 86400, limit))]
+
+
+def prune(days: int = 30):
+    _db().execute("DELETE FROM api_usage WHERE ts < ?", (time.time() - days * 86400,))
@@ -0,0 +1,65 @@
+"""
+Воркер отчётов — отдельный процесс, отдельное ядро:
+
+    python -m core.tasks.worker --shard 0 --shards 2
+    python -m core.tasks.worker --shard 1 --shards 2
+
+Бот (FLEET_SHARDS=2) только ставит задания в jobstore; каждый воркер
+выполняет задания своих магазинов (core.tasks.fleet.shard_of) своим
+планировщиком — со всеми лимитами, WFQ, park/resume и склейкой повторов.
+На каждый шард — ровно один процесс (systemd-юнит с %i).
+"""
+from __future__ import annotations
+import argparse, asyncio, logging
+
+from config import settings
+from core.tasks.executors import shutdown_executors
+from core.tasks.fleet import RelayBot, shard_of
+from core.tasks.jobstore import jobstore
+from core.tasks.metrics import serve as serve_metrics
+from core.tasks.scheduler import scheduler
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0     # сек между проверками очереди
+
+
+async def serve(shard: int, shards: int):
+    def owns(store_id: str) -> bool:
+        return shard_of(store_id, shards) == shard
+
+    bot = RelayBot()
+    last_id = jobstore.last_id()
+    scheduler.recover(bot, owns)
+    if settings.METRICS_PORT:
+        await serve_metrics(settings.METRICS_PORT + 1 + shard)
+    log.info("worker %s/%s started", shard, shards)
+    while True:
+        for store_id, requested in jobstore.take_drops(owns):
+            jobstore.cancel_queued(store_id, requested)
+            n = scheduler.drop(store_id)
+            log.info("worker %s: drop %s (%s jobs)", shard, store_id, n)
+        last_id = scheduler.pull(bot, owns, last_id)
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Воркер отчётов одного шарда магазинов")
+    ap.add_argument("--shard", type=int, required=True)
+    ap.add_argument("--shards", type=int, required=True)
+    args = ap.parse_args()
+    if not 0 <= args.shard < args.shards:
+        ap.error("--shard должен быть в [0, --shards)")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [%(levelname)s] w{args.shard} %(name)s: %(message)s",
+    )
+    try:
+        asyncio.run(serve(args.shard, args.shards))
+    finally:
+        shutdown_executors()
+
+
+if __name__ == "__main__":
+    main()
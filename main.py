@@ -7,7 +7,10 @@ from aiogram.fsm.storage.memory import MemoryStorage
 
 from config import settings
 from telegram.handlers import router as handlers_router
-from core.tasks.queue import start_workers
+from core.tasks.executors import shutdown_executors
+from core.tasks.fleet import relay_loop
+from core.tasks.metrics import serve as serve_metrics
+from core.tasks.store_queue import backend, restore_loops
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,11 +25,19 @@ async def main() -> None:
     dp = Dispatcher(storage=MemoryStorage())
     dp.include_router(handlers_router)
 
-    # запускаем фоновые workers
-    worker_pool = asyncio.create_task(start_workers(settings.WORKERS))
-
-    await dp.start_polling(bot)
-    await worker_pool  # не даём python завершиться
+    # отчёты выполняет core.tasks.scheduler — поднимаем то, что было до рестарта;
+    # при FLEET_SHARDS > 0 их выполняют воркеры, а бот пересылает их сообщения
+    backend.recover(bot)
+    relay = asyncio.create_task(relay_loop(bot)) if settings.FLEET_SHARDS else None
+    restore_loops(bot)
+    if settings.METRICS_PORT:
+        await serve_metrics(settings.METRICS_PORT)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if relay is not None:
+            relay.cancel()
+        shutdown_executors()
 
 if __name__ == "__main__":
     asyncio.run(main())
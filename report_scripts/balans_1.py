@@ -15,6 +15,12 @@ from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from typing import Dict
 
+from core.services import http
+from core.services.sheet_session import SheetSession
+from core.services.sheet_writer import own_write
+from core.tasks import trace
+from core.tasks.cancel import CancelToken, NEVER
+
 # ───────── helpers ─────────
 def col_letter(n: int) -> str:
     s = ""
@@ -31,15 +37,17 @@ def iso_utc(dt):
 # ───────── main entry ─────────
 def run(*, token_oz: str, client_id: str,
         gs_cred: str, spread_id: str,
-        worksheet: str = "balans_1") -> None:
+        worksheet: str = "balans_1",
+        cancel: CancelToken | None = None) -> None:
 
     # локальные импорты (имён достаточно внутри функции)
-    import requests, gspread, pytz
+    import pytz
     import pandas as pd
     from dateutil.relativedelta import relativedelta
     from google.oauth2.service_account import Credentials
 
     headers = {"Client-Id": client_id, "Api-Key": token_oz}
+    cancel = cancel or NEVER
     tz_msk = pytz.timezone("Europe/Moscow")
     now_msk = datetime.now(tz_msk)
     date_disp = now_msk.strftime("%d.%m.%Y (%H:%M)")
@@ -50,7 +58,7 @@ def run(*, token_oz: str, client_id: str,
     def fetch_free_stock() -> dict[str, int]:
         url = "https://api-seller.ozon.ru/v2/analytics/stock_on_warehouses"
         pay = {"limit": 1000, "offset": 0, "warehouse_type": "ALL"}
-        rows = requests.post(url, headers=headers, json=pay, timeout=60) \
+        rows = http.post(url, headers=headers, json=pay, timeout=60) \
                        .json()["result"]["rows"]
         if not rows:
             return {}
@@ -75,8 +83,9 @@ def run(*, token_oz: str, client_id: str,
         totals: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
 
         while True:
+            cancel.check()
             payload = {"filter": {}, "limit": limit, "last_id": last}
-            rets = requests.post(url, headers=headers, json=payload, timeout=60) \
+            rets = http.post(url, headers=headers, json=payload, timeout=60) \
                            .json().get("returns", [])
             if not rets:
                 break
@@ -114,7 +123,8 @@ def run(*, token_oz: str, client_id: str,
         }
         total, offset = [], 0
         while True:
-            chunk = requests.post(url, headers=headers,
+            cancel.check()
+            chunk = http.post(url, headers=headers,
                                   json={**base, "offset": offset}, timeout=60).json()["result"]
             total += chunk
             if len(chunk) < base["limit"]:
@@ -138,7 +148,7 @@ def run(*, token_oz: str, client_id: str,
     # 4. Supply lookup
     # ------------------------------------------------------------------
     def supply_lookup():
-        ids = requests.post(
+        ids = http.post(
             "https://api-seller.ozon.ru/v2/supply-order/list",
             headers=headers,
             json={"filter": {"states": ["ORDER_STATE_COMPLETED"]},
@@ -148,7 +158,7 @@ def run(*, token_oz: str, client_id: str,
         if not ids:
             return {}
 
-        orders = requests.post(
+        orders = http.post(
             "https://api-seller.ozon.ru/v2/supply-order/get",
             headers=headers,
             json={"order_ids": ids}, timeout=60).json().get("orders", [])
@@ -159,7 +169,7 @@ def run(*, token_oz: str, client_id: str,
         if not bundle_ids:
             return {}
 
-        items = requests.post(
+        items = http.post(
             "https://api-seller.ozon.ru/v1/supply-order/bundle",
             headers=headers,
             json={"bundle_ids": bundle_ids, "is_asc": True,
@@ -179,24 +189,28 @@ def run(*, token_oz: str, client_id: str,
             gs_cred,
             scopes=["https://spreadsheets.google.com/feeds",
                     "https://www.googleapis.com/auth/drive"])
-        sh = gspread.authorize(creds).open_by_key(spread_id)
-        ws = (sh.worksheet(worksheet)
-              if worksheet in [w.title for w in sh.worksheets()]
-              else sh.add_worksheet(worksheet, rows=1000, cols=30))
+        gc = http.gspread_client(creds)
+        # метаданные и весь лист — по одному запросу
+        ss = SheetSession(gc, spread_id)
+        ss.ensure({worksheet: (1000, 30)})
+        ws = ss.worksheet(worksheet)
+        sheet = ss.values(worksheet)
 
         base_hdr = ["Дата обновления", "SKU", "Наименование", "Поставка",
                     "Свободный остаток", "Утиль/Возврат", "Едет на склад Ozon"]
-        hdr = ws.row_values(1) or []
+        old_hdr = list(sheet[0]) if sheet else []
+        while old_hdr and old_hdr[-1] == "":     # как row_values(1)
+            old_hdr.pop()
+        hdr = list(old_hdr)
         for col in base_hdr:
             if col not in hdr:
                 hdr.append(col)
         for st in sorted(statuses):
             if st not in hdr:
                 hdr.append(st)
-        if hdr != ws.row_values(1):
+        if hdr != old_hdr:
             ws.update("A1", [hdr])
 
-        sheet = ws.get_all_values()
         idx = {row[1]: i for i, row in enumerate(sheet[1:], start=2)}
         lastcol = col_letter(len(hdr))
 
@@ -221,19 +235,27 @@ def run(*, token_oz: str, client_id: str,
             else:
                 appends.append(row)
 
-        if updates:
-            ws.batch_update(updates)
-        if appends:
-            ws.append_rows(appends, value_input_option="USER_ENTERED")
+        with own_write(gc, spread_id):
+            if updates:
+                ws.batch_update(updates)
+            if appends:
+                ws.append_rows(appends, value_input_option="USER_ENTERED")
 
     # ------------------------------------------------------------------
     # main pipeline
     # ------------------------------------------------------------------
+    trace.phase("stock")
     free_map = fetch_free_stock()
+    trace.phase("returns")
     returns_map = fetch_returns()
+    cancel.check()
+    trace.phase("supply")
     supply_map = supply_lookup()
+    trace.phase("fbo")
     fbo = fetch_fbo()
     rows_dict, statuses = pivot_statuses(fbo)
 
+    cancel.check()
+    trace.phase("write")
     save_sheet(rows_dict, statuses, free_map, returns_map, supply_map)
     print("[balans_1] ✅ таблица обновлена")
@@ -14,13 +14,18 @@ import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple
 
-import requests
 from dateutil import tz
 import pandas as pd
 import gspread
 from gspread.exceptions import APIError
 from google.oauth2.service_account import Credentials
 
+from core.services import http, ozon_fin, sku_ref
+from core.services.sheet_session import SheetSession
+from core.services.sheet_writer import GridWriter, own_write
+from core.tasks import trace
+from core.tasks.cancel import CancelToken, NEVER
+
 from gspread_formatting import (
     CellFormat, Color, TextFormat,
     format_cell_range, batch_updater
@@ -44,8 +49,6 @@ except ImportError:
 
 
 # ────────────────────  Константы и настройки  ──────────────────────────
-URL_FIN   = 'https://api-seller.ozon.ru/v3/finance/transaction/list'
-PAGE_SIZE = 1000
 REQUEST_TIMEOUT = 60 # Таймаут для запросов к API
 
 # Названия колонок
@@ -94,12 +97,13 @@ def split_by_first_block(rows: List[List]) -> Tuple[List[List], List[List]]:
     return top, rest
 
 # ────────────────────  Работа с Google Sheets  ───────────────────────────
-def open_sheet_retry(creds, key, name, retries=5, delay=5):
-    """Открывает лист с несколькими попытками при ошибках API."""
-    client = gspread.authorize(creds)
+def open_sheet_retry(gc, key, name, retries=3, delay=5) -> SheetSession:
+    """Открывает таблицу (метаданные одним запросом) с несколькими попытками
+    при ошибках API."""
     for i in range(retries):
         try:
-            return client.open_by_key(key).worksheet(name)
+            ss = SheetSession(gc, key)
+            break
         except APIError as e:
             if e.response.status_code in (429, 503) and i < retries - 1:
                 log(f"⚠️ Google API вернул {e.response.status_code}, повтор через {delay} сек.")
@@ -107,10 +111,13 @@ def open_sheet_retry(creds, key, name, retries=5, delay=5):
                 delay *= 2
             else:
                 raise
+    if name not in ss:
+        raise gspread.WorksheetNotFound(name)
+    return ss
 
 def safe_update(func, *args, **kwargs):
     """Обёртка для методов update/batch_update с повторными попытками."""
-    retries, delay = 5, 5
+    retries, delay = 3, 5
     for i in range(retries):
         try:
             return func(*args, **kwargs)
@@ -122,6 +129,12 @@ def safe_update(func, *args, **kwargs):
             else:
                 raise
 
+def _layout(values: List[List]) -> Tuple[List[int], List[int]]:
+    """Номера строк «Итого» и пустых — от них зависят стили листа."""
+    rows = list(enumerate(values, 1))[1:]
+    return ([i for i, r in rows if r and r[0] == "Итого"],
+            [i for i, r in rows if not any(r)])
+
 def apply_styles(sheet, values: List[List]):
     """Применяет стили к шапке, итоговым и пустым строкам."""
     last_col = col_letter(len(values[0]))
@@ -152,65 +165,26 @@ def apply_styles(sheet, values: List[List]):
             format_cell_range(sheet, f"A{s}:{last_col}{e}", BLANK_FMT, batch)
 
 # ────────────────────  Загрузка данных из Ozon  ──────────────────────────
-def month_by_month_operations(headers: dict, bottom_ts: datetime) -> List[Dict]:
-    """Скачивает все операции с Ozon API помесячно с логикой retry."""
+def month_by_month_operations(headers: dict, bottom_ts: datetime,
+                              cancel: CancelToken = NEVER) -> List[Dict]:
+    """Скачивает все операции с Ozon API помесячно (месяцы, уже загруженные
+    шагом той же цепочки, берутся из core.tasks.context)."""
     ops: List[Dict] = []
     cur = datetime.now(tz=tz.tzutc()).replace(microsecond=0)
     
     while cur.replace(day=1) >= bottom_ts:
         m_start = cur.replace(day=1, hour=0, minute=0, second=0)
-        next_m  = m_start.replace(year=m_start.year + (m_start.month // 12), month=(m_start.month % 12) + 1)
-        frm, to = m_start, next_m - timedelta(seconds=1)
-        log(f"🗓️  Загрузка операций за {frm.strftime('%Y-%m')}...")
-        page = 1
-        
-        while True:
-            payload = {"filter": {"date": {"from": frm.strftime('%Y-%m-%dT%H:%M:%S.000Z'), "to": to.strftime('%Y-%m-%dT%H:%M:%S.000Z')}}, "page": page, "page_size": PAGE_SIZE}
-            chunk = []
-            
-            for attempt in range(5): # 5 попыток
-                try:
-                    r = requests.post(URL_FIN, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
-                    if r.status_code == 429:
-                        delay = 15 * (attempt + 1)
-                        log(f"⚠️ API Ozon вернул 429. Повтор через {delay} сек...")
-                        time.sleep(delay)
-                        continue
-                    r.raise_for_status()
-                    chunk = r.json().get("result", {}).get("operations", [])
-                    break
-                except requests.exceptions.RequestException as e:
-                    if attempt == 4:
-                        log(f"❌ Ошибка API Ozon после всех попыток: {e}")
-                        raise
-                    delay = 10 * (attempt + 1)
-                    log(f"⚠️ Ошибка запроса к API Ozon ({e}). Повтор через {delay} сек...")
-                    time.sleep(delay)
-            
-            if not chunk: break
-            ops.extend(chunk)
-            if len(chunk) < PAGE_SIZE: break
-            page += 1
-        
+        log(f"🗓️  Загрузка операций за {m_start.strftime('%Y-%m')}...")
+        ops.extend(ozon_fin.month_ops(headers, m_start, cancel))
         cur = m_start - timedelta(seconds=1)
     return ops
 
 # ────────────────────  Обработка и построение отчёта  ───────────────────
-def load_input_mapping(creds, spreadsheet_id: str, sheet_name: str) -> Dict[int, Tuple[float, float]]:
-    """Загружает справочник SKU, себестоимости и налога из листа input."""
-    ws = open_sheet_retry(creds, spreadsheet_id, sheet_name)
-    rows = ws.get_all_values()
-    hdr = {h: i for i, h in enumerate(rows[0])}
-    mp: Dict[int, Tuple[float, float]] = {}
-    for r in rows[1:]:
-        try:
-            sku = int(r[hdr['SKU']])
-            cost = float(r[hdr.get('Себестоимость', 2)] or 0)
-            tax = float(r[hdr.get('% Налога', 3)] or 0) / 100
-            mp[sku] = (cost, tax)
-        except (ValueError, IndexError):
-            continue
-    return mp
+def load_input_mapping(gc, spreadsheet_id: str, sheet_name: str) -> Dict[int, Tuple[float, float]]:
+    """Справочник SKU → (себестоимость, доля налога) из листа input
+    (общий кэш core.services.sku_ref)."""
+    ref = sku_ref.load(gc, spreadsheet_id, sheet_name)
+    return {sku: (r.cost, (r.tax or 0) / 100) for sku, r in ref.items()}
 
 def build_weekly_report(ops: List[Dict], lookup: Dict[int, Tuple[float, float]]) -> pd.DataFrame:
     """Строит еженедельный отчёт на основе данных об операциях."""
@@ -299,10 +273,15 @@ def build_weekly_report(ops: List[Dict], lookup: Dict[int, Tuple[float, float]])
     return pd.DataFrame(rows, columns=all_cols)
 
 # ────────────────────  Загрузка в Google Sheets  ───────────────────────
-def upload_to_gs(df: pd.DataFrame, creds, spreadsheet_id: str, sheet_name: str):
-    """Обновляет Google-лист: верхний период заменяется, остальное сохраняется."""
+def upload_to_gs(df: pd.DataFrame, gc, spreadsheet_id: str, sheet_name: str):
+    """Обновляет Google-лист: верхний период заменяется, остальное сохраняется.
+
+    На лист уходит только разница с тем, что на нём уже есть
+    (core.services.sheet_writer); стили — если сдвинулись строки.
+    """
     df_prepared = df.where(pd.notnull(df), None)
-    sheet = open_sheet_retry(creds, spreadsheet_id, sheet_name)
+    ss = open_sheet_retry(gc, spreadsheet_id, sheet_name)
+    writer = GridWriter(gc, ss, sheet_name)
     last_col = col_letter(len(df_prepared.columns))
 
     vals = [df_prepared.columns.tolist()] + df_prepared.values.tolist()
@@ -316,59 +295,67 @@ def upload_to_gs(df: pd.DataFrame, creds, spreadsheet_id: str, sheet_name: str):
         sum_formula = "+".join([f'{c}{i+1}' for c in formula_cols])
         # vals[i][1] = f"=SUM(D{i+1}:{last_col}{i+1})"
         
-    old_vals = sheet.get_all_values()
+    old_vals = safe_update(writer.old)
     if len(old_vals) <= 1:
         log("📝 Лист пуст — отчёт будет загружен полностью.")
-        safe_update(sheet.update, vals, 'A1', value_input_option='USER_ENTERED')
-        safe_update(sheet.freeze, rows=1)
-        apply_styles(sheet, vals)
-        log("✅ Отчёт успешно загружен.")
+        merged = vals
+    else:
+        new_top, _ = split_by_first_block(vals)
+        _, old_tail = split_by_first_block(old_vals)
+        merged = [vals[0]] + new_top[1:] + old_tail
+
+    # после сбоя писатель перечитает лист, повтор считает разницу заново
+    plan = safe_update(writer.write, merged)
+    if not plan.changed:
+        log("✅ Лист уже актуален — запись не нужна.")
         return
-
-    new_top, _ = split_by_first_block(vals)
-    _, old_tail = split_by_first_block(old_vals)
-
-    merged = [vals[0]] + new_top[1:] + old_tail
-    
-    safe_update(sheet.clear)
-    safe_update(sheet.update, merged, 'A1', value_input_option='USER_ENTERED')
-    safe_update(sheet.freeze, rows=1)
-    apply_styles(sheet, merged)
-    log("✅ Обновлён только верхний период, старые данные сохранены.")
+    if plan.inserted or plan.deleted or _layout(old_vals) != _layout(merged):
+        sheet = ss.worksheet(sheet_name)
+        with own_write(gc, spreadsheet_id):
+            safe_update(sheet.freeze, rows=1)
+            apply_styles(sheet, merged)
+    log(f"✅ Обновлён верхний период: ячеек {plan.cells}, "
+        f"строк +{plan.inserted}/−{plan.deleted}; старые данные сохранены.")
 
 # ──────────────────────────── MAIN / RUN ────────────────────────────
 def run(*,
-        gs_creds_path: str,
-        spreadsheet_id: str,
-        output_sheet_name: str,
-        input_sheet_name: str,
-        ozon_client_id: str,
-        ozon_api_key: str,
-        start_date_str: str = "2022-01-01"
+        gs_cred: str,
+        spread_id: str,
+        client_id: str,
+        token_oz: str,
+        output_sheet_name: str = "week_fin",
+        input_sheet_name: str = "input",
+        start_date_str: str = "2022-01-01",
+        cancel: CancelToken | None = None,
     ):
     """
     Основная функция для запуска процесса формирования и загрузки отчёта.
     """
     log("🚀 Запуск скрипта fin_week_1")
+    cancel = cancel or NEVER
 
     try:
         creds = Credentials.from_service_account_file(
-            gs_creds_path, scopes=["https://www.googleapis.com/auth/drive", "https://spreadsheets.google.com/feeds"]
+            gs_cred, scopes=["https://www.googleapis.com/auth/drive", "https://spreadsheets.google.com/feeds"]
         )
         
+        gc = http.gspread_client(creds)
+
         log("📥 Читаю лист input со справочником SKU...")
-        sku_map = load_input_mapping(creds, spreadsheet_id, input_sheet_name)
+        trace.phase("input")
+        sku_map = load_input_mapping(gc, spread_id, input_sheet_name)
         log(f"✔ Найдено позиций в справочнике: {len(sku_map)}")
         
         headers = {
-            "Client-Id": ozon_client_id,
-            "Api-Key": ozon_api_key,
+            "Client-Id": client_id,
+            "Api-Key": token_oz,
             "Content-Type": "application/json"
         }
         bottom_ts = datetime.strptime(start_date_str, "%Y-%m-%d").replace(tzinfo=tz.tzutc())
         
         log("⏬ Скачиваю операции Ozon...")
-        ops = month_by_month_operations(headers, bottom_ts)
+        trace.phase("operations")
+        ops = month_by_month_operations(headers, bottom_ts, cancel)
         log(f"✔ Загружено операций: {len(ops)}")
 
         if not ops:
@@ -376,15 +363,18 @@ def run(*,
             return
 
         log("📊 Формирую недельный отчёт...")
+        trace.phase("build")
         df = build_weekly_report(ops, sku_map)
 
+        cancel.check()
         log("📤 Обновляю Google Sheets...")
-        upload_to_gs(df, creds, spreadsheet_id, output_sheet_name)
+        trace.phase("write")
+        upload_to_gs(df, gc, spread_id, output_sheet_name)
         
         log("🎉 Скрипт fin_week_1 успешно завершён!")
 
     except FileNotFoundError:
-        log(f"❌ Критическая ошибка: файл учетных данных Google не найден по пути: {gs_creds_path}")
+        log(f"❌ Критическая ошибка: файл учетных данных Google не найден по пути: {gs_cred}")
         raise
     except Exception as e:
         log(f"❌ Критическая ошибка выполнения: {e}")
@@ -397,11 +387,11 @@ if __name__ == "__main__":
     # В реальных условиях лучше использовать переменные окружения для безопасности.
 
     run(
-        gs_creds_path=r'E:/Ozon_API/teak-digit-438912-s0-cc0207cd6ee3.json',
-        spreadsheet_id='1pkR_vV-g0cI8AUdQEAw2VTS4tBe78t5gD-ExqUnrpfo',
+        gs_cred=r'E:/Ozon_API/teak-digit-438912-s0-cc0207cd6ee3.json',
+        spread_id='1pkR_vV-g0cI8AUdQEAw2VTS4tBe78t5gD-ExqUnrpfo',
         output_sheet_name='week_fin',
         input_sheet_name='input',
-        ozon_client_id='2567268',
-        ozon_api_key='102efb35-db8d-4552-b6fa-75c0a66ce11d',
+        client_id='2567268',
+        token_oz='102efb35-db8d-4552-b6fa-75c0a66ce11d',
         start_date_str="2022-01-01"
     )
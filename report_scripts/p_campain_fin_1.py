@@ -6,6 +6,19 @@ report_scripts/p_campain_fin_1.py
 
 Оптимизированная версия максимально близкая к локальной
 с улучшенной обработкой лимитов API и полным сбором данных.
+
+При запуске из бота (park=True) скрипт не спит в ожидании UUID:
+отправляет запрос статистики, возвращает Park с состоянием и освобождает
+поток; планировщик опрашивает poll() и вызывает run(resume=state).
+
+Если передан store_id, состояние прогона (кампании, отправленные UUID
+с метками времени, разобранные ZIP) после каждой фазы пишется
+в чекпоинт; повторный запуск в пределах UUID_TTL продолжает с того же
+места и скачивает только недостающее.
+
+probe() — отпечаток дневной статистики всех кампаний за тот же период
+(один синхронный запрос): автоцикл пропускает прогон, если расходы
+не изменились (core.tasks.probes).
 """
 from __future__ import annotations
 
@@ -21,6 +34,16 @@ import requests
 import gspread
 from google.oauth2.service_account import Credentials
 
+from core.tasks import checkpoint
+from core.tasks.cancel import CancelToken, NEVER
+from core.services import http
+from core.services.sheet_session import SheetSession
+from core.services.sheet_writer import GridWriter
+from core.tasks import context, trace
+from core.tasks.failures import classify, PERMANENT
+from core.tasks.park import Park
+from core.tasks.probes import digest
+
 API = "https://api-performance.ozon.ru"
 UTC = timezone.utc
 
@@ -28,6 +51,11 @@ UTC = timezone.utc
 REQUEST_TIMEOUT = 60
 RETRY_DELAY = 70  # Задержка при 429 ошибках
 UUID_CHECK_INTERVAL = 120  # Интервал проверки UUID (как в локальной версии)
+UUID_TTL = 4 * 3600  # Сколько живёт чекпоинт с отправленными UUID
+
+
+class ReportFailed(RuntimeError):
+    """Ozon не собрал отчёт по UUID (state FAILED) — чанк отправляется заново."""
 
 
 # ──────────────────────────── helpers ────────────────────────────
@@ -35,20 +63,21 @@ def log(msg: str):
     print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}", flush=True)
 
 
-def sleep_progress(sec: int, msg: str = ""):
+def sleep_progress(sec: int, msg: str = "", cancel: CancelToken = NEVER):
     if msg:
         log(msg)
     for i in range(sec):
-        time.sleep(1)
+        cancel.sleep(1)
         print(".", end="", flush=True)
         if (i + 1) % 10 == 0:
             print(f" {i + 1}/{sec}")
     print()
 
 
-def get_token(session: requests.Session, cid: str, secret: str) -> tuple[str, datetime]:
+def get_token(session: requests.Session, cid: str, secret: str,
+              cancel: CancelToken = NEVER) -> tuple[str, datetime]:
     """Получение токена с retry логикой"""
-    max_retries = 3
+    max_retries = 2
     for attempt in range(max_retries):
         try:
             r = session.post(
@@ -57,30 +86,31 @@ def get_token(session: requests.Session, cid: str, secret: str) -> tuple[str, da
                 headers={"Content-Type": "application/json", "Accept": "application/json"},
                 timeout=REQUEST_TIMEOUT,
             )
-            if r.status_code == 429:
-                sleep_progress(RETRY_DELAY, f"⚠️ 429 при получении токена (попытка {attempt + 1})")
+            if r.status_code == 429 and attempt < max_retries - 1:
+                sleep_progress(RETRY_DELAY, f"⚠️ 429 при получении токена (попытка {attempt + 1})", cancel)
                 continue
             r.raise_for_status()
             token = r.json()["access_token"]
             log(f"✅ Токен получен ({token[:10]}...)")
             return token, datetime.now(UTC)
         except Exception as e:
-            if attempt == max_retries - 1:
+            if attempt == max_retries - 1 or classify(e) == PERMANENT:
                 raise
             log(f"⚠️ Ошибка получения токена (попытка {attempt + 1}): {e}")
-            time.sleep(5)
+            cancel.sleep(5)
 
 
 def ensure_token(session: requests.Session,
                  token_time: datetime,
                  cid: str,
                  secret: str,
-                 headers_cb: Callable[[dict], None]) -> datetime:
+                 headers_cb: Callable[[dict], None],
+                 cancel: CancelToken = NEVER) -> datetime:
     """Обновляет токен, если прошло >25 мин (как в локальной версии)"""
     if (datetime.now(UTC) - token_time).total_seconds() <= 1500:  # 25 минут
         return token_time
     log("🔄 Обновление токена по времени...")
-    new_token, new_time = get_token(session, cid, secret)
+    new_token, new_time = get_token(session, cid, secret, cancel)
     headers_cb({"Authorization": f"Bearer {new_token}"})
     return new_time
 
@@ -92,14 +122,15 @@ def chunk(lst: list, n: int = 10):
 
 
 # ─────────────────── работа с Performance API ────────────────────
-def fetch_campaigns(session: requests.Session, headers: dict) -> list[str]:
+def fetch_campaigns(session: requests.Session, headers: dict,
+                    cancel: CancelToken = NEVER) -> list[str]:
     """Получение списка кампаний с retry логикой"""
-    max_retries = 3
+    max_retries = 2
     for attempt in range(max_retries):
         try:
             r = session.get(f"{API}/api/client/campaign", headers=headers, timeout=REQUEST_TIMEOUT)
-            if r.status_code == 429:
-                sleep_progress(RETRY_DELAY, f"⚠️ 429 при получении кампаний (попытка {attempt + 1})")
+            if r.status_code == 429 and attempt < max_retries - 1:
+                sleep_progress(RETRY_DELAY, f"⚠️ 429 при получении кампаний (попытка {attempt + 1})", cancel)
                 continue
             r.raise_for_status()
             
@@ -109,19 +140,20 @@ def fetch_campaigns(session: requests.Session, headers: dict) -> list[str]:
             log(f"📋 Найдено кампаний: {len(ids)} {ids}")
             return ids
         except Exception as e:
-            if attempt == max_retries - 1:
+            if attempt == max_retries - 1 or classify(e) == PERMANENT:
                 raise
             log(f"⚠️ Ошибка получения кампаний (попытка {attempt + 1}): {e}")
-            time.sleep(5)
+            cancel.sleep(5)
 
 
 def post_statistics(session: requests.Session,
                     headers: dict,
                     camp_ids: list[str],
                     date_from: str,
-                    date_to: str) -> str:
+                    date_to: str,
+                    cancel: CancelToken = NEVER) -> str:
     """Отправка запроса на статистику с полной retry логикой"""
-    max_retries = 5
+    max_retries = 2
     for attempt in range(max_retries):
         try:
             payload = {
@@ -138,8 +170,8 @@ def post_statistics(session: requests.Session,
                 timeout=REQUEST_TIMEOUT
             )
             
-            if r.status_code == 429:
-                sleep_progress(RETRY_DELAY, f"⚠️ 429 при запросе статистики (попытка {attempt + 1})")
+            if r.status_code == 429 and attempt < max_retries - 1:
+                sleep_progress(RETRY_DELAY, f"⚠️ 429 при запросе статистики (попытка {attempt + 1})", cancel)
                 continue
                 
             r.raise_for_status()
@@ -148,21 +180,23 @@ def post_statistics(session: requests.Session,
             return uuid
             
         except Exception as e:
-            if attempt == max_retries - 1:
+            if attempt == max_retries - 1 or classify(e) == PERMANENT:
                 raise
             log(f"⚠️ Ошибка запроса статистики (попытка {attempt + 1}): {e}")
-            time.sleep(10)
+            cancel.sleep(10)
 
 
 def wait_uuid(session: requests.Session,
               uuid: str,
               headers_fn: Callable[[], dict],
-              refresh_token_fn: Callable[[], None]):
+              refresh_token_fn: Callable[[], None],
+              cancel: CancelToken = NEVER):
     """Ожидание готовности UUID - точная копия логики из локальной версии"""
     url = f"{API}/api/client/statistics/{uuid}"
     log(f"⏳ Ждём готовности UUID: {uuid}")
     
     while True:
+        cancel.check()
         try:
             # Обновляем токен если нужно
             refresh_token_fn()
@@ -170,7 +204,7 @@ def wait_uuid(session: requests.Session,
             r = session.get(url, headers=headers_fn(), timeout=REQUEST_TIMEOUT)
             
             if r.status_code == 429:
-                sleep_progress(RETRY_DELAY, "⚠️ 429 при проверке UUID")
+                sleep_progress(RETRY_DELAY, "⚠️ 429 при проверке UUID", cancel)
                 continue
                 
             if r.status_code == 403:
@@ -184,23 +218,69 @@ def wait_uuid(session: requests.Session,
             state = data.get("state")
             log(f"🔍 UUID {uuid} → state: {state}")
             
-            if state == "OK":
-                log(f"✅ Отчёт готов: {uuid}")
-                return
-                
-            if state == "FAILED":
-                raise RuntimeError(f"❌ UUID {uuid} завершился с ошибкой")
-                
         except Exception as e:
+            if classify(e) == PERMANENT:
+                raise
             log(f"⚠️ Исключение при проверке UUID {uuid}: {e}")
+            state = None
+
+        if state == "OK":
+            log(f"✅ Отчёт готов: {uuid}")
+            return
+        if state == "FAILED":
+            raise ReportFailed(f"❌ UUID {uuid} завершился с ошибкой")
         
         # Интервал как в локальной версии
-        time.sleep(UUID_CHECK_INTERVAL)
+        cancel.sleep(UUID_CHECK_INTERVAL)
+
+
+def uuid_state(session: requests.Session, headers: dict, uuid: str) -> str | None:
+    """Одна проверка статуса UUID без ожидания (None — не удалось узнать)."""
+    r = session.get(f"{API}/api/client/statistics/{uuid}",
+                    headers=headers, timeout=REQUEST_TIMEOUT)
+    if r.status_code in (403, 429):
+        return None
+    r.raise_for_status()
+    return r.json().get("state")
+
+
+_poll_tokens: dict[str, tuple[str, datetime]] = {}
+
 
+def poll(state: dict, *, perf_client_id: str, perf_client_secret: str) -> bool:
+    """Для планировщика: готов ли state['pending'] (OK или FAILED)."""
+    session = http.session()
+    token, token_time = _poll_tokens.get(perf_client_id, ("", datetime.min.replace(tzinfo=UTC)))
+    if (datetime.now(UTC) - token_time).total_seconds() > 1500:
+        token, token_time = get_token(session, perf_client_id, perf_client_secret)
+        _poll_tokens[perf_client_id] = (token, token_time)
+    st = uuid_state(session, {"Accept": "application/json",
+                              "Authorization": f"Bearer {token}"}, state["pending"])
+    if st is None:
+        _poll_tokens.pop(perf_client_id, None)
+    return st in ("OK", "FAILED")
 
-def download_zip(session: requests.Session, headers: dict, uuid: str) -> bytes:
+
+def probe(*, perf_client_id: str, perf_client_secret: str, days: int = 7) -> str:
+    """Отпечаток расходов: дневная статистика кампаний за период run()."""
+    session = http.session()
+    token, _ = get_token(session, perf_client_id, perf_client_secret)
+    now_msk = datetime.now(UTC) + timedelta(hours=3)
+    date_from = (now_msk - timedelta(days=days)).date().strftime("%Y-%m-%d")
+    date_to = now_msk.date().strftime("%Y-%m-%d")
+    r = session.get(f"{API}/api/client/statistics/daily/json",
+                    params={"dateFrom": date_from, "dateTo": date_to},
+                    headers={"Accept": "application/json",
+                             "Authorization": f"Bearer {token}"},
+                    timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+    return digest([date_from, date_to, r.json()])
+
+
+def download_zip(session: requests.Session, headers: dict, uuid: str,
+                 cancel: CancelToken = NEVER) -> bytes:
     """Скачивание ZIP отчёта с retry логикой"""
-    max_retries = 5
+    max_retries = 2
     for attempt in range(max_retries):
         try:
             r = session.get(
@@ -210,8 +290,8 @@ def download_zip(session: requests.Session, headers: dict, uuid: str) -> bytes:
                 timeout=REQUEST_TIMEOUT
             )
             
-            if r.status_code == 429:
-                sleep_progress(RETRY_DELAY, f"⚠️ 429 при скачивании ZIP (попытка {attempt + 1})")
+            if r.status_code == 429 and attempt < max_retries - 1:
+                sleep_progress(RETRY_DELAY, f"⚠️ 429 при скачивании ZIP (попытка {attempt + 1})", cancel)
                 continue
                 
             if r.status_code == 403:
@@ -227,10 +307,10 @@ def download_zip(session: requests.Session, headers: dict, uuid: str) -> bytes:
             return r.content
             
         except Exception as e:
-            if attempt == max_retries - 1:
+            if attempt == max_retries - 1 or classify(e) == PERMANENT:
                 raise
             log(f"⚠️ Ошибка скачивания ZIP (попытка {attempt + 1}): {e}")
-            time.sleep(10)
+            cancel.sleep(10)
 
 
 # ─────────────────────── CSV → DataFrame ────────────────────────
@@ -312,11 +392,19 @@ def write_sheet(gs_cred: str, spread_id: str, sheet_name: str, df: pd.DataFrame)
     try:
         scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
         creds = Credentials.from_service_account_file(gs_cred, scopes=scope)
-        client = gspread.authorize(creds)
-        sheet = client.open_by_key(spread_id).worksheet(sheet_name)
+        client = http.gspread_client(creds)
+        ss = SheetSession(client, spread_id)
+        if sheet_name not in ss:
+            raise gspread.WorksheetNotFound(sheet_name)
+        writer = GridWriter(client, ss, sheet_name)
         
-        # Получаем существующие данные
-        existing_values = sheet.get_all_values()
+        # Получаем существующие данные: снимок unit_day_5 из той же цепочки,
+        # если лист с тех пор не перезаписывали, иначе — прошлая запись
+        # листа (или одно его чтение)
+        ctx = context.current()
+        existing_values = (ctx.get(f"snapshot:{sheet_name}",
+                                   version=ctx.stamp(f"sheet:{sheet_name}"))
+                           or writer.old())
         if not existing_values:
             log("⚠️ Лист пуст")
             return
@@ -359,12 +447,11 @@ def write_sheet(gs_cred: str, spread_id: str, sheet_name: str, df: pd.DataFrame)
         
         log(f"🔍 Найдено совпадений: {matches_found}")
         
-        # Массовая запись точно как в локальной версии
+        # Колонка F2:F… — на лист уходят только изменившиеся ячейки
         update_data = [[row['rub'] if row['rub'] is not None else ''] for _, row in sheet_data.iterrows()]
-        update_range = f'F2:F{len(sheet_data) + 1}'
-        
-        sheet.update(range_name=update_range, values=update_data)
-        log(f"✅ Записано в Google Таблицу: {matches_found} значений")
+        plan = writer.write(update_data, at=(1, 5), resize=False)
+        log(f"✅ Записано в Google Таблицу: {matches_found} значений "
+            f"(изменилось ячеек: {plan.cells})")
         
     except Exception as e:
         log(f"❌ Ошибка записи в Google Таблицу: {e}")
@@ -380,14 +467,19 @@ def run(
     perf_client_id: str,
     perf_client_secret: str,
     days: int = 7,
+    park: bool = False,
+    resume: dict | None = None,
+    store_id: str | None = None,
+    cancel: CancelToken | None = None,
 ):
     """Основная функция - максимально близко к локальной версии"""
-    log("🚀 Запуск p_campain_fin_1")
+    log("🚀 Запуск p_campain_fin_1" + (" (продолжение)" if resume else ""))
+    cancel = cancel or NEVER
     
-    session = requests.Session()
+    session = http.session()
     
     # Получаем начальный токен
-    token, token_time = get_token(session, perf_client_id, perf_client_secret)
+    token, token_time = get_token(session, perf_client_id, perf_client_secret, cancel)
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -403,69 +495,173 @@ def run(
     
     def refresh_token():
         nonlocal token_time
-        token_time = ensure_token(session, token_time, perf_client_id, perf_client_secret, update_headers)
+        token_time = ensure_token(session, token_time, perf_client_id, perf_client_secret,
+                                  update_headers, cancel)
     
+    def save_checkpoint():
+        if store_id:
+            checkpoint.save(store_id, "p_campain_fin_1", st)
+
+    def drop_checkpoint():
+        if store_id:
+            checkpoint.clear(store_id, "p_campain_fin_1")
+
+    def resubmit():
+        # отчёт по чанку не собран — при повторе отправить чанк заново
+        st["next"] -= 1
+        st["pending"] = None
+        save_checkpoint()
+
     try:
-        # 1. Получаем кампании
-        campaign_ids = fetch_campaigns(session, get_headers())
-        if not campaign_ids:
-            log("❌ Нет активных кампаний")
-            return
-        
         # 2. Формируем даты (точно как в локальной версии)
         now_utc = datetime.now(timezone.utc)
         msk_offset = timedelta(hours=3)
         now_msk = now_utc + msk_offset
         date_to = now_msk.date()
         date_from = (now_msk - timedelta(days=days)).date()
-        date_from_str = date_from.strftime("%Y-%m-%d")
-        date_to_str = date_to.strftime("%Y-%m-%d")
-        
+
+        if resume is None and store_id:
+            resume = checkpoint.load(store_id, "p_campain_fin_1", max_age=UUID_TTL)
+            if resume and (resume["date_from"], resume["date_to"]) != (
+                    date_from.strftime("%Y-%m-%d"), date_to.strftime("%Y-%m-%d")):
+                resume = None   # сменились сутки — старые UUID не про тот период
+            elif resume and resume["submitted"] and \
+                    time.time() - min(resume["submitted"].values()) > UUID_TTL:
+                resume = None   # первые UUID уже протухли у Ozon
+            if resume:
+                log(f"♻️ Продолжаем с чекпоинта: готово UUID {len(resume['ready'])}, "
+                    f"разобрано {len(resume['parsed'])}, чанк {resume['next']}/{len(resume['chunks'])}")
+
+        if resume is None:
+            # 1. Получаем кампании
+            trace.phase("campaigns")
+            campaign_ids = fetch_campaigns(session, get_headers(), cancel)
+            if not campaign_ids:
+                log("❌ Нет активных кампаний")
+                drop_checkpoint()
+                return
+
+            st = {
+                "date_from": date_from.strftime("%Y-%m-%d"),
+                "date_to": date_to.strftime("%Y-%m-%d"),
+                # 10 кампаний в чанке как в локальной версии
+                "chunks": list(chunk(campaign_ids, 10)),
+                "next": 0,          # индекс следующего чанка для отправки
+                "pending": None,    # UUID, который сейчас собирает Ozon
+                "submitted": {},    # UUID → время отправки
+                "ready": [],        # готовые к скачиванию UUID
+                "parsed": {},       # UUID → [[date, sku, rub], ...]
+            }
+            save_checkpoint()
+        else:
+            st = resume
+            st.setdefault("submitted", {})
+            st.setdefault("parsed", {})
+
+        date_from_str, date_to_str = st["date_from"], st["date_to"]
         log(f"📅 Период: {date_from_str} - {date_to_str}")
-        
-        # 3. Собираем UUID для каждого чанка кампаний
-        uuids = []
-        for chunk_campaigns in chunk(campaign_ids, 10):  # 10 кампаний в чанке как в локальной версии
+
+        # 3a. После паузы: проверяем UUID, ради которого засыпали
+        trace.phase("statistics", chunks=len(st["chunks"]))
+        if st["pending"]:
+            uuid = st["pending"]
+            try:
+                state = uuid_state(session, get_headers(), uuid)
+            except Exception as e:
+                log(f"⚠️ Исключение при проверке UUID {uuid}: {e}")
+                state = None
+            if state == "OK":
+                st["ready"].append(uuid)
+                log(f"✅ UUID {uuid} готов к скачиванию")
+            elif state == "FAILED":
+                resubmit()
+                raise ReportFailed(f"❌ UUID {uuid} завершился с ошибкой")
+            elif park:
+                return Park(st, UUID_CHECK_INTERVAL)
+            else:
+                try:
+                    wait_uuid(session, uuid, get_headers, refresh_token, cancel)
+                except ReportFailed:
+                    resubmit()
+                    raise
+                st["ready"].append(uuid)
+            st["pending"] = None
+            save_checkpoint()
+
+        # 3. Собираем UUID для каждого чанка кампаний. Ошибка чанка
+        # прерывает прогон: без него колонка F была бы неполной, а повтор
+        # (с чекпоинта) выдержит планировщик
+        while st["next"] < len(st["chunks"]):
+            cancel.check()
+            chunk_campaigns = st["chunks"][st["next"]]
             try:
                 # Проверяем токен перед запросом
                 refresh_token()
                 
-                uuid = post_statistics(session, get_headers(), chunk_campaigns, date_from_str, date_to_str)
-                
+                uuid = post_statistics(session, get_headers(), chunk_campaigns,
+                                       date_from_str, date_to_str, cancel)
+                st["submitted"][uuid] = time.time()
+                st["pending"] = uuid
+                st["next"] += 1
+                save_checkpoint()
+
+                if park:
+                    # отдаём поток планировщику до готовности отчёта
+                    return Park(st, UUID_CHECK_INTERVAL)
+
                 # Ждём готовности UUID
-                wait_uuid(session, uuid, get_headers, refresh_token)
+                try:
+                    wait_uuid(session, uuid, get_headers, refresh_token, cancel)
+                except ReportFailed:
+                    resubmit()
+                    raise
                 
-                uuids.append(uuid)
+                st["ready"].append(uuid)
+                st["pending"] = None
+                save_checkpoint()
                 log(f"✅ UUID {uuid} готов к скачиванию")
                 
             except Exception as e:
                 log(f"❌ Ошибка обработки чанка кампаний {chunk_campaigns}: {e}")
-                continue
+                raise
+
+        uuids = st["ready"]
         
         if not uuids:
             log("❌ Не получено ни одного UUID")
+            drop_checkpoint()
             return
         
         log(f"📊 Всего UUID для скачивания: {len(uuids)}")
         
         # 4. Скачиваем и обрабатываем все ZIP файлы
+        trace.phase("download", uuids=len(uuids))
         all_dataframes = []
         for uuid in uuids:
+            cancel.check()
             try:
-                refresh_token()  # Обновляем токен перед каждым скачиванием
-                zip_data = download_zip(session, get_headers(), uuid)
-                df = parse_zip(zip_data)
+                if uuid in st["parsed"]:
+                    df = pd.DataFrame(st["parsed"][uuid], columns=['date', 'sku', 'rub'])
+                    log(f"♻️ UUID {uuid}: взят из чекпоинта")
+                else:
+                    refresh_token()  # Обновляем токен перед каждым скачиванием
+                    zip_data = download_zip(session, get_headers(), uuid, cancel)
+                    df = parse_zip(zip_data)
+                    st["parsed"][uuid] = df.values.tolist()
+                    save_checkpoint()
                 if not df.empty:
                     all_dataframes.append(df)
                     log(f"✅ UUID {uuid}: получено {len(df)} строк")
                 else:
                     log(f"⚠️ UUID {uuid}: нет данных")
             except Exception as e:
+                # скачанные ZIP уже в чекпоинте — повтор докачает остальные
                 log(f"❌ Ошибка обработки UUID {uuid}: {e}")
-                continue
+                raise
         
         if not all_dataframes:
             log("❌ Нет данных для записи")
+            drop_checkpoint()
             return
         
         # 5. Объединяем все данные
@@ -478,7 +674,10 @@ def run(
         log(f"💰 Общая сумма расходов: {final_df['rub'].sum():.2f} ₽")
         
         # 6. Записываем в Google Sheets
+        cancel.check()
+        trace.phase("write")
         write_sheet(gs_cred, spread_id, sheet_main, final_df)
+        drop_checkpoint()
         
         log("✅ p_campain_fin_1 успешно завершён")
         
@@ -7,12 +7,40 @@ report_scripts/unit_day_5.py  (обновлён)
       • шапка – жёлтый фон, жирный;
       • строки «Итого» – светло-серый фон, жирный.
 - Как и раньше: колонка F («Расходы на рекламу») не трогается!
+- probe(): дешёвый отпечаток исходных данных (итоги аналитики по дням,
+  финансовые итоги за 30 дней, лист input) — автоцикл пропускает
+  прогон, если он не изменился (core.tasks.probes).
+- После записи в общие данные цепочки (core.tasks.context) кладётся
+  снимок листа (дата + SKU) для p_campain_fin_1.
+- Продажи (/v1/analytics/data) читаются до последней страницы (offset)
+  через общий лимит кабинета (core.services.ratelimit).
+- Услуги и комиссия по SKU за 30 дней — накопленные дневные агрегаты
+  (core.services.unit_costs.rolling): из Ozon докачиваются только новые дни.
+- Расчёт строк — колоночный (unit_rows, numpy) с тем же результатом,
+  что у прежних циклов; замер — benchmarks/bench_unit_econ.py.
+- Лист input — общий справочник SKU (core.services.sku_ref): читается,
+  только если таблица менялась.
+- Чтение таблицы — через core.services.sheet_session: метаданные один
+  раз, недостающие листы одним запросом, листы одним values:batchGet.
+- Запись — разницей (core.services.sheet_writer): вместо clear + полной
+  перезаписи уходят вставки/удаления строк и изменившиеся ячейки, формат —
+  только если сдвинулись строки; без изменений лист не трогается.
 """
 
 from __future__ import annotations
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
+import numpy as np
+
+from core.services import http, ratelimit, sku_ref, unit_costs
+from core.services.sheet_session import SheetSession
+from core.services.sheet_writer import GridWriter
+from core.services.unit_costs import round2
+from core.tasks import context, trace
+from core.tasks.cancel import CancelToken, NEVER
+from core.tasks.probes import digest
+
 # ─────────────────── helpers ───────────────────
 def num(x):
     try:
@@ -29,15 +57,168 @@ def col_letter(n: int) -> str:  # 1-based
     return s
 
 
+# ─────────────────── unit-экономика ───────────────────
+# Колоночный конвейер: JSON продаж один раз раскладывается в массивы,
+# дальше — групповые операции numpy; услуги и комиссия по SKU — из
+# core.services.unit_costs. На тех же операциях таблица та же, что у
+# прежних циклов (benchmarks/bench_unit_econ.py сверяет).
+def unit_rows(sales_rows: list[dict], svc: tuple[np.ndarray, np.ndarray], ref,
+              adv_map: dict, default_tax: float,
+              today_key: str, today_disp: str) -> dict[str, list[list]]:
+    """Строки листа по дням: {ДД.ММ.ГГГГ: [строка, …]} в порядке продаж.
+
+    svc — (skus, n×4: log, acq, last, pct), как у unit_costs.rates()."""
+    rows_by_day: dict[str, list[list]] = defaultdict(list)
+    if not sales_rows:
+        return rows_by_day
+
+    # продажи → группы (день, SKU) в порядке первого появления
+    day_raw, sku_raw, names, m_units, m_rev = zip(*[
+        (r["dimensions"][1]["id"], r["dimensions"][0]["id"], r["dimensions"][0]["name"],
+         r["metrics"][0], r["metrics"][1]) for r in sales_rows])
+    day_raw, sku_raw = np.array(day_raw), np.array(sku_raw)
+    _, first, inv = np.unique(np.char.add(np.char.add(day_raw, "|"), sku_raw),
+                              return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    codes, first = rank[inv.ravel()], first[order]
+    g = len(first)
+    units = np.trunc(np.bincount(codes, np.asarray(m_units, float), g)).astype(np.int64)
+    revenue = round2(np.bincount(codes, np.asarray(m_rev, float), g))
+    last = np.zeros(g, np.int64)
+    np.maximum.at(last, codes, np.arange(len(codes)))
+
+    g_sku = sku_raw[first]
+    sku_int = g_sku.astype(np.int64)
+
+    # услуги и комиссия по SKU
+    skus, rates = svc
+    rate = np.zeros((g, 4))
+    if len(skus):
+        pos = np.minimum(np.searchsorted(skus, sku_int), len(skus) - 1)
+        hit = skus[pos] == sku_int
+        rate[hit] = rates[pos[hit]]
+    log_r = round2(np.abs(rate[:, 0]) * units)
+    acq_r = round2(np.abs(rate[:, 1]) * units)
+    last_r = round2(np.abs(rate[:, 2]) * units)
+    comm_r = round2(revenue * rate[:, 3] / 100)
+
+    # справочник SKU — по уникальным SKU, не по строкам
+    u_sku, u_inv = np.unique(sku_int, return_inverse=True)
+    refs = [ref.get(int(s)) for s in u_sku.tolist()]
+    tax_pct = np.array([round(r.tax, 2) if r and r.tax is not None else default_tax
+                        for r in refs], float)[u_inv.ravel()]
+    sebes = np.array([round(r.cost, 2) if r else 0.0 for r in refs], float)[u_inv.ravel()]
+    ref_name = [r.name if r else "" for r in refs]
+    tax_r = round2(revenue * tax_pct / 100)
+
+    # дни: группы уже в порядке продаж, внутри дня он сохраняется
+    day_ids, day_first, day_code = np.unique(day_raw[first], return_index=True,
+                                             return_inverse=True)
+    day_code = day_code.ravel()
+    disp = [datetime.strptime(d, "%Y-%m-%d").strftime("%d.%m.%Y")
+            for d in day_ids.tolist()]
+    shown = [today_disp if d == today_key else d for d in disp]
+    g_sku = g_sku.tolist()
+    g_name = [ref_name[u] or names[i]
+              for u, i in zip(u_inv.ravel().tolist(), last.tolist())]
+    adv = [adv_map.get((disp[d], sku), 0.0)
+           for d, sku in zip(day_code.tolist(), g_sku)]
+
+    rows = [[shown[d], sku, name, u, rv, ad, lg, cm, aq, ls, tx, "", seb, "", ""]
+            for d, sku, name, u, rv, ad, lg, cm, aq, ls, tx, seb in zip(
+                day_code.tolist(), g_sku, g_name, units.tolist(), revenue.tolist(),
+                adv, log_r.tolist(), comm_r.tolist(), acq_r.tolist(),
+                last_r.tolist(), tax_r.tolist(), sebes.tolist())]
+    by_day = np.argsort(day_code, kind="stable").tolist()
+    n_day = np.bincount(day_code)
+    start, n_day = (np.cumsum(n_day) - n_day).tolist(), n_day.tolist()
+    for d in np.argsort(day_first).tolist():
+        rows_by_day[disp[d]] = [rows[i] for i in by_day[start[d]:start[d] + n_day[d]]]
+    return rows_by_day
+
+
+# ─────────────────── Ozon ───────────────────
+URL_SALES = "https://api-seller.ozon.ru/v1/analytics/data"
+SALES_LIMIT = 1000      # максимум строк за запрос
+
+
+def analytics_rows(headers: dict, req: dict,
+                   cancel: CancelToken = NEVER) -> list[dict]:
+    """Все строки /v1/analytics/data постранично (offset). Метод — раз в
+    минуту на кабинет, поэтому страницы идут по очереди через общий лимит."""
+    rows, offset, r429 = [], 0, 0
+    while True:
+        cancel.check()
+        ratelimit.ozon(headers, URL_SALES, cancel)
+        r = http.post(URL_SALES, headers=headers, timeout=60,
+                      json={**req, "limit": SALES_LIMIT, "offset": offset,
+                            "sort": [{"key": "revenue", "order": "DESC"}]})
+        if r.status_code == 429 and r429 < 2:
+            r429 += 1
+            ratelimit.backoff(headers, URL_SALES, 60)
+            continue
+        r.raise_for_status()
+        chunk = r.json()["result"]["data"]
+        rows.extend(chunk)
+        if len(chunk) < SALES_LIMIT:
+            return rows
+        offset += SALES_LIMIT
+
+
+# ─────────────────── probe ───────────────────
+def probe(*, token_oz: str, client_id: str,
+          gs_cred: str, spread_id: str,
+          sheet_src: str = "input") -> str:
+    """Отпечаток того, из чего строится лист: 3 коротких запроса вместо
+    полного прогона."""
+    import pytz
+    from google.oauth2.service_account import Credentials
+
+    now_msk = datetime.now(timezone.utc).astimezone(pytz.timezone("Europe/Moscow"))
+    HEADERS = {"Client-Id": client_id, "Api-Key": token_oz}
+    date_from = (now_msk - timedelta(days=7)).strftime("%Y-%m-%d")
+    date_to = now_msk.strftime("%Y-%m-%d")
+
+    ratelimit.ozon(HEADERS, URL_SALES)
+    sales = http.post(
+        URL_SALES, headers=HEADERS,
+        json={"date_from": date_from, "date_to": date_to,
+              "metrics": ["ordered_units", "revenue"],
+              "dimension": ["day"], "limit": 1000},
+        timeout=60)
+    sales.raise_for_status()
+
+    fin_from = (now_msk - timedelta(days=30)).strftime("%Y-%m-%dT00:00:00.000Z")
+    url_totals = "https://api-seller.ozon.ru/v3/finance/transaction/totals"
+    ratelimit.ozon(HEADERS, url_totals)
+    fin = http.post(
+        url_totals, headers=HEADERS,
+        json={"date": {"from": fin_from,
+                       "to": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:00:00.000Z")},
+              "transaction_type": "all"},
+        timeout=60)
+    fin.raise_for_status()
+
+    creds = Credentials.from_service_account_file(
+        gs_cred, scopes=["https://www.googleapis.com/auth/spreadsheets.readonly",
+                         "https://www.googleapis.com/auth/drive.metadata.readonly"])
+    inp = sku_ref.load(http.gspread_client(creds), spread_id, sheet_src).digest
+
+    return digest([date_from, date_to, sales.json()["result"],
+                   fin.json()["result"], inp])
+
+
 # ─────────────────── main ───────────────────
 def run(*, token_oz: str, client_id: str,
         gs_cred: str, spread_id: str,
         sheet_main: str = "unit-day",
         sheet_src: str = "input",
-        default_tax: float = 7.0, **_) -> None:
+        default_tax: float = 7.0,
+        cancel: CancelToken | None = None, **_) -> None:
 
-    import requests, gspread, pytz
-    from dateutil import tz
+    import pytz
     from google.oauth2.service_account import Credentials
 
     tz_msk = pytz.timezone("Europe/Moscow")
@@ -46,102 +227,46 @@ def run(*, token_oz: str, client_id: str,
     today_disp = now_msk.strftime("%d.%m.%Y (%H:%M МСК)")
 
     HEADERS = {"Client-Id": client_id, "Api-Key": token_oz}
+    cancel = cancel or NEVER
 
     # ───── 1. Продажи ─────
-    url_sales = "https://api-seller.ozon.ru/v1/analytics/data"
+    trace.phase("sales")
     sales_req = {
         "date_from": (now_msk - timedelta(days=7)).strftime("%Y-%m-%d"),
         "date_to": now_msk.strftime("%Y-%m-%d"),
         "metrics": ["ordered_units", "revenue"],
         "dimension": ["sku", "day"],
-        "limit": 1000,
     }
-    sales_raw = requests.post(url_sales, headers=HEADERS,
-                              json=sales_req, timeout=60).json()
-
-    sales = defaultdict(lambda: {"name": None, "units": 0, "rev": 0.0})
-    for r in sales_raw["result"]["data"]:
-        sku = r["dimensions"][0]["id"]
-        name = r["dimensions"][0]["name"]
-        day = datetime.strptime(r["dimensions"][1]["id"],
-                                "%Y-%m-%d").strftime("%d.%m.%Y")
-        s = sales[(day, sku)]
-        s["name"] = name
-        s["units"] += r["metrics"][0]
-        s["rev"] += r["metrics"][1]
+    sales_rows = analytics_rows(HEADERS, sales_req, cancel)
 
     # ───── 2. Финансы ─────
-    url_fin = "https://api-seller.ozon.ru/v3/finance/transaction/list"
-    fin_req = {
-        "filter": {"date": {
-            "from": (datetime.now(tz.tzutc()) - timedelta(days=30)
-                     ).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-            "to": datetime.now(tz.tzutc()
-                               ).strftime("%Y-%m-%dT%H:%M:%S.000Z")},
-            "transaction_type": "all"},
-        "page": 1, "page_size": 1000,
-    }
-    fin_ops = requests.post(url_fin, headers=HEADERS,
-                            json=fin_req, timeout=60).json() \
-        ["result"]["operations"]
-
-    tmp = defaultdict(lambda: {"log": [], "acq": [], "last": [],
-                               "accr": 0.0, "comm": 0.0})
-    for op in fin_ops:
-        accr = op.get("accruals_for_sale", 0)
-        comm = abs(op.get("sale_commission", 0))
-        for it in op.get("items", []):
-            sku = it["sku"]
-            for s in op.get("services", []):
-                n, p = s["name"], abs(s["price"])
-                if n == "MarketplaceServiceItemDirectFlowLogistic":
-                    tmp[sku]["log"].append(p)
-                elif n == "MarketplaceRedistributionOfAcquiringOperation":
-                    tmp[sku]["acq"].append(p)
-                elif n == "MarketplaceServiceItemDelivToCustomer":
-                    tmp[sku]["last"].append(p)
-            tmp[sku]["accr"] += accr
-            tmp[sku]["comm"] += comm
-
-    svc = {}
-    for sku, d in tmp.items():
-        pct = round(d["comm"] / d["accr"] * 100, 2) if d["accr"] else 0
-        avg = lambda lst: round(sum(lst) / len(lst), 2) if lst else 0
-        svc[sku] = {"log": avg(d["log"]), "acq": avg(d["acq"]),
-                    "last": avg(d["last"]), "pct": pct}
+    cancel.check()
+    trace.phase("finance")
+    # скользящие 30 дней: докачиваются только дни после прошлого прогона
+    svc = unit_costs.rolling(HEADERS, cancel)
 
     # ───── 3. Sheets ─────
+    cancel.check()
+    trace.phase("sheets_read")
     creds = Credentials.from_service_account_file(
         gs_cred,
         scopes=["https://spreadsheets.google.com/feeds",
                 "https://www.googleapis.com/auth/drive"])
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(spread_id)
-    ws = (sh.worksheet(sheet_main)
-          if sheet_main in [w.title for w in sh.worksheets()]
-          else sh.add_worksheet(sheet_main, rows=1000, cols=30))
-
-    if sheet_src not in [w.title for w in sh.worksheets()]:
-        sh.add_worksheet(sheet_src, rows=100, cols=4)
-
-    inp_vals = sh.worksheet(sheet_src).get_all_values()
+    gc = http.gspread_client(creds)
+    # метаданные — один запрос, input — только если справочник SKU устарел,
+    # лист отчёта — своя прошлая запись, пока таблицу никто не правил
+    ss = SheetSession(gc, spread_id)
+    ss.ensure({sheet_main: (1000, 30), sheet_src: (100, 4)})
+
+    ctx = context.current()
+    ref = sku_ref.load(gc, spread_id, sheet_src, read=lambda: ss.values(sheet_src))
+    writer = GridWriter(gc, ss, sheet_main, revision=ref.revision)
     adv_map = {(r[0][:10], r[1]): num(r[5])
-               for r in ws.get_all_values()[1:]
+               for r in writer.old()[1:]
                if r and r[0] not in ("", "Итого")}
 
-    inp_map = {}
-    for row in inp_vals[1:]:
-        if not row or not row[0]:
-            continue
-        sku = str(row[0]).strip()
-        inp_map[sku] = {
-            "name": row[1].strip() if len(row) > 1 else "",
-            "sebes": num(row[2]) if len(row) > 2 else 0.0,
-            "tax%": num(str(row[3]).replace("%", ""))
-            if len(row) > 3 else default_tax,
-        }
-
     # ───── 4. Формирование таблицы ─────
+    trace.phase("build")
     HEAD = ["Дата обновления", "SKU", "Название товара", "Количество продаж",
             "Сумма продаж", "Расходы на рекламу", "Логистика", "Комиссия Озон",
             "Эквайринг", "Последняя миля", "Налог (руб)", "Себес. Продаж",
@@ -151,31 +276,8 @@ def run(*, token_oz: str, client_id: str,
     IDX_TAX, IDX_SEB_PR, IDX_SEB_UNIT = 10, 11, 12
     IDX_PROF, IDX_MAR = 13, 14
 
-    rows_by_day = defaultdict(list)
-    for (day, sku), s in sales.items():
-        sku_str = str(sku)
-        units = int(s["units"])
-        revenue = round(float(s["rev"]), 2)
-
-        sv = svc.get(int(sku), {})
-        log_r = round(abs(sv.get("log", 0)) * units, 2)
-        acq_r = round(abs(sv.get("acq", 0)) * units, 2)
-        last_r = round(abs(sv.get("last", 0)) * units, 2)
-        comm_r = round(revenue * sv.get("pct", 0) / 100, 2)
-
-        tax_pct = inp_map.get(sku_str, {}).get("tax%", default_tax)
-        tax_r = round(revenue * tax_pct / 100, 2)
-
-        adv = adv_map.get((day, sku_str), 0.0)
-        sebes_u = inp_map.get(sku_str, {}).get("sebes", 0.0)
-
-        row = [
-            today_disp if day == today_key else day, sku,
-            inp_map.get(sku_str, {}).get("name") or s["name"],
-            units, revenue, adv, log_r, comm_r, acq_r, last_r,
-            tax_r, "", sebes_u, "", "",
-        ]
-        rows_by_day[day].append(row)
+    rows_by_day = unit_rows(sales_rows, svc, ref, adv_map, default_tax,
+                            today_key, today_disp)
 
     table, total_idx = [HEAD], []
     r_idx = 2
@@ -203,10 +305,9 @@ def run(*, token_oz: str, client_id: str,
         row[IDX_MAR] = f"=IF(E{i}=0;\"\";ROUND(N{i}/E{i}*100;2))"
 
     # ───── 5. Запись + формат ─────
-    ws.clear()
-    ws.update(table, "A1", value_input_option="USER_ENTERED")
-
-    sheet_id = ws.id
+    cancel.check()
+    trace.phase("write")
+    sheet_id = ss.sheets[sheet_main]["sheetId"]
     req = []
 
     # 5.1 сначала полностью сбрасываем формат
@@ -236,4 +337,11 @@ def run(*, token_oz: str, client_id: str,
                 "textFormat": {"bold": True}}},
             "fields": "userEnteredFormat(backgroundColor,textFormat.bold)"}})
 
-    ws.spreadsheet.batch_update({"requests": req})
+    # на лист уходит только разница; формат — если строки сдвинулись
+    totals = lambda t: [i for i, r in enumerate(t, 1) if r and r[0] == "Итого"]
+    plan = writer.diff(table)
+    moved = plan.inserted or plan.deleted or totals(writer.old()) != total_idx
+    writer.apply(plan, req if moved else ())
+    # снимок «дата + SKU» для p_campain_fin_1 — как его вернул бы get_all_values()
+    ctx.put(f"snapshot:{sheet_main}", [[str(c) for c in row[:2]] for row in table],
+            version=ctx.bump(f"sheet:{sheet_main}"))
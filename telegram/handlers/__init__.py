@@ -3,8 +3,10 @@ from aiogram import Router
 from .start import router as start_router
 from .add_store import router as add_router
 from .store import router as store_router   # ← меню магазина
+from .admin import router as admin_router   # ← /stats для админов
 
 router = Router(name="handlers")
+router.include_router(admin_router)
 router.include_router(start_router)
 router.include_router(add_router)
 router.include_router(store_router)
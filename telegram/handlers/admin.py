@@ -0,0 +1,124 @@
+from __future__ import annotations
+import html, time
+
+from aiogram import Router, F
+from aiogram.types import Message
+
+from config import settings
+from core.tasks.executors import executor_stats
+from core.tasks.jobstore import jobstore
+from core.tasks.lanes import LONG, SHORT
+from core.tasks.metrics import QUEUE_WAIT, RUN_TIME, JOBS
+from core.tasks.scheduler import scheduler
+from core.tasks import usage
+
+router = Router(name="admin")
+
+
+def is_admin(user_id: int) -> bool:
+    return str(user_id) in {x.strip() for x in settings.ADMIN_IDS.split(",")}
+
+
+def _sec(v: float | None) -> str:
+    if v is None:
+        return "—"
+    return "∞" if v == float("inf") else f"{v:g}"
+
+
+def _stats_text() -> str:
+    db = jobstore.counts()
+    lines = [
+        "<b>📊 Очередь отчётов</b>",
+        f"jobstore: в очереди {db.get('queued', 0)}, "
+        f"выполняются {db.get('running', 0)}, ждут Ozon {db.get('parked', 0)}, "
+        f"ждут повтора {db.get('retry', 0)}",
+    ]
+    if settings.FLEET_SHARDS:
+        lines.append(f"отчёты выполняют {settings.FLEET_SHARDS} воркер(а) — "
+                     f"их метрики на портах {settings.METRICS_PORT}+1…")
+    else:
+        depth = {LONG: 0, SHORT: 0}
+        for labels, n in scheduler.depths():
+            depth[labels["lane"]] += n
+        lines.append(
+            f"long: {scheduler.running(LONG)}/{scheduler.lane_limits[LONG]} идут, "
+            f"{depth[LONG]} ждут · short: {scheduler.running(SHORT)}/"
+            f"{scheduler.lane_limits[SHORT]} идут, {depth[SHORT]} ждут · "
+            f"park: {scheduler.parked()} · повтор: {scheduler.retrying()}")
+        stuck = sum(g.get("stuck", 0) for g in executor_stats().values())
+        if scheduler.stalled() or stuck:
+            lines.append(f"⚠️ сторож: снимаются {scheduler.stalled()}, "
+                         f"потоков брошенных заданий {stuck}")
+
+    results: dict[str, dict[str, int]] = {}
+    for key, n in JOBS.values.items():
+        lb = dict(key)
+        results.setdefault(lb["script"], {})[lb["result"]] = int(n)
+    if results:
+        lines += ["", "<b>Скрипты</b> (p50 / p95, сек)"]
+    for script, res in sorted(results.items()):
+        waits = [dict(k) for k in QUEUE_WAIT.values if dict(k)["script"] == script]
+        lane = waits[0]["lane"] if waits else ""
+        wait = (f"{_sec(QUEUE_WAIT.quantile(.5, script=script, lane=lane))} / "
+                f"{_sec(QUEUE_WAIT.quantile(.95, script=script, lane=lane))}")
+        run = (f"{_sec(RUN_TIME.quantile(.5, script=script))} / "
+               f"{_sec(RUN_TIME.quantile(.95, script=script))}")
+        counts = ", ".join(f"{k} {v}" for k, v in sorted(res.items()))
+        lines.append(f"<code>{script}</code>: ждали ≤ {wait}, шли ≤ {run}; {counts}")
+    return "\n".join(lines)
+
+
+@router.message(F.text == "/stats")
+async def cmd_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    await msg.answer(_stats_text())
+
+
+def _usage_text(days: float = 1) -> str:
+    lines = [f"<b>🔌 Внешние API за {days:g} сут.</b> (вызовы / 429 / повторы / МБ)"]
+    for by, title in (("store_id", "Магазины"), ("endpoint", "Эндпоинты")):
+        lines += ["", f"<b>{title}</b>"]
+        for r in usage.top(days, by=by):
+            lines.append(f"<code>{r['key']}</code>: {r['calls']} / {r['r429']} / "
+                         f"{r['retries']} / {(r['resp_bytes'] or 0) / 2**20:.1f}")
+    return "\n".join(lines)
+
+
+@router.message(F.text == "/usage")
+async def cmd_usage(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    await msg.answer(_usage_text())
+
+
+def _dlq_text() -> str:
+    rows = jobstore.dead_letters()
+    if not rows:
+        return "☠️ Dead-letter пуст."
+    lines = [f"<b>☠️ Dead-letter</b> ({len(rows)}) — автозапуск приостановлен"]
+    for r in rows:
+        age = (time.time() - r["first_at"]) / 3600
+        lines.append(f"<code>{r['store_id']}</code> {r['script']} · {r['kind']} ×{r['failures']}, "
+                     f"{age:.0f} ч: {html.escape(r['error'][:200])}")
+    lines.append("\n/dlq_clear &lt;store_id&gt; [script] — вернуть в автозапуск")
+    return "\n".join(lines)
+
+
+@router.message(F.text == "/dlq")
+async def cmd_dlq(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    await msg.answer(_dlq_text())
+
+
+@router.message(F.text.startswith("/dlq_clear"))
+async def cmd_dlq_clear(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    args = msg.text.split()[1:]
+    if not args:
+        await msg.answer("Использование: /dlq_clear &lt;store_id&gt; [script]")
+        return
+    n = jobstore.revive(args[0], args[1] if len(args) > 1 else None)
+    await msg.answer(f"♻️ Снято с dead-letter: {n}.")
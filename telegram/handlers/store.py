@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import asyncio
 import logging
 from aiogram import Router, F, Bot
 from aiogram.types import CallbackQuery, Message
@@ -9,6 +8,7 @@ from aiogram.fsm.state import State, StatesGroup
 
 from telegram.keyboards import kb_store_menu, kb_del_confirm, kb_main
 from core.services.gs_db import GsDB
+from core.tasks import trace
 from core.tasks.store_queue import get_worker, _workers
 
 log = logging.getLogger(__name__)
@@ -119,47 +119,44 @@ async def run_week_once(cb: CallbackQuery):
 
 # ─────── helper: ставим задачу в очередь ───────
 async def _enqueue_single(cb: CallbackQuery, script: str, nice: str):
-    sid = cb.data.split("_", 1)[1]
-    db = GsDB()
-    row = next(r for r in (await db.sheets.read_all(await db._ws("Stores")))[1:]
-               if r[0] == sid)
-
-    worker = await get_worker(sid, {
-        "store_id": sid,
-        "credentials_json": row[4],
-        "sheet_id": row[5],
-        "sa_path":  row[6],
-        "chat_id":  cb.from_user.id,
-        "bot":      cb.bot,
-    })
-    await worker.queue.put({
-        **worker.base_cfg,
-        "script": script,
-        "human":  nice,
-        "step":   "—",
-        "bot":    cb.bot,
-    })
-    await cb.answer("ℹ️ Отчёт добавлен в очередь.")
+    with trace.span("callback", action=script, user=cb.from_user.id):
+        sid = cb.data.split("_", 1)[1]
+        db = GsDB()
+        row = next(r for r in (await db.sheets.read_all(await db._ws("Stores")))[1:]
+                   if r[0] == sid)
+
+        worker = await get_worker(sid, {
+            "store_id": sid,
+            "owner_id": cb.from_user.id,
+            "sheet_id": row[5],
+            "sa_path":  row[6],
+            "chat_id":  cb.from_user.id,
+            "bot":      cb.bot,
+        })
+        worker.submit(script, nice)
+        await cb.answer("ℹ️ Отчёт добавлен в очередь.")
 
 
 # ───── запуск / остановка авто-цикла ─────
 @router.callback_query(F.data.startswith("update_"))
 async def start_auto(cb: CallbackQuery):
-    sid = cb.data.removeprefix("update_")
-    db = GsDB()
-    row = next(r for r in (await db.sheets.read_all(await db._ws("Stores")))[1:]
-               if r[0] == sid)
-
-    worker = await get_worker(sid, {
-        "store_id": sid,
-        "credentials_json": row[4],
-        "sheet_id": row[5],
-        "sa_path":  row[6],
-        "chat_id":  cb.from_user.id,
-        "bot":      cb.bot,
-    })
-    await worker.enqueue_chain(manual=True)
-    await cb.answer("⏳ Авто-обновление запущено.")
+    with trace.span("callback", action="update", user=cb.from_user.id):
+        sid = cb.data.removeprefix("update_")
+        db = GsDB()
+        row = next(r for r in (await db.sheets.read_all(await db._ws("Stores")))[1:]
+                   if r[0] == sid)
+
+        worker = await get_worker(sid, {
+            "store_id": sid,
+            "owner_id": cb.from_user.id,
+            "sheet_id": row[5],
+            "sa_path":  row[6],
+            "chat_id":  cb.from_user.id,
+            "bot":      cb.bot,
+        })
+        await worker.start()
+        await worker.enqueue_chain(manual=True)      # unit-day; balans и fin-week — своими кнопками
+        await cb.answer("⏳ Авто-обновление запущено.")
 
 
 @router.callback_query(F.data.startswith("stop_"))
@@ -170,7 +167,6 @@ async def stop_auto(cb: CallbackQuery):
         await cb.answer("Нет активного обновления")
         return
 
-    w.cancel.set()
-    w.queue = asyncio.Queue()
+    w.stop()
     await cb.answer("⏹ Остановлено.")
     await cb.message.answer("🛑 Обновление прервано.")